@@ -0,0 +1,235 @@
+##
+## Multipass Library - 2024
+## mp [Ubuntu:22.04]
+## File description:
+## benchmarks of the public APIs against the stand-in multipass client
+## @julesreyn
+##
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+from pathlib import Path
+import importlib.util
+import subprocess
+import statistics
+import threading
+import argparse
+import platform
+import tempfile
+import logging
+import shutil
+import json
+import time
+import sys
+import os
+import io
+
+ROOT = Path(__file__).resolve().parent.parent
+BIN_DIR = Path(__file__).resolve().parent / "bin"
+DEFAULT_SIZES = (1, 10, 100)
+
+
+class WebhookSink(BaseHTTPRequestHandler):
+    """Stand-in Discord webhook counting the errors reported by mp.logger."""
+
+    posts = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with WebhookSink.lock:
+            WebhookSink.posts += 1
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_webhook_sink():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), WebhookSink)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def prepare_environment(workdir, latency):
+    """
+    Point mp at the stand-in clients, must run before mp is imported.
+
+    Args:
+        workdir (Path): The scratch directory of the run.
+        latency (float): The latency of every multipass and cloudflared call in seconds.
+    """
+    home = workdir / "home"
+    (home / ".cloudflared").mkdir(parents=True, exist_ok=True)
+    (home / ".cloudflared" / "cert.pem").write_text("bench certificate\n")
+    sink = start_webhook_sink()
+    os.environ.update({
+        "PATH": f'{BIN_DIR}{os.pathsep}{os.environ.get("PATH", "")}',
+        "HOME": str(home),
+        "MP_BENCH_STATE": str(workdir / "state.json"),
+        "MP_BENCH_LATENCY": str(latency),
+        "WEBHOOK_URL": f'http://127.0.0.1:{sink.server_port}/webhook',
+    })
+    sys.path.insert(0, str(ROOT))
+
+
+def reset_fleet(size, state="Running"):
+    """
+    Replace the fake instances with `size` instances in a given state.
+
+    Args:
+        size (int): The number of instances.
+        state (str): The state of every instance, default is "Running".
+    """
+    instances = {f'bench-{index}': {"state": state, "ipv4": f'10.{100 + index // 62500}.{index // 250 % 250}.{index % 250 + 2}',
+                                    "image": "22.04", "cpus": "1", "memory": "1G"} for index in range(size)}
+    Path(os.environ["MP_BENCH_STATE"]).write_text(json.dumps({"instances": instances, "deleted": {}, "next": size}))
+
+
+def load_expose():
+    spec = importlib.util.spec_from_file_location("expose", ROOT / "setup_tools" / "expose.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def bench_get_all_instances(mp, size, workers):
+    reset_fleet(size)
+    return mp.get_all_instances
+
+
+def bench_stop_all_instances(mp, size, workers):
+    reset_fleet(size)
+    return mp.stop_all_instances
+
+
+def bench_install_prerequisites(mp, size, workers):
+    reset_fleet(size)
+    names = [f'bench-{index}' for index in range(size)]
+
+    def run():
+        os.chdir(ROOT) # the setup files are resolved from the repository root
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(mp.install_prerequisites, names))
+    return run
+
+
+def bench_expose_start(mp, size, workers):
+    expose = load_expose()
+    scratch = Path(tempfile.mkdtemp(prefix="expose-", dir=os.environ["HOME"]))
+
+    def run():
+        os.chdir(scratch) # expose keeps its port_status file in the working directory
+        with redirect_stdout(io.StringIO()):
+            for port in range(8000, 8000 + size):
+                expose.start(port)
+    return run
+
+
+BENCHMARKS = {
+    "get_all_instances": bench_get_all_instances,
+    "stop_all_instances": bench_stop_all_instances,
+    "install_prerequisites": bench_install_prerequisites,
+    "expose.start": bench_expose_start,
+}
+
+
+def run_benchmark(mp, name, size, repeat, workers):
+    """
+    Time a benchmark `repeat` times, with a fresh fleet, cache and runner statistics each time.
+
+    Returns:
+        dict: The timings, the multipass calls and the errors reported of the benchmark.
+    """
+    durations = []
+    for _ in range(repeat):
+        run = BENCHMARKS[name](mp, size, workers)
+        mp.instance_cache.clear()
+        mp.runner.reset()
+        posts = WebhookSink.posts
+        start = time.perf_counter()
+        run()
+        durations.append(time.perf_counter() - start)
+        commands = mp.stats()["commands"]
+    return {
+        "benchmark": name,
+        "instances": size,
+        "repeat": repeat,
+        "seconds": {
+            "min": round(min(durations), 4),
+            "median": round(statistics.median(durations), 4),
+            "mean": round(statistics.mean(durations), 4),
+            "max": round(max(durations), 4),
+        },
+        "median_per_instance": round(statistics.median(durations) / size, 4),
+        "multipass_calls": sum(summary["count"] for summary in commands.values()),
+        "calls_by_subcommand": {subcommand: summary["count"] for subcommand, summary in sorted(commands.items())},
+        "errors_reported": WebhookSink.posts - posts,
+    }
+
+
+def revision():
+    try:
+        return subprocess.run(["git", "-C", str(ROOT), "describe", "--always", "--dirty"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark the mp public APIs against a stand-in multipass client.")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="Comma separated fleet sizes (default: 1,10,100).")
+    parser.add_argument("--latency", type=float, default=0.05, help="Latency of every multipass and cloudflared call in seconds (default: 0.05).")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of timed runs per benchmark and size (default: 3).")
+    parser.add_argument("--workers", type=int, default=8, help="Instances provisioned at the same time by install_prerequisites (default: 8).")
+    parser.add_argument("--only", action="append", choices=list(BENCHMARKS), help="Run only this benchmark, can be repeated.")
+    parser.add_argument("--output", default="benchmark-results.json", help="JSON results file, - for stdout (default: benchmark-results.json).")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    sizes = [int(size) for size in args.sizes.split(",")]
+    output = Path(args.output).resolve() if args.output != "-" else None
+    workdir = Path(tempfile.mkdtemp(prefix="mp-bench-"))
+    prepare_environment(workdir, args.latency)
+    logging.basicConfig(level=logging.CRITICAL)
+    import mp
+
+    results, skipped = [], []
+    try:
+        for name in args.only or BENCHMARKS:
+            for size in sizes:
+                try:
+                    result = run_benchmark(mp, name, size, args.repeat, args.workers)
+                except ImportError as error:
+                    skipped.append({"benchmark": name, "reason": f'missing dependency: {error.name}'})
+                    print(f'{name:<24} skipped, missing dependency {error.name}', file=sys.stderr)
+                    break
+                results.append(result)
+                print(f'{name:<24} {size:>5} instances  median {result["seconds"]["median"]:>8.3f}s  '
+                      f'{result["multipass_calls"]:>5} multipass calls  {result["errors_reported"]:>4} errors', file=sys.stderr)
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "revision": revision(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {"sizes": sizes, "latency": args.latency, "repeat": args.repeat, "workers": args.workers},
+        "results": results,
+        "skipped": skipped,
+    }
+    if output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        output.write_text(json.dumps(report, indent=2) + "\n")
+        print(f'Results written to {output}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,13 +7,35 @@
 ##
 
 from mp import *
+import argparse
 import logging
 import datetime
 
 log = logging.getLogger(__name__)
 
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Initialize new Multipass instances.')
+    parser.add_argument('--count', type=int, default=1, help='The number of instances to launch.')
+    parser.add_argument('--image', default=DEFAULT_INSTANCE_IMAGE, help='The image of the instances.')
+    parser.add_argument('--cpus', default=DEFAULT_INSTANCE_VCPUS, help='The number of CPUs of each instance.')
+    parser.add_argument('--memory', default=DEFAULT_INSTANCE_MEMORY, help='The amount of memory of each instance.')
+    parser.add_argument('--concurrency', type=int, default=4, help='The maximum number of instances launched at the same time.')
+    parser.add_argument('--golden', action='store_true', help='Clone the instances from the golden image of their profile.')
+    return parser.parse_args()
+
+
+def print_progress(result, done, total):
+    print(f'[{done}/{total}] {result.name}: {"OK" if result.ok else "FAILED"} ({result.duration}s)')
+
+
 if __name__ == "__main__":
     logging.basicConfig(filename=f"logs/instances/init-vm-{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.log",
                         level=logging.INFO,
                         format='%(asctime)s - %(levelname)s - %(message)s')
-    init_instance()
\ No newline at end of file
+    args = parse_arguments()
+    if args.count == 1:
+        print(init_instance(args.image, args.cpus, args.memory, golden=args.golden))
+    else:
+        launch_fleet(args.count, InstanceProfile(args.image, args.cpus, args.memory), args.concurrency,
+                     golden=args.golden, on_progress=print_progress)
@@ -1,4 +1,15 @@
+from .backends import *
+from .cmd.instance_cache import *
+from .cmd.runner import *
+from .cmd.guest_channel import *
+from .cmd.admission import *
 from .cmd.instance_operations import *
 from .cmd.instance_info import *
+from .cmd.instance_metrics import *
+from .cmd.instance_watcher import *
+from .cmd.instance_exec import *
 from .cmd.file_operations import *
+from .cmd.file_sync import *
+from .cmd.chunked_transfer import *
+from .cmd.warm_pool import *
 from .cmd.instance_prerequisites import *
\ No newline at end of file
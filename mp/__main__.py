@@ -0,0 +1,40 @@
+##
+## Multipass Library - 2024
+## mp [Ubuntu:22.04]
+## File description:
+## multipass library command line entry point
+## @julesreyn
+##
+
+import argparse
+import logging
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(prog='mp', description='Multipass instance manager.')
+    subparsers = parser.add_subparsers(dest='command', help='sub-command help')
+
+    exporter = subparsers.add_parser('exporter', help='Serve instance and tunnel metrics for Prometheus.')
+    exporter.add_argument('--host', default='127.0.0.1', help='The address to listen on.')
+    exporter.add_argument('--port', type=int, default=9464, help='The port to listen on.')
+    exporter.add_argument('--interval', type=float, default=15.0, help='The delay between two collections in seconds.')
+    exporter.add_argument('--workers', type=int, default=8, help='The maximum number of instances probed at the same time.')
+    exporter.add_argument('--timeout', type=float, default=10.0, help='The deadline of each instance probe in seconds.')
+    exporter.add_argument('--expose-status', default='port_status', help='The status file written by expose.')
+
+    return parser, parser.parse_args()
+
+
+def main():
+    parser, args = parse_arguments()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.command == 'exporter':
+        from mp.exporter import serve
+        serve(args.host, args.port, args.interval, args.workers, args.timeout, args.expose_status)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,4 @@
+from .process import *
+from .instance_operations import *
+from .instance_info import *
+from .file_operations import *
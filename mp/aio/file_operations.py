@@ -0,0 +1,67 @@
+##
+## Multipass Library - 2024
+## mp [Ubuntu:22.04]
+## File description:
+## multipass asyncio library for multipass file operations
+## @julesreyn
+##
+
+from mp.aio.process import run_multipass, report
+from mp.logger import logger
+import asyncio
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+
+async def put_file(name, source, destination, timeout=None):
+    """
+    Transfer a file to a specified instance.
+
+    Args:
+        name (str): The name of the instance.
+        source (str): The path to the file to transfer, "~" is expanded to the home directory.
+        destination (str): The destination path on the instance.
+        timeout (float): The deadline of the transfer in seconds, no deadline if None.
+
+    Returns:
+        bool: True if the file was transferred successfully, False otherwise.
+
+    Example:
+        >>> await put_file("instance_name", "file.txt", "/home/ubuntu/file.txt")
+        True
+    """
+    log.info(f'Transferring file to instance {name}: {source} -> {destination}')
+    source = os.path.expanduser(source)
+    if not os.path.exists(source):
+        await asyncio.to_thread(logger, instance=name, error=f"warning: source file {source} does not exist.", status="warning")
+        return False
+    result = await run_multipass(["transfer", source, f"{name}:{destination}"], timeout=timeout)
+    if result.returncode != 0:
+        await report(name, result.stderr)
+    return result.returncode == 0
+
+
+async def get_file(name, source, destination, timeout=None):
+    """
+    Transfer a file from a specified instance.
+
+    Args:
+        name (str): The name of the instance.
+        source (str): The path to the file to transfer.
+        destination (str): The destination path on the host.
+        timeout (float): The deadline of the transfer in seconds, no deadline if None.
+
+    Returns:
+        bool: True if the file was transferred successfully, False otherwise.
+
+    Example:
+        >>> await get_file("instance_name", "/home/ubuntu/file.txt", "file.txt")
+        True
+    """
+    log.info(f'Transferring file from instance {name}: {source} -> {destination}')
+    result = await run_multipass(["transfer", f"{name}:{source}", destination], timeout=timeout)
+    if result.returncode != 0:
+        await report(name, result.stderr)
+    return result.returncode == 0
@@ -0,0 +1,323 @@
+##
+## Multipass Library - 2024
+## mp [Ubuntu:22.04]
+## File description:
+## multipass asyncio library for multipass instance information
+## @julesreyn
+##
+
+from mp.aio.process import run_multipass, report
+from mp.cmd.instance_cache import instance_cache
+from mp.cmd.instance_info import InstanceIndex, cpu_sampler, _parse_snapshots, _parse_instance_index
+from mp.cmd.instance_metrics import FleetMetrics, METRICS_PROBE, _parse_metrics
+import subprocess
+import asyncio
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+
+async def get_snapshots(names=None, timeout=None):
+    """
+    Get a snapshot of several instances with a single `multipass info` call.
+
+    Args:
+        names (list): The names of the instances, all instances if None or empty.
+        timeout (float): The deadline of the call in seconds, no deadline if None.
+
+    Returns:
+        dict: A dictionary mapping the instance names to their InstanceSnapshot.
+
+    Example:
+        >>> await get_snapshots(["instance1", "instance2"])
+        {'instance1': InstanceSnapshot(name='instance1', state='Running', ...), 'instance2': InstanceSnapshot(...)}
+    """
+    names = list(names or [])
+    result = await run_multipass(["info", "--format", "json"] + (names or ["--all"]), timeout=timeout)
+    if result.returncode != 0 and len(names) > 1:
+        result = await run_multipass(["info", "--format", "json", "--all"], timeout=timeout)
+    if result.returncode != 0:
+        await report(", ".join(names) or "get_snapshots", result.stderr)
+        return {}
+    return _parse_snapshots(result.stdout, names)
+
+
+async def get_snapshot(name, timeout=None):
+    """
+    Get a snapshot of a specified instance.
+
+    Args:
+        name (str): The name of the instance.
+        timeout (float): The deadline of the call in seconds, no deadline if None.
+
+    Returns:
+        InstanceSnapshot: The snapshot of the instance, None if the instance does not exist.
+
+    Example:
+        >>> await get_snapshot("instance_name")
+        InstanceSnapshot(name='instance_name', state='Running', ...)
+    """
+    return (await get_snapshots([name], timeout)).get(name)
+
+
+async def _snapshot_field(name, field, timeout):
+    found, value = instance_cache.lookup(name, field)
+    if found:
+        return value
+    return getattr(await get_snapshot(name, timeout), field, None)
+
+
+async def get_ip(name, timeout=None):
+    """
+    Get the IP address of a specified instance.
+
+    Args:
+        name (str): The name of the instance.
+        timeout (float): The deadline of the call in seconds, no deadline if None.
+
+    Returns:
+        str: The IP address of the instance.
+
+    Example:
+        >>> await get_ip("instance_name")
+        192.168.0.1
+    """
+    return await _snapshot_field(name, "ip", timeout)
+
+
+async def get_state(name, timeout=None):
+    """
+    Get the state of a specified instance.
+
+    Args:
+        name (str): The name of the instance.
+        timeout (float): The deadline of the call in seconds, no deadline if None.
+
+    Returns:
+        str: The state of the instance.
+
+    Example:
+        >>> await get_state("instance_name")
+        Running
+    """
+    return await _snapshot_field(name, "state", timeout)
+
+
+async def get_image(name, timeout=None):
+    """
+    Get the image of a specified instance.
+
+    Args:
+        name (str): The name of the instance.
+        timeout (float): The deadline of the call in seconds, no deadline if None.
+
+    Returns:
+        str: The image of the instance.
+
+    Example:
+        >>> await get_image("instance_name")
+        22.04 LTS
+    """
+    return await _snapshot_field(name, "image", timeout)
+
+
+async def get_instance_info(name, timeout=None):
+    """
+    Get information about a specified instance.
+
+    Args:
+        name (str): The name of the instance.
+        timeout (float): The deadline of the call in seconds, no deadline if None.
+
+    Returns:
+        str: Information about the instance, with the layout of `multipass info`.
+
+    Example:
+        >>> print(await get_instance_info("instance_name"))
+        Name:           instance_name
+        State:          Running
+        ...
+    """
+    snapshot = await get_snapshot(name, timeout)
+    return snapshot.describe() if snapshot else None
+
+
+async def get_hostname(name, timeout=None):
+    """
+    Get the hostname of a specified instance.
+
+    Args:
+        name (str): The name of the instance.
+        timeout (float): The deadline of the call in seconds, no deadline if None.
+
+    Returns:
+        str: The hostname of the instance.
+
+    Example:
+        >>> await get_hostname("instance_name")
+        "instance_hostname"
+    """
+    found, hostname = instance_cache.lookup(name, "hostname")
+    if found:
+        return hostname
+    result = await run_multipass(["exec", name, "--", "hostname"], timeout=timeout)
+    if result.returncode != 0:
+        await report(name, result.stderr)
+        return None
+    hostname = result.stdout.strip()
+    instance_cache.set(name, "hostname", hostname)
+    return hostname
+
+
+async def get_cpu_usage(name, timeout=None):
+    """
+    Get the CPU usage of a specified instance since the previous call.
+    0.4 is equal to 40% CPU usage.
+
+    Args:
+        name (str): The name of the instance.
+        timeout (float): The deadline of the call in seconds, no deadline if None.
+
+    Returns:
+        float: The CPU usage of the instance.
+
+    Example:
+        >>> await get_cpu_usage("instance_name")
+        0.0
+    """
+    result = await run_multipass(["exec", name, "--", "head", "-n", "1", "/proc/stat"], timeout=timeout)
+    if result.returncode != 0 or not result.stdout.startswith("cpu"):
+        await report(name, result.stderr)
+        return None
+    return cpu_sampler.sample(name, result.stdout)
+
+
+async def get_instance_index(timeout=None):
+    """
+    Get the index of all instances with a single `multipass list` call.
+
+    Args:
+        timeout (float): The deadline of the call in seconds, no deadline if None.
+
+    Returns:
+        InstanceIndex: The index of all instances, empty if multipass could not be queried.
+
+    Example:
+        >>> (await get_instance_index()).by_state
+        {'Running': ['instance1', 'instance2'], 'Stopped': ['instance3']}
+    """
+    found, index = instance_cache.lookup(None, "index")
+    if found:
+        return index
+    result = await run_multipass(["list", "--format", "json"], timeout=timeout)
+    if result.returncode != 0:
+        await report("get_instance_index", result.stderr)
+        return InstanceIndex()
+    index = _parse_instance_index(result.stdout)
+    instance_cache.set(None, "index", index)
+    return index
+
+
+async def get_running_instances(timeout=None):
+    """
+    Get the names of all running instances.
+
+    Args:
+        timeout (float): The deadline of the call in seconds, no deadline if None.
+
+    Returns:
+        list: A list of the names of all running instances.
+
+    Example:
+        >>> await get_running_instances()
+        ["instance1", "instance2"]
+    """
+    return (await get_instance_index(timeout)).names("Running")
+
+
+async def get_all_instances(timeout=None):
+    """
+    Get the names of all instances, whatever their state.
+
+    Args:
+        timeout (float): The deadline of the call in seconds, no deadline if None.
+
+    Returns:
+        list: A list of the names of all instances.
+
+    Example:
+        >>> await get_all_instances()
+        ["instance1", "instance2", "instance3"]
+    """
+    return (await get_instance_index(timeout)).names()
+
+
+async def collect_metrics(name, timeout=None):
+    """
+    Collect the CPU, memory, disk, uptime, processes, users and hostname of an instance with a single exec.
+
+    Args:
+        name (str): The name of the instance.
+        timeout (float): The deadline of the probe in seconds, no deadline if None.
+
+    Returns:
+        InstanceMetrics: The metrics of the instance, None if the probe failed.
+
+    Raises:
+        subprocess.TimeoutExpired: If the instance did not answer before the deadline.
+
+    Example:
+        >>> await collect_metrics("instance_name")
+        InstanceMetrics(name='instance_name', hostname='instance_name', cpu_usage=0.0213, ...)
+    """
+    result = await run_multipass(["exec", name, "--", "sh", "-c", METRICS_PROBE], timeout=timeout)
+    if result.returncode != 0:
+        await report(name, result.stderr)
+        return None
+    metrics = _parse_metrics(name, result.stdout)
+    instance_cache.set(name, "hostname", metrics.hostname)
+    return metrics
+
+
+async def collect_fleet_metrics(names=None, concurrency=32, timeout=10.0):
+    """
+    Collect the metrics of many instances concurrently on the event loop.
+
+    Args:
+        names (list): The names of the instances, all running instances if None.
+        concurrency (int): The maximum number of probes running at the same time, default is 32.
+        timeout (float): The deadline of each probe in seconds, default is 10.
+
+    Returns:
+        FleetMetrics: The metrics of the instances that answered, and the instances that timed out or failed.
+
+    Example:
+        >>> await collect_fleet_metrics(timeout=5)
+        FleetMetrics(metrics={'instance1': InstanceMetrics(...)}, timed_out=['instance2'], failed=[], duration=5.01)
+    """
+    names = await get_running_instances() if names is None else list(names)
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    fleet = FleetMetrics()
+    start = time.monotonic()
+
+    async def probe(name):
+        async with semaphore:
+            try:
+                metrics = await collect_metrics(name, timeout)
+            except subprocess.TimeoutExpired:
+                log.warning(f'Instance {name} did not answer within {timeout}s')
+                fleet.timed_out.append(name)
+                return
+            except Exception:
+                log.exception(f'Collecting the metrics of instance {name} failed')
+                fleet.failed.append(name)
+                return
+        if metrics is None:
+            fleet.failed.append(name)
+        else:
+            fleet.metrics[name] = metrics
+
+    await asyncio.gather(*(probe(name) for name in names))
+    fleet.duration = round(time.monotonic() - start, 3)
+    return fleet
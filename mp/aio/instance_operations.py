@@ -0,0 +1,152 @@
+##
+## Multipass Library - 2024
+## mp [Ubuntu:22.04]
+## File description:
+## multipass asyncio library for multipass instance operations
+## @julesreyn
+##
+
+from mp.aio.process import run_multipass, report
+from mp.logger import logger
+from mp.cmd.instance_cache import instance_cache, VOLATILE_FIELDS
+from mp.cmd.instance_operations import _update_launch_record
+from mp.cmd.admission import async_admission
+from mp.cmd.guest_channel import close_channel
+import asyncio
+import shlex
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+
+async def exec_command(name, command, timeout=None):
+    """
+    Execute a command on a specified instance.
+
+    Args:
+        name (str): The name of the instance on which to execute the command.
+        command (str | list): The command to execute, a string is split with shell quoting rules.
+        timeout (float): The deadline of the command in seconds, no deadline if None.
+
+    Returns:
+        bool: True if the command executed successfully, False otherwise.
+
+    Raises:
+        subprocess.TimeoutExpired: If the command did not finish before the deadline.
+
+    Example:
+        >>> await exec_command("instance_name", "ls")
+        True
+    """
+    log.info(f'Executing command on instance {name}: {command}')
+    argv = shlex.split(command) if isinstance(command, str) else list(command)
+    result = await run_multipass(["exec", name, "--"] + argv, timeout=timeout)
+    if result.returncode != 0:
+        await report(name, result.stderr)
+    return result.returncode == 0
+
+
+async def launch_instance(name="default_name", image="22.04", cpus="1", memory="2G", timeout=None):
+    """
+    Launch a new instance with the specified parameters.
+
+    Args:
+        name (str): The name of the instance to create.
+        image (str): The image to use for the instance, default is "22.04".
+        cpus (str): The number of CPUs to allocate to the instance.
+        memory (str): The amount of memory to allocate to the instance.
+        timeout (float): The deadline of the launch in seconds, no deadline if None.
+
+    Returns:
+        bool: True if the instance was created successfully, False otherwise or if admission control rejected it.
+
+    Example:
+        >>> await launch_instance("instance_name", "22.04", "1", "2G")
+        True
+    """
+    log.info(f'Launching instance {name} with image {image}, {cpus} CPUs, and {memory} memory')
+    async with async_admission(name, cpus, memory) as admitted:
+        if not admitted:
+            await asyncio.to_thread(logger, instance=name, error="warning: not enough host capacity to launch the instance.", status="warning")
+            return False
+        result = await run_multipass(["launch", "--name", name, "--cpus", cpus, "--memory", memory, image], timeout=timeout)
+    instance_cache.invalidate(name)
+    if result.returncode != 0:
+        await report(name, result.stderr)
+    else:
+        await asyncio.to_thread(_update_launch_record, lambda record: record.update({name: time.time()}))
+    return result.returncode == 0
+
+
+async def start_instance(name, timeout=None):
+    """
+    Start a specified instance.
+
+    Args:
+        name (str): The name of the instance to start.
+        timeout (float): The deadline of the operation in seconds, no deadline if None.
+
+    Returns:
+        bool: True if the instance was started successfully, False otherwise.
+
+    Example:
+        >>> await start_instance("instance_name")
+        True
+    """
+    log.info(f'Starting instance {name}')
+    result = await run_multipass(["start", name], timeout=timeout)
+    instance_cache.invalidate(name, VOLATILE_FIELDS)
+    if result.returncode != 0:
+        await report(name, result.stderr)
+    return result.returncode == 0
+
+
+async def stop_instance(name, timeout=None):
+    """
+    Stop a specified instance.
+
+    Args:
+        name (str): The name of the instance to stop.
+        timeout (float): The deadline of the operation in seconds, no deadline if None.
+
+    Returns:
+        bool: True if the instance was stopped successfully, False otherwise.
+
+    Example:
+        >>> await stop_instance("instance_name")
+        True
+    """
+    log.info(f'Stopping instance {name}')
+    await asyncio.to_thread(close_channel, name)
+    result = await run_multipass(["stop", name], timeout=timeout)
+    instance_cache.invalidate(name, VOLATILE_FIELDS)
+    if result.returncode != 0:
+        await report(name, result.stderr)
+    return result.returncode == 0
+
+
+async def delete_instance(name, timeout=None):
+    """
+    Delete and purge a specified instance.
+
+    Args:
+        name (str): The name of the instance to delete.
+        timeout (float): The deadline of the operation in seconds, no deadline if None.
+
+    Returns:
+        bool: True if the instance was deleted successfully, False otherwise.
+
+    Example:
+        >>> await delete_instance("instance_name")
+        True
+    """
+    log.info(f'Deleting instance {name}')
+    await asyncio.to_thread(close_channel, name)
+    result = await run_multipass(["delete", name, "--purge"], timeout=timeout)
+    instance_cache.invalidate(name)
+    if result.returncode != 0:
+        await report(name, result.stderr)
+    else:
+        await asyncio.to_thread(_update_launch_record, lambda record: record.pop(name, None))
+    return result.returncode == 0
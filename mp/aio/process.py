@@ -0,0 +1,61 @@
+##
+## Multipass Library - 2024
+## mp [Ubuntu:22.04]
+## File description:
+## multipass asyncio library for multipass process handling
+## @julesreyn
+##
+
+from mp.logger import logger
+from mp.cmd.runner import runner
+from mp.backends import get_backend
+import subprocess
+import asyncio
+import logging
+
+log = logging.getLogger(__name__)
+
+
+async def run_multipass(args, input=None, timeout=None):
+    """
+    Run a multipass command on the current backend without blocking the event loop.
+    With the multipass CLI, the process is killed if the deadline expires or if the calling task is cancelled.
+    The command is recorded in the runner statistics, it is not bounded by the runner concurrency limit.
+
+    Args:
+        args (list): The arguments of the multipass command.
+        input (bytes | str): The data to send on the standard input of the command.
+        timeout (float): The deadline of the command in seconds, no deadline if None.
+
+    Returns:
+        subprocess.CompletedProcess: The result of the command, with text stdout and stderr.
+
+    Raises:
+        subprocess.TimeoutExpired: If the command did not finish before the deadline.
+
+    Example:
+        >>> await run_multipass(["list", "--format", "json"], timeout=10)
+        CompletedProcess(args=['multipass', 'list', '--format', 'json'], returncode=0, stdout='{...}', stderr='')
+    """
+    call = runner.start(args)
+    try:
+        result = await get_backend().run_async(call.args, input, timeout)
+    except subprocess.TimeoutExpired:
+        runner.finish(call, timed_out=True)
+        raise
+    except (Exception, asyncio.CancelledError) as error: # e.g. multipass is not on the PATH, or the task was cancelled
+        runner.finish(call, error=error)
+        raise
+    runner.finish(call, result.returncode, len(result.stdout or "") + len(result.stderr or ""))
+    return result
+
+
+async def report(instance, error):
+    """
+    Report an error through the Discord logger without blocking the event loop.
+
+    Args:
+        instance (str): The name of the instance.
+        error (str): The error message.
+    """
+    await asyncio.to_thread(logger, instance=instance, error=error)
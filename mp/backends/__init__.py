@@ -0,0 +1,3 @@
+from .base import *
+from .cli import *
+from .fake import *
@@ -0,0 +1,166 @@
+##
+## Multipass Library - 2024
+## mp [Ubuntu:22.04]
+## File description:
+## multipass backend library for the backend interface and selection
+## @julesreyn
+##
+
+from mp.cmd.instance_cache import instance_cache
+from contextlib import contextmanager
+import subprocess
+import threading
+import asyncio
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class BackendError(RuntimeError):
+    """Raised when a backend cannot be created, e.g. because an optional dependency is missing."""
+
+
+class Backend:
+    """
+    Way of talking to multipass.
+
+    A backend runs multipass sub-commands given with the arguments of the `multipass` CLI
+    and answers like the CLI would: exit code, standard output and standard error. The JSON
+    formats of `list --format json` and `info --format json` are the ones parsed by mp.
+    run answers the one-shot commands, popen starts the streamed ones and run_async serves mp.aio.
+
+    Example:
+        >>> get_backend().run(["list", "--format", "json"])
+        CompletedProcess(args=['multipass', 'list', '--format', 'json'], returncode=0, stdout='{...}', stderr='')
+    """
+
+    name = "base"
+    streaming = True # the processes of popen read their input as it is written, guest channels need it
+
+    def run(self, args, input=None, timeout=None):
+        """
+        Run a multipass sub-command.
+
+        Args:
+            args (list): The arguments of the multipass command, e.g. ["start", "instance_name"].
+            input (str): The data sent to the standard input of the command.
+            timeout (float): The deadline of the command in seconds, no deadline if None.
+
+        Returns:
+            subprocess.CompletedProcess: The exit code and the text output of the command.
+
+        Raises:
+            subprocess.TimeoutExpired: If the command did not finish before the deadline.
+        """
+        raise NotImplementedError
+
+    def popen(self, args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=False):
+        """
+        Start a multipass sub-command without waiting for it, for the streamed execs, tree transfers and guest channels.
+
+        Args:
+            args (list): The arguments of the multipass command, e.g. ["exec", "instance_name", "--", "tar", "-x"].
+            stdin (int): subprocess.PIPE or subprocess.DEVNULL, default is subprocess.DEVNULL.
+            stdout (int): subprocess.PIPE or subprocess.DEVNULL, default is subprocess.PIPE.
+            stderr (int): subprocess.PIPE or subprocess.DEVNULL, default is subprocess.PIPE.
+            text (bool): Open the pipes in text mode, line buffered, default is False.
+
+        Returns:
+            subprocess.Popen: The running command, or an object with the same stdin, stdout, stderr, returncode,
+            poll, wait, kill and communicate.
+        """
+        raise NotImplementedError
+
+    async def run_async(self, args, input=None, timeout=None):
+        """
+        Run a multipass sub-command without blocking the event loop, by default with run in a worker thread.
+
+        Args:
+            args (list): The arguments of the multipass command.
+            input (bytes | str): The data sent to the standard input of the command.
+            timeout (float): The deadline of the command in seconds, no deadline if None.
+
+        Returns:
+            subprocess.CompletedProcess: The exit code and the text output of the command.
+
+        Raises:
+            subprocess.TimeoutExpired: If the command did not finish before the deadline.
+        """
+        if isinstance(input, bytes):
+            input = input.decode()
+        return await asyncio.to_thread(self.run, list(args), input, timeout)
+
+    def close(self):
+        """Release the resources held by the backend."""
+
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """
+    Get the backend used by mp, the multipass CLI unless another one was selected.
+
+    Returns:
+        Backend: The current backend.
+
+    Example:
+        >>> get_backend().name
+        'cli'
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                from mp.backends.cli import CliBackend
+                _backend = CliBackend()
+    return _backend
+
+
+
+def set_backend(backend):
+    """
+    Select the backend used by mp. The instance cache is cleared, its entries came from the previous backend.
+
+    Args:
+        backend (Backend): The new backend, None to go back to the multipass CLI.
+
+    Returns:
+        Backend: The previous backend.
+
+    Example:
+        >>> set_backend(FakeBackend(["instance1"]))
+    """
+    global _backend
+    with _backend_lock:
+        previous, _backend = _backend, backend
+    instance_cache.clear()
+    log.info(f'Using the {backend.name if backend else "cli"} backend')
+    return previous
+
+
+
+@contextmanager
+def use_backend(backend):
+    """
+    Select a backend for the duration of a block.
+
+    Args:
+        backend (Backend): The backend to use.
+
+    Yields:
+        Backend: The backend.
+
+    Example:
+        >>> with use_backend(FakeBackend()) as backend:
+        ...     backend.add_instance("instance_name")
+        ...     get_running_instances()
+        ['instance_name']
+    """
+    previous = set_backend(backend)
+    try:
+        yield backend
+    finally:
+        set_backend(previous)
@@ -0,0 +1,63 @@
+##
+## Multipass Library - 2024
+## mp [Ubuntu:22.04]
+## File description:
+## multipass backend library for the multipass command line client
+## @julesreyn
+##
+
+from mp.backends.base import Backend
+import subprocess
+import asyncio
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class CliBackend(Backend):
+    """
+    Backend running the `multipass` command line client, one process per command.
+
+    Args:
+        executable (str): The multipass client, default is "multipass" from the PATH.
+
+    Example:
+        >>> CliBackend().run(["start", "instance_name"]).returncode
+        0
+    """
+
+    name = "cli"
+
+    def __init__(self, executable="multipass"):
+        self.executable = executable
+
+    def run(self, args, input=None, timeout=None):
+        return subprocess.run([self.executable] + list(args), input=input, capture_output=True, text=True, timeout=timeout)
+
+    def popen(self, args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=False):
+        return subprocess.Popen([self.executable] + list(args), stdin=stdin, stdout=stdout, stderr=stderr,
+                                text=text, bufsize=1 if text else -1)
+
+    async def run_async(self, args, input=None, timeout=None):
+        # the process is killed if the deadline expires or if the calling task is cancelled
+        args = [self.executable] + list(args)
+        if isinstance(input, str):
+            input = input.encode()
+        process = await asyncio.create_subprocess_exec(*args, stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+                                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(input), timeout)
+        except asyncio.TimeoutError:
+            await _kill(process)
+            raise subprocess.TimeoutExpired(args, timeout) from None
+        except asyncio.CancelledError:
+            await _kill(process)
+            raise
+        return subprocess.CompletedProcess(args, process.returncode, stdout.decode(errors="replace"), stderr.decode(errors="replace"))
+
+
+
+async def _kill(process):
+    if process.returncode is None:
+        process.kill()
+        await asyncio.shield(process.wait())
@@ -0,0 +1,386 @@
+##
+## Multipass Library - 2024
+## mp [Ubuntu:22.04]
+## File description:
+## multipass backend library for an in-memory fake of multipass
+## @julesreyn
+##
+
+from mp.backends.base import Backend
+from mp.utils import parse_size
+from dataclasses import dataclass, field
+import subprocess
+import threading
+import logging
+import json
+import time
+import os
+
+log = logging.getLogger(__name__)
+
+_TARGET_STATES = {"start": "Running", "restart": "Running", "stop": "Stopped", "suspend": "Suspended"}
+
+
+@dataclass(slots=True)
+class FakeInstance:
+    """
+    Instance held by a FakeBackend.
+
+    Attributes:
+        name (str): The name of the instance.
+        state (str): The state of the instance.
+        ipv4 (str): The IPv4 address reported while the instance is running.
+        image (str): The image of the instance.
+        cpus (str): The number of vCPUs.
+        memory (str): The memory, e.g. "2G".
+        disk (str): The disk size, e.g. "5G".
+        mounts (dict): A dictionary mapping the mount targets to their host source.
+    """
+    name: str
+    state: str = "Running"
+    ipv4: str = None
+    image: str = "22.04"
+    cpus: str = "1"
+    memory: str = "2G"
+    disk: str = "5G"
+    mounts: dict = field(default_factory=dict)
+
+
+class FakeProcess:
+    """
+    Process returned by FakeBackend.popen, with the interface of subprocess.Popen used by mp.
+
+    The command is answered by the backend once its standard input is closed, then its output is
+    written to the pipes. kill() marks the process as killed but does not interrupt the exec handler.
+    """
+
+    def __init__(self, backend, args, stdin, stdout, stderr, text):
+        self.args = ["multipass"] + args
+        self.returncode = None
+        self.stdin = self.stdout = self.stderr = None
+        self._text = text
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._communication = None
+        input_fd = None
+        if stdin == subprocess.PIPE:
+            input_fd, write_fd = os.pipe()
+            self.stdin = open(write_fd, "w" if text else "wb", buffering=1 if text else -1)
+        self._outputs = []
+        for stream, attribute in ((stdout, "stdout"), (stderr, "stderr")):
+            if stream == subprocess.PIPE:
+                read_fd, write_fd = os.pipe()
+                setattr(self, attribute, open(read_fd, "r" if text else "rb"))
+                self._outputs.append(open(write_fd, "w" if text else "wb"))
+            else:
+                self._outputs.append(None)
+        threading.Thread(target=self._run, args=(backend, args, input_fd), daemon=True).start()
+
+    def _convert(self, value):
+        value = value or ""
+        if self._text:
+            return value.decode(errors="replace") if isinstance(value, bytes) else value
+        return value.encode() if isinstance(value, str) else value
+
+    def _run(self, backend, args, input_fd):
+        data = None if self._text else b"" # binary streams always hand bytes to the exec handler
+        if input_fd is not None:
+            with open(input_fd, "r" if self._text else "rb") as file:
+                data = file.read()
+        try:
+            result = backend.run(args, data)
+        except Exception as error:
+            result = subprocess.CompletedProcess(self.args, 1, "", f'{error}\n')
+        for output, value in zip(self._outputs, (result.stdout, result.stderr)):
+            if output is None:
+                continue
+            try:
+                output.write(self._convert(value))
+                output.close()
+            except (OSError, ValueError):
+                pass
+        with self._lock:
+            if self.returncode is None:
+                self.returncode = result.returncode
+        self._done.set()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise subprocess.TimeoutExpired(self.args, timeout)
+        return self.returncode
+
+    def kill(self):
+        with self._lock:
+            if self.returncode is None:
+                self.returncode = -9
+        self._done.set()
+
+    terminate = kill
+
+    def communicate(self, input=None, timeout=None):
+        if self._communication is None:
+            chunks = {"stdout": [], "stderr": []}
+            threads = [threading.Thread(target=self._collect, args=(getattr(self, source), chunks[source]), daemon=True)
+                       for source in chunks if getattr(self, source) is not None]
+            if self.stdin is not None:
+                threads.append(threading.Thread(target=self._feed, args=(input,), daemon=True))
+            for thread in threads:
+                thread.start()
+            self._communication = (threads, chunks)
+        threads, chunks = self._communication
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in threads:
+            thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+            if thread.is_alive():
+                raise subprocess.TimeoutExpired(self.args, timeout)
+        self.wait()
+        empty = "" if self._text else b""
+        return tuple(empty.join(chunks[source]) if getattr(self, source) is not None else None for source in chunks)
+
+    def _collect(self, stream, chunks):
+        chunks.append(stream.read())
+        stream.close()
+
+    def _feed(self, input):
+        try:
+            if input:
+                self.stdin.write(input)
+            self.stdin.close()
+        except (BrokenPipeError, ValueError):
+            pass
+
+
+
+class FakeBackend(Backend):
+    """
+    In-memory backend answering like multipass, for tests and dry runs.
+
+    It understands list, info, launch, clone, start, stop, suspend, restart, delete, purge,
+    exec, transfer, mount, unmount and version. Every call is recorded in `calls`.
+    Commands run with exec are answered by `exec_handler`, they succeed with no output by default.
+    The processes of popen are answered the same way once their standard input is closed, the input
+    and output are bytes for the binary streams (tree and chunked transfers), even without standard input. Guest channels need
+    a process answering while it runs, they are refused and mp falls back to plain execs.
+
+    Args:
+        instances (list): The names of the instances existing at start, all of them running.
+        exec_handler (callable): Called with (name, argv, input) for each exec, returns a
+            subprocess.CompletedProcess or an (exit code, stdout, stderr) tuple.
+
+    Example:
+        >>> backend = FakeBackend(["instance1"], exec_handler=lambda name, argv, input: (0, name + "\\n", ""))
+        >>> set_backend(backend)
+        >>> get_hostname("instance1")
+        'instance1'
+        >>> backend.calls[-1]
+        ['exec', 'instance1', '--', 'hostname']
+    """
+
+    name = "fake"
+    streaming = False
+
+    def __init__(self, instances=(), exec_handler=None):
+        self.instances = {}
+        self.deleted = {}
+        self.calls = []
+        self.transfers = []
+        self.exec_handler = exec_handler
+        self._addresses = 0
+        self._lock = threading.RLock()
+        for name in instances:
+            self.add_instance(name)
+
+    def add_instance(self, name, state="Running", image="22.04", cpus="1", memory="2G", disk="5G"):
+        """
+        Create an instance without going through launch.
+
+        Args:
+            name (str): The name of the instance.
+            state (str): The state of the instance, default is "Running".
+            image (str): The image of the instance, default is "22.04".
+            cpus (str): The number of vCPUs, default is "1".
+            memory (str): The memory, default is "2G".
+            disk (str): The disk size, default is "5G".
+
+        Returns:
+            FakeInstance: The new instance.
+        """
+        with self._lock:
+            self._addresses += 1
+            instance = FakeInstance(name, state, f'10.99.{self._addresses // 250}.{self._addresses % 250 + 2}', image, str(cpus), memory, disk)
+            self.instances[name] = instance
+            return instance
+
+    def run(self, args, input=None, timeout=None):
+        args = list(args)
+        with self._lock:
+            self.calls.append(args)
+        command = args[0] if args else ""
+        handler = getattr(self, f'_{command.lstrip("-")}', None)
+        if handler is None:
+            return self._result(args, 1, stderr=f'Unknown command: {command}')
+        if command == "exec":
+            return handler(args, input) # the exec handler runs without the lock, execs run in parallel
+        with self._lock:
+            return handler(args, input)
+
+    def popen(self, args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=False):
+        return FakeProcess(self, list(args), stdin, stdout, stderr, text)
+
+    def _result(self, args, returncode=0, stdout="", stderr=""):
+        return subprocess.CompletedProcess(["multipass"] + args, returncode, stdout, stderr)
+
+    def _names(self, args):
+        names = [arg for arg in args[1:] if not arg.startswith("-")]
+        return list(self.instances) if "--all" in args else names
+
+    def _missing(self, args, names, pool=None):
+        pool = self.instances if pool is None else pool
+        missing = [name for name in names if name not in pool]
+        return self._result(args, 2, stderr=f'instance "{missing[0]}" does not exist\n') if missing else None
+
+    def _version(self, args, input):
+        return self._result(args, stdout="multipass   1.15.0\nmultipassd  1.15.0\n")
+
+    def _list(self, args, input):
+        instances = [{"name": instance.name, "state": instance.state,
+                      "ipv4": [instance.ipv4] if instance.state == "Running" else [],
+                      "release": f'Ubuntu {instance.image} LTS'} for instance in self.instances.values()]
+        return self._result(args, stdout=json.dumps({"list": instances}))
+
+    def _info(self, args, input):
+        args = [arg for index, arg in enumerate(args) if arg != "--format" and (index == 0 or args[index - 1] != "--format")]
+        names = self._names(args) or list(self.instances)
+        error = self._missing(args, names)
+        if error:
+            return error
+        info = {}
+        for name in names:
+            instance = self.instances[name]
+            running = instance.state == "Running"
+            info[name] = {
+                "state": instance.state,
+                "ipv4": [instance.ipv4] if running else [],
+                "image_release": f'{instance.image} LTS',
+                "image_hash": "0" * 64,
+                "release": f'Ubuntu {instance.image} LTS' if running else "",
+                "load": [0.0, 0.0, 0.0] if running else [],
+                "cpu_count": instance.cpus,
+                "memory": {"total": parse_size(instance.memory), "used": parse_size(instance.memory) // 10} if running else {},
+                "disks": {"sda1": {"total": str(parse_size(instance.disk)), "used": str(parse_size(instance.disk) // 4)}} if running else {},
+                "mounts": {target: {"source_path": source} for target, source in instance.mounts.items()},
+            }
+        return self._result(args, stdout=json.dumps({"errors": [], "info": info}))
+
+    def _option(self, args, option, default):
+        return args[args.index(option) + 1] if option in args else default
+
+    def _launch(self, args, input):
+        name = self._option(args, "--name", None) or self._option(args, "-n", None) or f'fake-{len(self.instances)}'
+        if name in self.instances:
+            return self._result(args, 1, stderr=f'launch failed: instance "{name}" already exists\n')
+        positional = [arg for index, arg in enumerate(args[1:], 1) if not arg.startswith("-") and not args[index - 1].startswith("-")]
+        self.add_instance(name, image=positional[0] if positional else "22.04", cpus=self._option(args, "--cpus", "1"),
+                          memory=self._option(args, "--memory", "1G"), disk=self._option(args, "--disk", "5G"))
+        return self._result(args, stdout=f'Launched: {name}\n')
+
+    def _clone(self, args, input):
+        source = args[1]
+        error = self._missing(args, [source])
+        if error:
+            return error
+        if self.instances[source].state != "Stopped":
+            return self._result(args, 1, stderr=f'Please stop instance {source} before you clone it.\n')
+        original = self.instances[source]
+        name = self._option(args, "--name", None) or f'{source}-clone1'
+        clone = self.add_instance(name, "Stopped", original.image, original.cpus, original.memory, original.disk)
+        return self._result(args, stdout=f'Cloned from {source} to {clone.name}.\n')
+
+    def _lifecycle(self, args, input):
+        names = self._names(args)
+        error = self._missing(args, names)
+        if error:
+            return error
+        for name in names:
+            self.instances[name].state = _TARGET_STATES[args[0]]
+        return self._result(args)
+
+    _start = _stop = _suspend = _restart = _lifecycle
+
+    def _delete(self, args, input):
+        names = self._names(args)
+        error = self._missing(args, names)
+        if error:
+            return error
+        for name in names:
+            instance = self.instances.pop(name)
+            if "--purge" not in args and "-p" not in args:
+                instance.state = "Deleted"
+                self.deleted[name] = instance
+        return self._result(args)
+
+    def _recover(self, args, input):
+        names = list(self.deleted) if "--all" in args else self._names(args)
+        error = self._missing(args, names, self.deleted)
+        if error:
+            return error
+        for name in names:
+            self.instances[name] = self.deleted.pop(name)
+            self.instances[name].state = "Stopped"
+        return self._result(args)
+
+    def _purge(self, args, input):
+        self.deleted.clear()
+        return self._result(args)
+
+    def _exec(self, args, input):
+        name = args[1]
+        with self._lock:
+            error = self._missing(args, [name])
+            if error:
+                return error
+            if self.instances[name].state != "Running":
+                return self._result(args, 2, stderr=f'instance "{name}" is not running\n')
+        argv = args[args.index("--") + 1:] if "--" in args else args[2:]
+        if self.exec_handler is None:
+            return self._result(args)
+        reply = self.exec_handler(name, argv, input)
+        if isinstance(reply, subprocess.CompletedProcess):
+            return reply
+        return self._result(args, *reply)
+
+    def _transfer(self, args, input):
+        paths = [arg for arg in args[1:] if not arg.startswith("-")]
+        names = [path.split(":", 1)[0] for path in paths if ":" in path]
+        error = self._missing(args, names)
+        if error:
+            return error
+        self.transfers.append((paths[:-1], paths[-1]))
+        return self._result(args)
+
+    def _mount(self, args, input):
+        source, target = [arg for arg in args[1:] if not arg.startswith("-")][:2]
+        name, _, path = target.partition(":")
+        error = self._missing(args, [name])
+        if error:
+            return error
+        self.instances[name].mounts[path] = source
+        return self._result(args)
+
+    def _unmount(self, args, input):
+        targets = [arg for arg in args[1:] if not arg.startswith("-")]
+        names = [target.partition(":")[0] for target in targets]
+        error = self._missing(args, names)
+        if error:
+            return error
+        for target in targets:
+            name, _, path = target.partition(":")
+            mounts = self.instances[name].mounts
+            if path:
+                mounts.pop(path, None)
+            else:
+                mounts.clear()
+        return self._result(args)
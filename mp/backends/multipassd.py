@@ -0,0 +1,185 @@
+##
+## Multipass Library - 2024
+## mp [Ubuntu:22.04]
+## File description:
+## multipass backend library for the multipassd gRPC socket
+## @julesreyn
+##
+
+from mp.backends.base import Backend, BackendError
+from mp.backends.cli import CliBackend
+from pathlib import Path
+import subprocess
+import importlib
+import logging
+import json
+
+try:
+    import grpc
+except ImportError:
+    grpc = None
+
+log = logging.getLogger(__name__)
+
+DEFAULT_ADDRESS = "unix:/var/snap/multipass/common/multipass_socket"
+DEFAULT_CLIENT_CERT_DIR = Path.home() / "snap" / "multipass" / "current" / "data" / "multipass-client-certificate"
+DEFAULT_SERVER_CERT = Path("/var/snap/multipass/common/data/multipassd/certificates/localhost.pem")
+
+STUBS_HELP = ("generate them from src/rpc/multipass.proto of your multipass version with "
+              "`python -m grpc_tools.protoc -I <dir> --python_out=. --grpc_python_out=. multipass.proto`")
+
+
+class GrpcBackend(Backend):
+    """
+    Experimental backend talking to the multipassd gRPC socket directly, without spawning a client process.
+    The RPC mapping follows multipass.proto but has not been checked against every daemon version,
+    it is never selected by default and is not exported by mp.backends.
+
+    list, info, start and stop are sent as RPCs, the other sub-commands and the streamed
+    commands of popen go to the fallback backend (the multipass CLI by default). The Python stubs of multipass.proto are not shipped
+    with multipass, they must be generated for the installed version and importable.
+    The client certificate must be one the daemon trusts, e.g. the one of the multipass CLI.
+
+    Args:
+        address (str): The gRPC address of the daemon, default is the snap socket.
+        stubs (str): The module generated from multipass.proto, default is "multipass_pb2"
+            (the service module is the same name with a "_grpc" suffix).
+        client_cert (str): The PEM client certificate, default is the one of the multipass CLI.
+        client_key (str): The PEM client key, default is the one of the multipass CLI.
+        server_cert (str): The PEM certificate of the daemon, default is the snap one.
+        timeout (float): The deadline of the RPCs without a timeout in seconds, default is 60.
+        fallback (Backend): The backend of the other sub-commands, default is CliBackend().
+
+    Raises:
+        BackendError: If grpcio or the stubs are not installed, or a certificate cannot be read.
+
+    Example:
+        >>> from mp.backends.multipassd import GrpcBackend
+        >>> set_backend(GrpcBackend())
+        >>> get_running_instances()
+        ['instance1', 'instance2']
+    """
+
+    name = "grpc"
+    NATIVE = ("list", "info", "start", "stop")
+
+    def __init__(self, address=DEFAULT_ADDRESS, stubs="multipass_pb2", client_cert=None, client_key=None,
+                 server_cert=DEFAULT_SERVER_CERT, timeout=60.0, fallback=None):
+        if grpc is None:
+            raise BackendError("the gRPC backend needs the grpcio package: pip install grpcio")
+        try:
+            self.pb2 = importlib.import_module(stubs)
+            self.pb2_grpc = importlib.import_module(f'{stubs}_grpc')
+        except ImportError as error:
+            raise BackendError(f'the gRPC backend needs the Python stubs {stubs} and {stubs}_grpc, {STUBS_HELP}') from error
+        try:
+            credentials = grpc.ssl_channel_credentials(
+                root_certificates=Path(server_cert).read_bytes() if server_cert else None,
+                private_key=Path(client_key or DEFAULT_CLIENT_CERT_DIR / "multipass_cert_key.pem").read_bytes(),
+                certificate_chain=Path(client_cert or DEFAULT_CLIENT_CERT_DIR / "multipass_cert.pem").read_bytes(),
+            )
+        except OSError as error:
+            raise BackendError(f'cannot read the multipass certificates: {error}') from error
+        self.address = address
+        self.timeout = timeout
+        self.fallback = fallback or CliBackend()
+        self.streaming = self.fallback.streaming
+        self.channel = grpc.secure_channel(address, credentials, options=[("grpc.ssl_target_name_override", "localhost")])
+        self.stub = self.pb2_grpc.RpcStub(self.channel)
+        log.warning('The gRPC backend is experimental, check its answers against the multipass CLI of your version')
+
+    def _native(self, command, names, options):
+        if command not in self.NATIVE:
+            return False
+        json_format = options == ["--format", "json"] or options == ["--format", "json", "--all"]
+        if command == "list":
+            return json_format and not names
+        if command == "info":
+            return json_format and (bool(names) != ("--all" in options))
+        if command in ("start", "stop"):
+            return not options and bool(names)
+        return False
+
+    def _split(self, args):
+        command = args[0] if args else ""
+        options = [arg for index, arg in enumerate(args[1:], 1) if arg.startswith("-") or args[index - 1] == "--format"]
+        names = [arg for arg in args[1:] if arg not in options]
+        return command, names, options
+
+    def run(self, args, input=None, timeout=None):
+        args = list(args)
+        command, names, options = self._split(args)
+        if not self._native(command, names, options):
+            return self.fallback.run(args, input, timeout)
+        try:
+            stdout = getattr(self, f'_{command}')(names, timeout or self.timeout)
+        except grpc.RpcError as error:
+            if error.code() == grpc.StatusCode.DEADLINE_EXCEEDED:
+                raise subprocess.TimeoutExpired(["multipass"] + args, timeout or self.timeout) from None
+            return subprocess.CompletedProcess(["multipass"] + args, 1, "", f'{error.details()}\n')
+        return subprocess.CompletedProcess(["multipass"] + args, 0, stdout, "")
+
+    def popen(self, args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=False):
+        # exec streams, the only popen commands, are not RPCs of this backend
+        return self.fallback.popen(args, stdin=stdin, stdout=stdout, stderr=stderr, text=text)
+
+    async def run_async(self, args, input=None, timeout=None):
+        if not self._native(*self._split(list(args))):
+            return await self.fallback.run_async(args, input, timeout)
+        return await super().run_async(args, input, timeout)
+
+    def _call(self, method, request, timeout):
+        # every multipassd RPC is a bidirectional stream, the request is sent alone and the replies collected
+        return list(getattr(self.stub, method)(iter([request]), timeout=timeout))
+
+    def _state(self, status):
+        return self.pb2.InstanceStatus.Status.Name(status.status).replace("_", " ").title()
+
+    def _instance_names(self, names):
+        return self.pb2.InstanceNames(instance_name=names)
+
+    def _list(self, names, timeout):
+        instances = []
+        for reply in self._call("list", self.pb2.ListRequest(request_ipv4=True), timeout):
+            contents = reply.instance_list if "instance_list" in reply.DESCRIPTOR.fields_by_name else reply
+            instances += [{"name": instance.name, "state": self._state(instance.instance_status),
+                           "ipv4": list(instance.ipv4), "release": instance.current_release}
+                          for instance in getattr(contents, "instances", ())]
+        return json.dumps({"list": instances})
+
+    def _info(self, names, timeout):
+        fields = self.pb2.InfoRequest.DESCRIPTOR.fields_by_name
+        if "instance_snapshot_pairs" in fields:
+            request = self.pb2.InfoRequest(instance_snapshot_pairs=[self.pb2.InstanceSnapshotPair(instance_name=name) for name in names])
+        else:
+            request = self.pb2.InfoRequest(instance_names=self._instance_names(names))
+        info = {}
+        for reply in self._call("info", request, timeout):
+            for item in getattr(reply, "details", getattr(reply, "info", ())):
+                details = item.instance_info if "instance_info" in item.DESCRIPTOR.fields_by_name else item
+                mounts = getattr(getattr(item, "mount_info", None), "mount_paths", ())
+                info[item.name] = {
+                    "state": self._state(item.instance_status),
+                    "ipv4": list(details.ipv4),
+                    "image_release": details.image_release,
+                    "image_hash": details.id,
+                    "release": details.current_release,
+                    "load": [float(value) for value in details.load.split()],
+                    "cpu_count": item.cpu_count,
+                    "memory": {"total": item.memory_total, "used": details.memory_usage},
+                    "disks": {"sda1": {"total": item.disk_total, "used": details.disk_usage}},
+                    "mounts": {mount.target_path: {"source_path": mount.source_path} for mount in mounts},
+                }
+        return json.dumps({"errors": [], "info": info})
+
+    def _start(self, names, timeout):
+        self._call("start", self.pb2.StartRequest(instance_names=self._instance_names(names)), timeout)
+        return ""
+
+    def _stop(self, names, timeout):
+        self._call("stop", self.pb2.StopRequest(instance_names=self._instance_names(names)), timeout)
+        return ""
+
+    def close(self):
+        self.channel.close()
+        self.fallback.close()
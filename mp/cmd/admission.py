@@ -0,0 +1,337 @@
+##
+## Multipass Library - 2024
+## mp [Ubuntu:22.04]
+## File description:
+## multipass instance library for host capacity admission control
+## @julesreyn
+##
+
+from mp.cmd.instance_info import fetch_snapshots
+from mp.utils import parse_size
+from contextlib import contextmanager, asynccontextmanager
+from dataclasses import dataclass
+import threading
+import logging
+import asyncio
+import shutil
+import time
+import os
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+log = logging.getLogger(__name__)
+
+DEFAULT_INSTANCE_DISK = "5G" # multipass default disk size
+ACTIVE_STATES = ("Running", "Starting", "Restarting", "Delayed Shutdown", "Suspending")
+
+
+@dataclass(slots=True)
+class Capacity:
+    """
+    Amount of vCPUs, memory and disk.
+
+    Attributes:
+        cpus (float): The number of vCPUs.
+        memory (int): The memory in bytes.
+        disk (int): The disk in bytes.
+    """
+    cpus: float = 0
+    memory: int = 0
+    disk: int = 0
+
+    def __add__(self, other):
+        return Capacity(self.cpus + other.cpus, self.memory + other.memory, self.disk + other.disk)
+
+    def __sub__(self, other):
+        return Capacity(self.cpus - other.cpus, self.memory - other.memory, self.disk - other.disk)
+
+    def fits(self, other):
+        """
+        Check if another capacity fits in this one.
+
+        Args:
+            other (Capacity): The requested capacity.
+
+        Returns:
+            bool: True if every resource of other is lower or equal to this one.
+        """
+        return other.cpus <= self.cpus and other.memory <= self.memory and other.disk <= self.disk
+
+
+def host_capacity(disk_path="/"):
+    """
+    Get the physical capacity of the host, with psutil when it is installed.
+
+    Args:
+        disk_path (str): The filesystem holding the multipass images, default is "/".
+
+    Returns:
+        Capacity: The number of logical CPUs, the total memory and the disk size of the host.
+    """
+    if psutil is not None:
+        return Capacity(psutil.cpu_count(logical=True), psutil.virtual_memory().total, psutil.disk_usage(disk_path).total)
+    return Capacity(os.cpu_count(), os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES"), shutil.disk_usage(disk_path).total)
+
+
+class AdmissionController:
+    """
+    Admit launches only when the host can fit the new instance.
+
+    Allocations are read from a single `multipass info` call: vCPUs and memory of the active
+    instances, and the disk of every instance. They are compared with the host capacity
+    multiplied by the overcommit ratios. Launches that do not fit are queued until enough
+    resources are released, or rejected once queue_timeout expires. When multipass cannot
+    be queried the allocations are unknown, and launches are queued or rejected the same way.
+    A released reservation is kept until a listing started after its release accounts for the
+    instance, so a launch is never missed by both its reservation and an older listing.
+
+    Args:
+        cpu_ratio (float): The vCPU overcommit ratio, default is 4.
+        memory_ratio (float): The memory overcommit ratio, default is 1.
+        disk_ratio (float): The disk overcommit ratio, default is 1.
+        disk_path (str): The filesystem holding the multipass images, default is "/".
+        queue_timeout (float): How long a launch waits for resources in seconds, 0 to reject immediately, None to wait forever.
+        poll_interval (float): The delay between two allocation checks of a queued launch in seconds, default is 5.
+
+    Example:
+        >>> controller = AdmissionController(cpu_ratio=2, memory_ratio=1.2, queue_timeout=60)
+        >>> controller.headroom()
+        Capacity(cpus=14, memory=20401094656, disk=193273528320)
+    """
+
+    def __init__(self, cpu_ratio=4.0, memory_ratio=1.0, disk_ratio=1.0, disk_path="/", queue_timeout=0, poll_interval=5.0):
+        self.cpu_ratio = cpu_ratio
+        self.memory_ratio = memory_ratio
+        self.disk_ratio = disk_ratio
+        self.disk_path = disk_path
+        self.queue_timeout = queue_timeout
+        self.poll_interval = poll_interval
+        self._reserved = {}
+        self._released = {}
+        self._condition = threading.Condition()
+
+    def capacity(self):
+        """
+        Get the capacity usable by instances, the host capacity multiplied by the overcommit ratios.
+
+        Returns:
+            Capacity: The usable capacity.
+        """
+        host = host_capacity(self.disk_path)
+        return Capacity(host.cpus * self.cpu_ratio, int(host.memory * self.memory_ratio), int(host.disk * self.disk_ratio))
+
+    def _instance_allocations(self):
+        # queries multipass, never called with the condition held, returns the allocations and the start time of the listing
+        listed_at = time.monotonic()
+        snapshots = fetch_snapshots()
+        if snapshots is None:
+            return None, listed_at
+        allocations = {}
+        for name, snapshot in snapshots.items():
+            disk = snapshot.disk_total if snapshot.disk_total is not None else parse_size(DEFAULT_INSTANCE_DISK)
+            allocations[name] = Capacity(0, 0, disk)
+            if snapshot.state in ACTIVE_STATES:
+                allocations[name] += Capacity(snapshot.cpus or 0, snapshot.memory_total or 0, 0)
+        return allocations, listed_at
+
+    def _total(self, allocations, listed_at):
+        # must be called with the condition held, an instance still reserved is counted once, by its reservation.
+        # A released reservation is dropped once a listing started after the release, which holds the launched instance.
+        for name, released_at in list(self._released.items()):
+            if released_at < listed_at:
+                del self._released[name]
+                self._reserved.pop(name, None)
+        allocated = Capacity()
+        for name, allocation in allocations.items():
+            if name not in self._reserved:
+                allocated += allocation
+        for reservation in self._reserved.values():
+            allocated += reservation
+        return allocated
+
+    def allocated(self):
+        """
+        Get the resources allocated to the existing instances and to the launches in progress.
+
+        Returns:
+            Capacity: The allocated capacity, None if multipass could not be queried.
+        """
+        allocations, listed_at = self._instance_allocations()
+        if allocations is None:
+            return None
+        with self._condition:
+            return self._total(allocations, listed_at)
+
+    def headroom(self):
+        """
+        Get the resources still available for new instances, negative when the host is overcommitted.
+
+        Returns:
+            Capacity: The available capacity, None if multipass could not be queried.
+        """
+        allocated = self.allocated()
+        return None if allocated is None else self.capacity() - allocated
+
+    def reserve(self, name, cpus, memory, disk=DEFAULT_INSTANCE_DISK):
+        """
+        Reserve the resources of a new instance, waiting up to queue_timeout for them.
+
+        Args:
+            name (str): The name of the instance.
+            cpus (str | int): The number of vCPUs of the instance.
+            memory (str | int): The memory of the instance, e.g. "2G".
+            disk (str | int): The disk of the instance, default is "5G".
+
+        Returns:
+            bool: True if the resources are reserved, False if the launch is rejected.
+        """
+        request = Capacity(float(cpus), parse_size(memory), parse_size(disk))
+        deadline = None if self.queue_timeout is None else time.monotonic() + self.queue_timeout
+        while True:
+            capacity, (allocations, listed_at) = self.capacity(), self._instance_allocations()
+            with self._condition:
+                headroom = None if allocations is None else capacity - self._total(allocations, listed_at)
+                if headroom is not None and headroom.fits(request):
+                    self._reserved[name] = request
+                    self._released.pop(name, None)
+                    log.info(f'Admitted instance {name}, headroom after launch: {headroom - request}')
+                    return True
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    log.warning(f'Rejected instance {name}: requested {request}, headroom {headroom or "unknown"}')
+                    return False
+                log.info(f'Queueing instance {name}: requested {request}, headroom {headroom or "unknown"}')
+                self._condition.wait(self.poll_interval if remaining is None else min(self.poll_interval, remaining))
+
+    def release(self, name):
+        """
+        Release the reservation of an instance once it is launched or failed.
+        The reservation still counts until a listing started after the release, so that the
+        launched instance is counted either by its reservation or by the listing.
+
+        Args:
+            name (str): The name of the instance.
+        """
+        with self._condition:
+            if name in self._reserved:
+                self._released[name] = time.monotonic()
+            self._condition.notify_all()
+
+
+_controller = None
+
+
+def enable_admission_control(cpu_ratio=4.0, memory_ratio=1.0, disk_ratio=1.0, disk_path="/", queue_timeout=0, poll_interval=5.0):
+    """
+    Check the host capacity before every launch_instance and init_instance.
+
+    Args:
+        cpu_ratio (float): The vCPU overcommit ratio, default is 4.
+        memory_ratio (float): The memory overcommit ratio, default is 1.
+        disk_ratio (float): The disk overcommit ratio, default is 1.
+        disk_path (str): The filesystem holding the multipass images, default is "/".
+        queue_timeout (float): How long a launch waits for resources in seconds, 0 to reject immediately, None to wait forever.
+        poll_interval (float): The delay between two allocation checks of a queued launch in seconds, default is 5.
+
+    Returns:
+        AdmissionController: The controller used by the launches.
+
+    Example:
+        >>> enable_admission_control(cpu_ratio=2, queue_timeout=300)
+    """
+    global _controller
+    _controller = AdmissionController(cpu_ratio, memory_ratio, disk_ratio, disk_path, queue_timeout, poll_interval)
+    return _controller
+
+
+def disable_admission_control():
+    """Launch instances without checking the host capacity."""
+    global _controller
+    _controller = None
+
+
+def get_headroom():
+    """
+    Get the resources still available for new instances.
+
+    Returns:
+        Capacity: The available capacity, None if admission control is disabled or multipass could not be queried.
+
+    Example:
+        >>> get_headroom()
+        Capacity(cpus=14, memory=20401094656, disk=193273528320)
+    """
+    return _controller.headroom() if _controller is not None else None
+
+
+@contextmanager
+def admission(name, cpus, memory, disk=DEFAULT_INSTANCE_DISK):
+    """
+    Hold a reservation for the duration of a launch.
+
+    Args:
+        name (str): The name of the instance.
+        cpus (str | int): The number of vCPUs of the instance.
+        memory (str | int): The memory of the instance.
+        disk (str | int): The disk of the instance, default is "5G".
+
+    Yields:
+        bool: True if the launch is admitted, always True when admission control is disabled.
+
+    Example:
+        >>> with admission("instance_name", "1", "2G") as admitted:
+        ...     if admitted:
+        ...         launch()
+    """
+    controller = _controller
+    if controller is None:
+        yield True
+        return
+    admitted = controller.reserve(name, cpus, memory, disk)
+    try:
+        yield admitted
+    finally:
+        if admitted:
+            controller.release(name)
+
+
+
+@asynccontextmanager
+async def async_admission(name, cpus, memory, disk=DEFAULT_INSTANCE_DISK):
+    """
+    Hold a reservation for the duration of a launch of mp.aio.
+    The reservation is waited for in a worker thread, so a queued launch does not block the event loop.
+
+    Args:
+        name (str): The name of the instance.
+        cpus (str | int): The number of vCPUs of the instance.
+        memory (str | int): The memory of the instance.
+        disk (str | int): The disk of the instance, default is "5G".
+
+    Yields:
+        bool: True if the launch is admitted, always True when admission control is disabled.
+
+    Example:
+        >>> async with async_admission("instance_name", "1", "2G") as admitted:
+        ...     if admitted:
+        ...         await launch()
+    """
+    controller = _controller
+    if controller is None:
+        yield True
+        return
+    reservation = asyncio.ensure_future(asyncio.to_thread(controller.reserve, name, cpus, memory, disk))
+    try:
+        admitted = await asyncio.shield(reservation)
+    except asyncio.CancelledError:
+        # the worker thread cannot be interrupted, a reservation it still makes is released at once
+        reservation.add_done_callback(lambda done: done.cancelled() or done.exception() or not done.result() or controller.release(name))
+        raise
+    try:
+        yield admitted
+    finally:
+        if admitted:
+            controller.release(name)
@@ -0,0 +1,358 @@
+##
+## Multipass Library - 2024
+## mp [Ubuntu:22.04]
+## File description:
+## multipass instance library for resumable chunked transfers of large files
+## @julesreyn
+##
+
+from mp.logger import logger
+from mp.cmd.runner import runner
+from mp.cmd.guest_channel import run_guest
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from pathlib import Path
+import subprocess
+import hashlib
+import logging
+import json
+import time
+import os
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 16 * 1024 ** 2 # bytes per exec, at most parallel * chunk_size bytes are held in memory
+DEFAULT_PARALLEL = 4 # chunks transferred at the same time
+TRANSFER_STATE_DIR = Path.home() / '.cache' / 'mp' / 'transfers' # progress of the interrupted transfers, removed once complete
+
+# Run by python3 on the instance. The paths are expanded like the shell would, "~/file" is in the home directory.
+HASH_FILE = r'''
+import hashlib, json, os, sys
+path, chunk_size = os.path.expanduser(sys.argv[1]), int(sys.argv[2])
+try:
+    stat = os.stat(path)
+    whole, chunks = hashlib.sha256(), []
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            whole.update(chunk)
+            chunks.append(hashlib.sha256(chunk).hexdigest())
+except FileNotFoundError:
+    json.dump(None, sys.stdout)
+    sys.exit(0)
+json.dump({"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "mode": stat.st_mode & 0o7777,
+           "sha256": whole.hexdigest(), "chunks": chunks}, sys.stdout)
+'''
+
+WRITE_CHUNK = r'''
+import hashlib, os, sys
+path, offset, expected = os.path.expanduser(sys.argv[1]), int(sys.argv[2]), sys.argv[3]
+data = sys.stdin.buffer.read()
+if hashlib.sha256(data).hexdigest() != expected:
+    sys.exit(f"chunk at offset {offset} is corrupted, {len(data)} bytes received")
+os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o600)
+try:
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view, offset = view[written:], offset + written
+    os.fsync(fd)
+finally:
+    os.close(fd)
+'''
+
+READ_CHUNK = r'''
+import os, sys
+path, offset, length = os.path.expanduser(sys.argv[1]), int(sys.argv[2]), int(sys.argv[3])
+with open(path, "rb") as file:
+    file.seek(offset)
+    sys.stdout.buffer.write(file.read(length))
+'''
+
+FINALIZE = r'''
+import hashlib, os, sys
+part, destination, size, expected, mode = os.path.expanduser(sys.argv[1]), os.path.expanduser(sys.argv[2]), int(sys.argv[3]), sys.argv[4], int(sys.argv[5], 8)
+os.makedirs(os.path.dirname(part) or ".", exist_ok=True)
+with open(part, "ab") as file:
+    file.truncate(size)
+sha = hashlib.sha256()
+with open(part, "rb") as file:
+    for chunk in iter(lambda: file.read(1 << 20), b""):
+        sha.update(chunk)
+if sha.hexdigest() != expected:
+    sys.exit(f"{destination} is corrupted, sha256 {sha.hexdigest()} instead of {expected}")
+os.chmod(part, mode)
+os.replace(part, destination)
+'''
+
+
+@dataclass(slots=True)
+class TransferProgress:
+    """
+    Progress of a chunked transfer, handed to the on_progress callback after each chunk.
+
+    Attributes:
+        path (str): The destination of the transfer.
+        done (int): The bytes transferred and verified so far, including the ones of a previous attempt.
+        total (int): The size of the file in bytes.
+        elapsed (float): The duration of this attempt in seconds.
+        bytes_per_second (float): The throughput of this attempt.
+    """
+    path: str
+    done: int
+    total: int
+    elapsed: float
+    bytes_per_second: float
+
+    @property
+    def percent(self):
+        return 100.0 * self.done / self.total if self.total else 100.0
+
+
+
+def _hash_chunks(path, chunk_size):
+    stat = os.stat(path)
+    whole, chunks = hashlib.sha256(), []
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            whole.update(chunk)
+            chunks.append(hashlib.sha256(chunk).hexdigest())
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "mode": stat.st_mode & 0o7777,
+            "sha256": whole.hexdigest(), "chunks": chunks}
+
+
+def _remote_hash(name, path, chunk_size, timeout=None):
+    result = run_guest(name, ["python3", "-c", HASH_FILE, path, str(chunk_size)], timeout=timeout)
+    if result.returncode != 0:
+        raise OSError(result.stderr.strip() or f"exit code {result.returncode}")
+    return json.loads(result.stdout)
+
+
+def _chunk_exec(name, argv, data=None, timeout=None):
+    # chunks are binary, they go through a binary popen of the backend rather than run and the text guest channels
+    process, call = runner.popen(["exec", name, "--"] + argv, name, stdin=subprocess.PIPE if data is not None else subprocess.DEVNULL)
+    try:
+        stdout, stderr = process.communicate(data, timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
+        runner.finish(call, timed_out=True)
+        return None, b"", f"timed out after {timeout}s"
+    runner.finish(call, process.returncode, len(stdout) + len(stderr))
+    return process.returncode, stdout, stderr.decode(errors="replace").strip()
+
+
+def _state_file(direction, name, source, destination):
+    key = hashlib.sha256(json.dumps([direction, name, source, destination]).encode()).hexdigest()[:24]
+    return TRANSFER_STATE_DIR / f'{key}.json'
+
+
+def _load_state(path, source):
+    # the state of a previous attempt is only reused if the source did not change since
+    try:
+        state = json.loads(path.read_text())
+    except (OSError, ValueError):
+        return None
+    same = all(state.get(key) == source[key] for key in ("size", "mtime_ns", "sha256", "chunks"))
+    return state if same else None
+
+
+def _save_state(path, state):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix('.tmp')
+    tmp.write_text(json.dumps(state))
+    tmp.replace(path)
+
+
+def _transfer_chunks(name, destination, state, state_path, pending, transfer, parallel, retries, on_progress):
+    # runs transfer(index) on `parallel` workers, records each verified chunk in the state file, returns the errors
+    size, chunk_size = state["size"], state["chunk_size"]
+    done = sum(min(chunk_size, size - index * chunk_size) for index in state["done"])
+    sent, start, errors = 0, time.monotonic(), []
+
+    def attempt(index):
+        for remaining in range(retries, -1, -1):
+            error = transfer(index)
+            if error is None or not remaining:
+                return error
+            log.warning(f'Chunk {index} of {destination} failed, {remaining} retries left: {error}')
+
+    with ThreadPoolExecutor(max_workers=parallel) as pool:
+        futures = {pool.submit(attempt, index): index for index in pending}
+        for future in as_completed(futures):
+            index = futures[future]
+            error = future.result()
+            if error is not None:
+                errors.append(f'chunk {index}: {error}')
+                continue
+            length = min(chunk_size, size - index * chunk_size)
+            done, sent = done + length, sent + length
+            state["done"].append(index)
+            _save_state(state_path, state)
+            elapsed = time.monotonic() - start
+            progress = TransferProgress(destination, done, size, elapsed, sent / elapsed if elapsed else 0.0)
+            log.info(f'{destination}: {progress.percent:.1f}% ({done}/{size} bytes, {progress.bytes_per_second / 1024 ** 2:.1f} MiB/s)')
+            if on_progress is not None:
+                on_progress(progress)
+    return errors
+
+
+
+def put_large_file(name, source, destination, chunk_size=DEFAULT_CHUNK_SIZE, parallel=DEFAULT_PARALLEL, retries=2,
+                   timeout=None, on_progress=None):
+    """
+    Transfer a large file to a specified instance in chunks sent in parallel, each one through its own `multipass exec`.
+
+    Every chunk is checked against its sha256 before it is written, and the whole file once all chunks are there.
+    The file is assembled in `destination.part` and renamed when complete. The verified chunks are recorded in
+    TRANSFER_STATE_DIR: after an interruption, calling it again with the same arguments only sends the missing chunks.
+    python3 must be installed on the instance.
+
+    Args:
+        name (str): The name of the instance.
+        source (str): The path to the file to transfer, "~" is expanded to the home directory.
+        destination (str): The destination path on the instance.
+        chunk_size (int): The size of the chunks in bytes, default is 16 MiB.
+        parallel (int): The number of chunks sent at the same time, default is 4.
+        retries (int): The number of times a failed chunk is sent again, default is 2.
+        timeout (float): The deadline of each chunk in seconds, no deadline if None.
+        on_progress (callable): Called with a TransferProgress after each chunk.
+
+    Returns:
+        bool: True if the file was transferred and verified, False otherwise.
+
+    Example:
+        >>> put_large_file("instance_name", "dataset.tar", "/home/ubuntu/dataset.tar", on_progress=lambda progress: print(f'{progress.percent:.0f}%'))
+        25%
+        50%
+        75%
+        100%
+        True
+    """
+    log.info(f'Transferring large file to instance {name}: {source} -> {destination}')
+    source = os.path.expanduser(source)
+    if not os.path.isfile(source):
+        logger(instance=name, error=f"warning: source file {source} does not exist.", status="warning")
+        return False
+    manifest = _hash_chunks(source, chunk_size)
+    state_path = _state_file("put", name, os.path.abspath(source), destination)
+    state = _load_state(state_path, manifest)
+    part = f'{destination}.part'
+    if state is not None and state["done"]:
+        try:
+            remote = _remote_hash(name, part, chunk_size, timeout) or {"chunks": []}
+        except (OSError, ValueError, subprocess.TimeoutExpired) as error:
+            log.warning(f'Could not check the chunks already sent to {part}: {error}')
+            remote = {"chunks": []}
+        state["done"] = [index for index in state["done"] if index < len(remote["chunks"]) and remote["chunks"][index] == manifest["chunks"][index]]
+        log.info(f'Resuming the transfer of {source}: {len(state["done"])}/{len(manifest["chunks"])} chunks already on the instance')
+    if state is None:
+        state = dict(manifest, chunk_size=chunk_size, done=[])
+    _save_state(state_path, state)
+
+    def send(index):
+        with open(source, "rb") as file:
+            file.seek(index * chunk_size)
+            data = file.read(chunk_size)
+        if hashlib.sha256(data).hexdigest() != manifest["chunks"][index]:
+            return f'{source} changed during the transfer'
+        code, _, error = _chunk_exec(name, ["python3", "-c", WRITE_CHUNK, part, str(index * chunk_size), manifest["chunks"][index]], data, timeout)
+        return None if code == 0 else error or f"exit code {code}"
+
+    pending = [index for index in range(len(manifest["chunks"])) if index not in state["done"]]
+    errors = _transfer_chunks(name, destination, state, state_path, pending, send, parallel, retries, on_progress)
+    if errors:
+        logger(instance=name, error=f'{len(errors)} chunks of {source} not transferred, call put_large_file again to resume: {"; ".join(errors[:5])}')
+        return False
+    try:
+        result = run_guest(name, ["python3", "-c", FINALIZE, part, destination, str(manifest["size"]), manifest["sha256"], oct(manifest["mode"])], timeout=timeout)
+    except subprocess.TimeoutExpired:
+        logger(instance=name, error=f'Timed out verifying {destination}')
+        return False
+    if result.returncode != 0:
+        logger(instance=name, error=result.stderr.strip())
+        return False
+    state_path.unlink(missing_ok=True)
+    log.info(f'Large file transferred to instance {name}: {source} -> {destination}')
+    return True
+
+
+
+def get_large_file(name, source, destination, chunk_size=DEFAULT_CHUNK_SIZE, parallel=DEFAULT_PARALLEL, retries=2,
+                   timeout=None, on_progress=None):
+    """
+    Transfer a large file from a specified instance in chunks received in parallel, each one through its own `multipass exec`.
+
+    The instance hashes the file once, then every chunk is checked against its sha256 before it is written,
+    and the whole file once all chunks are there. The file is assembled in `destination.part` and renamed when
+    complete. After an interruption, calling it again with the same arguments only fetches the missing chunks,
+    as long as the file did not change on the instance. python3 must be installed on the instance.
+
+    Args:
+        name (str): The name of the instance.
+        source (str): The path to the file on the instance.
+        destination (str): The destination path on the host.
+        chunk_size (int): The size of the chunks in bytes, default is 16 MiB.
+        parallel (int): The number of chunks received at the same time, default is 4.
+        retries (int): The number of times a failed chunk is fetched again, default is 2.
+        timeout (float): The deadline of each chunk in seconds, no deadline if None.
+        on_progress (callable): Called with a TransferProgress after each chunk.
+
+    Returns:
+        bool: True if the file was transferred and verified, False otherwise.
+
+    Example:
+        >>> get_large_file("instance_name", "/var/backups/db.dump", "db.dump", parallel=8)
+        True
+    """
+    log.info(f'Transferring large file from instance {name}: {source} -> {destination}')
+    try:
+        manifest = _remote_hash(name, source, chunk_size, timeout)
+    except (OSError, ValueError, subprocess.TimeoutExpired) as error:
+        logger(instance=name, error=f'Could not read {source}: {error}')
+        return False
+    if manifest is None:
+        logger(instance=name, error=f"warning: source file {source} does not exist.", status="warning")
+        return False
+    state_path = _state_file("get", name, source, os.path.abspath(destination))
+    state = _load_state(state_path, manifest)
+    part = f'{destination}.part'
+    if state is not None and state["done"]:
+        local = _hash_chunks(part, chunk_size) if os.path.exists(part) else {"chunks": []}
+        state["done"] = [index for index in state["done"] if index < len(local["chunks"]) and local["chunks"][index] == manifest["chunks"][index]]
+        log.info(f'Resuming the transfer of {source}: {len(state["done"])}/{len(manifest["chunks"])} chunks already on the host')
+    if state is None:
+        state = dict(manifest, chunk_size=chunk_size, done=[])
+    _save_state(state_path, state)
+    os.makedirs(os.path.dirname(os.path.abspath(part)), exist_ok=True)
+    fd = os.open(part, os.O_WRONLY | os.O_CREAT, 0o600)
+
+    def fetch(index):
+        length = min(chunk_size, manifest["size"] - index * chunk_size)
+        code, data, error = _chunk_exec(name, ["python3", "-c", READ_CHUNK, source, str(index * chunk_size), str(length)], timeout=timeout)
+        if code != 0:
+            return error or f"exit code {code}"
+        if hashlib.sha256(data).hexdigest() != manifest["chunks"][index]:
+            return f'corrupted, {len(data)} bytes received'
+        os.pwrite(fd, data, index * chunk_size)
+        return None
+
+    try:
+        pending = [index for index in range(len(manifest["chunks"])) if index not in state["done"]]
+        errors = _transfer_chunks(name, destination, state, state_path, pending, fetch, parallel, retries, on_progress)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    if errors:
+        logger(instance=name, error=f'{len(errors)} chunks of {source} not transferred, call get_large_file again to resume: {"; ".join(errors[:5])}')
+        return False
+    os.truncate(part, manifest["size"])
+    received = _hash_chunks(part, chunk_size)["sha256"]
+    if received != manifest["sha256"]:
+        logger(instance=name, error=f'{destination} is corrupted, sha256 {received} instead of {manifest["sha256"]}')
+        return False
+    os.chmod(part, manifest["mode"])
+    os.replace(part, destination)
+    state_path.unlink(missing_ok=True)
+    log.info(f'Large file transferred from instance {name}: {source} -> {destination}')
+    return True
@@ -7,12 +7,23 @@
 ##
 
 from mp.logger import logger
+from mp.cmd.runner import run_multipass, runner
+from mp.cmd.guest_channel import run_guest
+from dataclasses import dataclass
+from pathlib import Path, PurePosixPath
 import subprocess
+import threading
+import tarfile
+import fnmatch
 import os
 import logging
 
 log = logging.getLogger(__name__)
 
+# Run by sh on the instance when tar failed: prints "<path>\0<size>:<mtime>\0" for each of the NUL-separated
+# paths read on stdin that is a regular file under $1, so that names are never parsed from the tar output.
+CHECK_FILES = r'''cd "$1" && xargs -0 -r sh -c 'for f; do [ -f "$f" ] && printf "%s\0%s\0" "$f" "$(stat -c %s:%Y -- "$f")"; done' sh'''
+
 
 def put_file(name, source, destination):
     """
@@ -20,7 +31,7 @@ def put_file(name, source, destination):
 
     Args:
         name (str): The name of the instance.
-        source (str): The path to the file to transfer.
+        source (str): The path to the file to transfer, "~" is expanded to the home directory.
         destination (str): The destination path on the instance.
 
     Returns:
@@ -40,10 +51,11 @@ def put_file(name, source, destination):
         False
     """
     log.info(f'Transferring file to instance {name}: {source} -> {destination}')
+    source = os.path.expanduser(source)
     if not os.path.exists(source):
         logger(instance=name, error=f"warning: source file {source} does not exist.", status="warning")
         return False
-    result = subprocess.run(["multipass", "transfer", source, f"{name}:{destination}"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    result = run_multipass(["transfer", source, f"{name}:{destination}"])
     if result.returncode != 0:
         logger(instance=name, error=result.stderr)
     log.info(f'File transferred to instance {name}: {source} -> {destination}')
@@ -74,7 +86,7 @@ def get_file(name, source, destination):
         False
     """
     log.info(f'Transferring file from instance {name}: {source} -> {destination}')
-    result = subprocess.run(["multipass", "transfer", f"{name}:{source}", destination], capture_output=True, text=True)
+    result = run_multipass(["transfer", f"{name}:{source}", destination])
     if result.returncode != 0:
         logger(instance=name, error=result.stderr)
     log.info(f'File transferred from instance {name}: {source} -> {destination}')
@@ -102,7 +114,7 @@ def mount(name, source, destination):
         False
     """
     log.info(f'Mounting directory to instance {name}: {source} -> {destination}')
-    result = subprocess.run(["multipass", "mount", source, f"{name}:{destination}"], capture_output=True, text=True)
+    result = run_multipass(["mount", source, f"{name}:{destination}"])
     if result.returncode != 0:
         logger(instance=name, error=result.stderr)
     log.info(f'Directory mounted to instance {name}: {source} -> {destination}')
@@ -125,8 +137,218 @@ def unmount(name):
         True
     """
     log.info(f'Unmounting directory from instance {name}')
-    result = subprocess.run(["multipass", "unmount", name], capture_output=True, text=True)
+    result = run_multipass(["unmount", name])
     if result.returncode != 0:
         logger(instance=name, error=result.stderr)
     log.info(f'Directory unmounted from instance {name}')
-    return result.returncode == 0
\ No newline at end of file
+    return result.returncode == 0
+
+
+@dataclass(slots=True)
+class FileTransfer:
+    """
+    Outcome of the transfer of one file of a tree.
+
+    Attributes:
+        path (str): The path of the file relative to the transferred directory.
+        size (int): The size of the file in bytes.
+        ok (bool): True if the file was written at its destination.
+        error (str): The reason of the failure, None on success.
+    """
+    path: str
+    size: int = 0
+    ok: bool = False
+    error: str = None
+
+
+def _selected(path, include=None, exclude=None):
+    if exclude and any(fnmatch.fnmatch(path, pattern) for pattern in exclude):
+        return False
+    return not include or any(fnmatch.fnmatch(path, pattern) for pattern in include)
+
+
+def _walk(local_dir, include=None, exclude=None):
+    root = Path(local_dir)
+    for directory, directories, files in os.walk(root):
+        relative_dir = Path(directory).relative_to(root)
+        directories[:] = sorted(entry for entry in directories if _selected((relative_dir / entry).as_posix(), None, exclude))
+        for entry in sorted(files):
+            path = (relative_dir / entry).as_posix()
+            if _selected(path, include, exclude):
+                yield path, Path(directory) / entry
+
+
+def _drain(stream, chunks):
+    for chunk in iter(lambda: stream.read(65536), b""):
+        chunks.append(chunk)
+    stream.close()
+
+
+def _tar_exec(name, script, remote_dir, stdin=None, stdout=None, timeout=None):
+    # the remote directory is passed as $1, it is never interpolated in the script
+    args = ["exec", name, "--", "sh", "-c", script, "sh", remote_dir]
+    process, call = runner.popen(args, name, stdin=stdin or subprocess.DEVNULL, stdout=stdout or subprocess.PIPE)
+    timer = threading.Timer(timeout, process.kill) if timeout is not None else None
+    if timer is not None:
+        timer.daemon = True
+        timer.start()
+    return process, call, timer
+
+
+
+def put_tree(name, local_dir, remote_dir, include=None, exclude=None, timeout=None):
+    """
+    Transfer a directory tree to a specified instance as a single tar stream through one `multipass exec`.
+    File modes and modification times are kept, the files belong to the user running the command.
+
+    Args:
+        name (str): The name of the instance.
+        local_dir (str): The directory on the host.
+        remote_dir (str): The destination directory on the instance, created if needed. Relative paths start from the home directory.
+        include (list): Shell-style patterns matched against the relative paths, only matching files are sent. All files if None.
+        exclude (list): Shell-style patterns of the files and directories to leave out.
+        timeout (float): The deadline of the whole transfer in seconds, no deadline if None.
+
+    Returns:
+        list: The FileTransfer of each selected file, in the order they were sent.
+
+    Example:
+        >>> put_tree("instance_name", "./setup_tools", "/home/ubuntu", include=["config.sh", "update-motd.d/*"])
+        [FileTransfer(path='config.sh', size=2412, ok=True, error=None), FileTransfer(path='update-motd.d/00-header', ...)]
+    """
+    log.info(f'Transferring tree to instance {name}: {local_dir} -> {remote_dir}')
+    if not os.path.isdir(local_dir):
+        logger(instance=name, error=f"warning: source directory {local_dir} does not exist.", status="warning")
+        return []
+    return _send_files(name, list(_walk(local_dir, include, exclude)), remote_dir, timeout)
+
+
+def _send_files(name, files, remote_dir, timeout=None):
+    # files is a list of (relative posix path, local path), sent as one tar stream extracted under remote_dir
+    if not files:
+        return []
+    results = {path: FileTransfer(path) for path, _ in files}
+    stamps = {}
+    process, call, timer = _tar_exec(name, 'mkdir -p "$1" && exec tar -x -p --no-same-owner -C "$1" -f -', remote_dir,
+                                     stdin=subprocess.PIPE, timeout=timeout)
+    stdout, stderr = [], []
+    readers = [threading.Thread(target=_drain, args=(process.stdout, stdout), daemon=True),
+               threading.Thread(target=_drain, args=(process.stderr, stderr), daemon=True)]
+    for reader in readers:
+        reader.start()
+    sent = 0
+    try:
+        with tarfile.open(fileobj=process.stdin, mode="w|", format=tarfile.PAX_FORMAT) as archive:
+            for path, local_path in files:
+                try:
+                    info = archive.gettarinfo(local_path, arcname=path)
+                    with open(local_path, "rb") as file:
+                        archive.addfile(info, file)
+                except OSError as error:
+                    results[path].error = str(error)
+                    continue
+                results[path].size = info.size
+                stamps[path] = f'{info.size}:{int(info.mtime)}'
+                sent += info.size
+    except (BrokenPipeError, ValueError):
+        pass # tar exited early, the per-file results tell which files made it
+    finally:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        process.wait()
+        for reader in readers:
+            reader.join()
+        if timer is not None:
+            timer.cancel()
+    error = b"".join(stderr).decode(errors="replace").strip()
+    runner.finish(call, process.returncode, sent, timed_out=process.returncode == -9 and timer is not None)
+    # tar succeeded for every file it was sent, after a failure the files are checked on the instance
+    extracted = set(stamps) if process.returncode == 0 else _check_files(name, remote_dir, stamps, timeout)
+    for path, result in results.items():
+        result.ok = result.error is None and path in extracted
+        if not result.ok and result.error is None:
+            result.error = error or f"tar exited with code {process.returncode}"
+    failed = [result.path for result in results.values() if not result.ok]
+    if failed:
+        logger(instance=name, error=f"{len(failed)} of {len(results)} files not transferred to {remote_dir}: {', '.join(failed[:10])}\n{error}")
+    log.info(f'Tree transferred to instance {name}: {len(results) - len(failed)}/{len(results)} files, {sent} bytes')
+    return list(results.values())
+
+
+
+def _check_files(name, remote_dir, stamps, timeout=None):
+    # stamps maps the sent paths to "<size>:<mtime>", returns the ones found under remote_dir with the same stamp
+    if not stamps:
+        return set()
+    try:
+        result = run_guest(name, ["sh", "-c", CHECK_FILES, "sh", remote_dir], timeout=timeout, input="\0".join(stamps))
+    except subprocess.TimeoutExpired:
+        return set()
+    fields = result.stdout.split("\0")
+    found = dict(zip(fields[0::2], fields[1::2]))
+    return {path for path, stamp in stamps.items() if found.get(path) == stamp}
+
+
+
+def get_tree(name, remote_dir, local_dir, include=None, exclude=None, timeout=None):
+    """
+    Transfer a directory tree from a specified instance as a single tar stream through one `multipass exec`.
+    File modes and modification times are kept, unsafe members (absolute paths, links outside of local_dir) are refused.
+
+    Args:
+        name (str): The name of the instance.
+        remote_dir (str): The directory on the instance. Relative paths start from the home directory.
+        local_dir (str): The destination directory on the host, created if needed.
+        include (list): Shell-style patterns matched against the relative paths, only matching files are written. All files if None.
+        exclude (list): Shell-style patterns of the files and directories to leave out.
+        timeout (float): The deadline of the whole transfer in seconds, no deadline if None.
+
+    Returns:
+        list: The FileTransfer of each selected file, in the order they were received.
+
+    Example:
+        >>> get_tree("instance_name", "/var/log/nginx", "./logs/instance_name", include=["*.log"])
+        [FileTransfer(path='access.log', size=90412, ok=True, error=None), FileTransfer(path='error.log', ...)]
+    """
+    log.info(f'Transferring tree from instance {name}: {remote_dir} -> {local_dir}')
+    os.makedirs(local_dir, exist_ok=True)
+    process, call, timer = _tar_exec(name, 'cd "$1" && exec tar -c -f - .', remote_dir, timeout=timeout)
+    stderr = []
+    reader = threading.Thread(target=_drain, args=(process.stderr, stderr), daemon=True)
+    reader.start()
+    results = []
+    received = 0
+    try:
+        with tarfile.open(fileobj=process.stdout, mode="r|") as archive:
+            for member in archive:
+                path = PurePosixPath(member.name).as_posix().removeprefix("./")
+                if member.isdir() or path in ("", ".") or not _selected(path, include, exclude):
+                    continue
+                result = FileTransfer(path, member.size)
+                try:
+                    member.name = path
+                    archive.extract(member, local_dir, set_attrs=True, filter="data")
+                    result.ok = True
+                    received += member.size
+                except (OSError, tarfile.TarError) as error:
+                    result.error = str(error)
+                results.append(result)
+    except tarfile.TarError as error:
+        stderr.append(str(error).encode())
+    finally:
+        process.stdout.close()
+        process.wait()
+        reader.join()
+        if timer is not None:
+            timer.cancel()
+    error = b"".join(stderr).decode(errors="replace").strip()
+    runner.finish(call, process.returncode, received, timed_out=process.returncode == -9 and timer is not None)
+    if process.returncode != 0:
+        logger(instance=name, error=error or f"tar exited with code {process.returncode}")
+    failed = [result for result in results if not result.ok]
+    if failed:
+        logger(instance=name, error=f"{len(failed)} of {len(results)} files not transferred from {remote_dir}: {', '.join(result.path for result in failed[:10])}")
+    log.info(f'Tree transferred from instance {name}: {len(results) - len(failed)}/{len(results)} files, {received} bytes')
+    return results
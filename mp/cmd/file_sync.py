@@ -0,0 +1,206 @@
+##
+## Multipass Library - 2024
+## mp [Ubuntu:22.04]
+## File description:
+## multipass instance library for incremental directory synchronisation
+## @julesreyn
+##
+
+from mp.logger import logger
+from mp.cmd.guest_channel import run_guest
+from mp.cmd.file_operations import _walk, _selected, _send_files
+from dataclasses import dataclass, field
+from pathlib import Path
+import subprocess
+import threading
+import hashlib
+import logging
+import json
+import os
+
+log = logging.getLogger(__name__)
+
+SYNC_CACHE_DIR = Path.home() / '.cache' / 'mp' / 'sync' # manifests of the synchronised trees, one file per instance
+
+# Run by python3 on the instance: prints the {path: [size, mtime_ns, sha256]} manifest of the tree given as argv[1].
+# The manifest cached on the host is read on stdin, files whose size and mtime did not change are not hashed again.
+# mtimes are compared at microsecond precision: tar carries them as a float PAX header, which loses the last nanoseconds.
+REMOTE_MANIFEST = r'''
+import fnmatch, hashlib, json, os, sys
+request = json.load(sys.stdin)
+root, cache, exclude = sys.argv[1], request["cache"], request["exclude"]
+def excluded(path):
+    return any(fnmatch.fnmatch(path, pattern) for pattern in exclude)
+manifest = {}
+for directory, directories, files in os.walk(root):
+    relative = os.path.relpath(directory, root)
+    prefix = "" if relative == "." else relative + "/"
+    directories[:] = [entry for entry in directories if not excluded(prefix + entry)]
+    for entry in files:
+        path = prefix + entry
+        if excluded(path):
+            continue
+        try:
+            stat = os.stat(os.path.join(directory, entry))
+            known = cache.get(path)
+            if known and known[0] == stat.st_size and abs(known[1] - stat.st_mtime_ns) < 1000:
+                digest = known[2]
+            else:
+                sha = hashlib.sha256()
+                with open(os.path.join(directory, entry), "rb") as file:
+                    for chunk in iter(lambda: file.read(1 << 20), b""):
+                        sha.update(chunk)
+                digest = sha.hexdigest()
+        except OSError:
+            continue
+        manifest[path] = [stat.st_size, stat.st_mtime_ns, digest]
+json.dump(manifest, sys.stdout)
+'''
+
+_cache_lock = threading.Lock()
+
+
+@dataclass(slots=True)
+class SyncResult:
+    """
+    Outcome of a directory synchronisation.
+
+    Attributes:
+        transferred (list): The FileTransfer of each new or changed file.
+        deleted (list): The relative paths of the extraneous files removed from the instance.
+        unchanged (int): The number of files already up to date on the instance.
+        error (str): The reason the synchronisation could not be done, None otherwise.
+    """
+    transferred: list = field(default_factory=list)
+    deleted: list = field(default_factory=list)
+    unchanged: int = 0
+    error: str = None
+
+    @property
+    def ok(self):
+        """True if the instance holds the same files as the local directory."""
+        return self.error is None and all(transfer.ok for transfer in self.transferred)
+
+
+
+def _update_cache(name, update=None):
+    path = SYNC_CACHE_DIR / f'{name}.json'
+    with _cache_lock:
+        try:
+            cache = json.loads(path.read_text())
+        except (OSError, ValueError):
+            cache = {}
+        cache.setdefault("local", {})
+        cache.setdefault("remote", {})
+        if update is not None:
+            update(cache)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix('.tmp')
+            tmp.write_text(json.dumps(cache))
+            tmp.replace(path)
+        return cache
+
+
+def _hash_file(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _local_manifest(local_dir, include=None, exclude=None, cache=None):
+    cache = cache or {}
+    manifest, paths = {}, {}
+    for path, local_path in _walk(local_dir, include, exclude):
+        try:
+            stat = os.stat(local_path)
+            known = cache.get(path)
+            if known and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+                digest = known[2]
+            else:
+                digest = _hash_file(local_path)
+        except OSError as error:
+            log.warning(f'Skipping {local_path}: {error}')
+            continue
+        manifest[path] = [stat.st_size, stat.st_mtime_ns, digest]
+        paths[path] = local_path
+    return manifest, paths
+
+
+
+def sync_dir(name, local_dir, remote_dir, delete=False, include=None, exclude=None, timeout=None):
+    """
+    Make a directory of an instance match a local directory, transferring only the new and changed files.
+
+    The files are compared by sha256. The manifest of the instance is fetched with one exec, and the changed files
+    are sent with one put_tree-like tar stream. The manifests are cached in SYNC_CACHE_DIR so that unchanged files
+    are not hashed again, on either side, and an unchanged tree costs a single round-trip. Empty directories are not removed.
+
+    Args:
+        name (str): The name of the instance.
+        local_dir (str): The directory on the host.
+        remote_dir (str): The directory on the instance, created if needed. Relative paths start from the home directory.
+        delete (bool): Remove the files of remote_dir that are not in local_dir, default is False.
+        include (list): Shell-style patterns matched against the relative paths, only matching files are synchronised. All files if None.
+        exclude (list): Shell-style patterns of the files and directories to leave out, they are never deleted.
+        timeout (float): The deadline of each exec in seconds, no deadline if None.
+
+    Returns:
+        SyncResult: The transferred, deleted and unchanged files.
+
+    Example:
+        >>> sync_dir("instance_name", "./site", "/srv/site", delete=True, exclude=[".git", "*.pyc"])
+        SyncResult(transferred=[FileTransfer(path='index.html', size=5120, ok=True, error=None)], deleted=['old.html'], unchanged=214, error=None)
+
+        >>> sync_dir("instance_name", "./site", "/srv/site").unchanged
+        215
+    """
+    log.info(f'Synchronising {local_dir} to instance {name}:{remote_dir}')
+    if not os.path.isdir(local_dir):
+        logger(instance=name, error=f"warning: source directory {local_dir} does not exist.", status="warning")
+        return SyncResult(error=f'{local_dir} does not exist')
+    local_key = str(Path(local_dir).resolve())
+    cache = _update_cache(name)
+    local, paths = _local_manifest(local_dir, include, exclude, cache["local"].get(local_key))
+    request = json.dumps({"cache": cache["remote"].get(remote_dir, {}), "exclude": exclude or []})
+    try:
+        result = run_guest(name, ["python3", "-c", REMOTE_MANIFEST, remote_dir], timeout=timeout, input=request)
+        remote = json.loads(result.stdout) if result.returncode == 0 else None
+    except subprocess.TimeoutExpired:
+        logger(instance=name, error=f'Timed out reading the manifest of {remote_dir}')
+        return SyncResult(error="timeout")
+    except ValueError:
+        remote = None
+    if remote is None:
+        logger(instance=name, error=f'Could not read the manifest of {remote_dir}: {result.stderr.strip()}')
+        return SyncResult(error=result.stderr.strip() or f"exit code {result.returncode}")
+
+    selected = {path for path in remote if _selected(path, include, exclude)}
+    changed = [(path, paths[path]) for path in local if path not in selected or remote[path][2] != local[path][2]]
+    sync = SyncResult(unchanged=len(local) - len(changed))
+    sync.transferred = _send_files(name, changed, remote_dir, timeout)
+    for transfer in sync.transferred:
+        if transfer.ok:
+            remote[transfer.path] = local[transfer.path] # tar keeps the mtime to the microsecond, the precision compared by the guest
+
+    extraneous = sorted(selected - set(local))
+    if delete and extraneous:
+        try:
+            result = run_guest(name, ["sh", "-c", 'cd "$1" && xargs -0 rm -f --', "sh", remote_dir], timeout=timeout, input="\0".join(extraneous))
+            if result.returncode != 0:
+                logger(instance=name, error=f'Could not delete the extraneous files of {remote_dir}: {result.stderr.strip()}')
+            else:
+                sync.deleted = extraneous
+                for path in extraneous:
+                    remote.pop(path)
+        except subprocess.TimeoutExpired:
+            logger(instance=name, error=f'Timed out deleting the extraneous files of {remote_dir}')
+
+    def update(cache):
+        cache["local"][local_key] = local
+        cache["remote"][remote_dir] = remote
+    _update_cache(name, update)
+    log.info(f'Synchronised {local_dir} to instance {name}:{remote_dir}: {len(sync.transferred)} transferred, '
+             f'{len(sync.deleted)} deleted, {sync.unchanged} unchanged')
+    return sync
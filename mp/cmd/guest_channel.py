@@ -0,0 +1,346 @@
+##
+## Multipass Library - 2024
+## mp [Ubuntu:22.04]
+## File description:
+## multipass instance library for persistent guest command channels
+## @julesreyn
+##
+
+from mp.cmd.runner import run_multipass, runner
+from mp.backends import get_backend
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+import subprocess
+import itertools
+import threading
+import logging
+import json
+import time
+
+log = logging.getLogger(__name__)
+
+# Request loop run inside the instance: one JSON request per line on stdin, one JSON response
+# per line on stdout. Requests run in their own thread, so a slow command does not hold the others.
+GUEST_LOOP = r'''
+import json, subprocess, sys, threading
+lock = threading.Lock()
+def reply(message):
+    with lock:
+        sys.stdout.write(json.dumps(message) + "\n")
+        sys.stdout.flush()
+def handle(request):
+    if request.get("op") == "ping":
+        return reply({"id": request["id"], "pong": True})
+    stdin = {"input": request["input"]} if request.get("input") is not None else {"stdin": subprocess.DEVNULL}
+    try:
+        process = subprocess.run(request["argv"], capture_output=True, text=True, errors="replace", timeout=request.get("timeout"), **stdin)
+        reply({"id": request["id"], "code": process.returncode, "stdout": process.stdout, "stderr": process.stderr})
+    except subprocess.TimeoutExpired:
+        reply({"id": request["id"], "timeout": True})
+    except OSError as error:
+        reply({"id": request["id"], "code": 127, "stdout": "", "stderr": str(error)})
+for line in sys.stdin:
+    threading.Thread(target=handle, args=(json.loads(line),), daemon=True).start()
+'''
+
+CHANNEL_CLOSED_CODE = 255 # exit code reported when the channel dies with a request in flight, as ssh does
+
+
+class ChannelError(RuntimeError):
+    """Raised when a guest channel cannot be opened or a request cannot be sent over it."""
+
+
+class _Connection:
+    """One running guest loop and the requests waiting for its responses."""
+
+    def __init__(self, process, call):
+        self.process = process
+        self.call = call
+        self.output_bytes = 0
+        self.pending = {}
+        self.closed = False
+        self.lock = threading.Lock()
+
+
+
+class GuestChannel:
+    """
+    Long-lived `multipass exec` running a request loop in an instance, to run many commands
+    without paying the client and SSH setup of a new exec for each of them.
+
+    Requests are framed as JSON lines and carry an id, so several threads can share the channel.
+    The channel is opened on first use, pinged when it has been idle for longer than
+    health_interval, and reopened when the guest loop died.
+
+    Args:
+        name (str): The name of the instance.
+        connect_timeout (float): The deadline of the first ping after opening the channel in seconds, default is 15.
+        health_interval (float): The idle time after which the channel is pinged before use in seconds, default is 30.
+
+    Example:
+        >>> channel = GuestChannel("instance_name")
+        >>> channel.run(["hostname"]).stdout
+        'instance_name\\n'
+        >>> channel.close()
+    """
+
+    def __init__(self, name, connect_timeout=15.0, health_interval=30.0):
+        self.name = name
+        self.connect_timeout = connect_timeout
+        self.health_interval = health_interval
+        self._connection = None
+        self._ids = itertools.count()
+        self._open_lock = threading.Lock()
+        self._last_reply = 0.0
+
+    @property
+    def alive(self):
+        """True if the guest loop is running."""
+        connection = self._connection
+        return connection is not None and not connection.closed and connection.process.poll() is None
+
+    def _read(self, connection):
+        for line in connection.process.stdout:
+            connection.output_bytes += len(line)
+            try:
+                reply = json.loads(line)
+            except ValueError:
+                continue
+            self._last_reply = time.monotonic()
+            with connection.lock:
+                future = connection.pending.pop(reply.get("id"), None)
+            if future is not None:
+                future.set_result(reply)
+        with connection.lock:
+            connection.closed = True
+            pending, connection.pending = connection.pending, {}
+        for future in pending.values():
+            future.set_exception(ChannelError(f'guest channel of instance {self.name} closed'))
+        runner.finish(connection.call, connection.process.wait(), connection.output_bytes)
+
+    def _send(self, request, timeout):
+        connection = self._connection
+        if connection is None:
+            raise ChannelError(f'guest channel of instance {self.name} is not open')
+        future = Future()
+        request["id"] = next(self._ids)
+        with connection.lock:
+            if connection.closed:
+                raise ChannelError(f'guest channel of instance {self.name} closed')
+            connection.pending[request["id"]] = future
+            try:
+                connection.process.stdin.write(json.dumps(request) + "\n")
+                connection.process.stdin.flush()
+            except (OSError, ValueError) as error:
+                connection.pending.pop(request["id"], None)
+                raise ChannelError(f'guest channel of instance {self.name} closed: {error}') from error
+        try:
+            return future.result(timeout)
+        except ChannelError as error:
+            return {"id": request["id"], "code": CHANNEL_CLOSED_CODE, "stdout": "", "stderr": str(error)}
+        except FutureTimeout:
+            with connection.lock:
+                connection.pending.pop(request["id"], None)
+            raise subprocess.TimeoutExpired(request.get("argv", "ping"), timeout) from None
+
+    def ping(self, timeout=5.0):
+        """
+        Check that the guest loop answers.
+
+        Args:
+            timeout (float): The deadline of the ping in seconds, default is 5.
+
+        Returns:
+            bool: True if the guest loop answered in time.
+        """
+        try:
+            return self._send({"op": "ping"}, timeout).get("pong", False)
+        except (ChannelError, subprocess.TimeoutExpired):
+            return False
+
+    def open(self):
+        """
+        Open the channel, or check its health if it is already open.
+
+        Raises:
+            ChannelError: If the guest loop does not answer within connect_timeout, or the backend cannot stream.
+        """
+        with self._open_lock:
+            if self.alive and (time.monotonic() - self._last_reply < self.health_interval or self.ping()):
+                return
+            self.close()
+            log.info(f'Opening guest channel to instance {self.name}')
+            backend = get_backend()
+            if not backend.streaming:
+                raise ChannelError(f'the {backend.name} backend cannot hold a guest channel open')
+            process, call = runner.popen(["exec", self.name, "--", "python3", "-u", "-c", GUEST_LOOP], self.name,
+                                         stdin=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+            self._connection = _Connection(process, call)
+            threading.Thread(target=self._read, args=(self._connection,), name=f"mp-channel-{self.name}", daemon=True).start()
+            if not self.ping(self.connect_timeout):
+                self.close()
+                raise ChannelError(f'guest channel of instance {self.name} could not be opened')
+
+    def run(self, argv, timeout=None, input=None):
+        """
+        Run a command in the instance over the channel.
+
+        Args:
+            argv (list): The command and its arguments.
+            timeout (float): The deadline of the command in seconds, no deadline if None.
+            input (str): The data sent to the standard input of the command.
+
+        Returns:
+            subprocess.CompletedProcess: The exit code and output of the command.
+
+        Raises:
+            ChannelError: If the channel cannot be opened or the request cannot be sent. A channel dying
+                after the request was sent is reported with exit code 255, the command may have run.
+            subprocess.TimeoutExpired: If the command did not finish before the deadline.
+        """
+        self.open()
+        args = ["multipass", "exec", self.name, "--"] + list(argv)
+        request = {"argv": list(argv), "timeout": timeout, "input": input}
+        wait = None if timeout is None else timeout + self.connect_timeout
+        reply = self._send(request, wait)
+        if reply.get("timeout"):
+            raise subprocess.TimeoutExpired(args, timeout)
+        return subprocess.CompletedProcess(args, reply["code"], reply["stdout"], reply["stderr"])
+
+    def close(self):
+        """Stop the guest loop, requests still in flight fail."""
+        connection, self._connection = self._connection, None
+        if connection is None:
+            return
+        try:
+            connection.process.stdin.close()
+        except OSError:
+            pass
+        try:
+            connection.process.wait(timeout=2)
+        except subprocess.TimeoutExpired:
+            connection.process.kill()
+            connection.process.wait()
+
+
+
+_channels = None
+_channel_options = {}
+_channels_lock = threading.Lock()
+
+
+def enable_guest_channels(connect_timeout=15.0, health_interval=30.0, retry_interval=60.0):
+    """
+    Run exec_command, the instance_info getters and collect_metrics over a persistent channel per instance.
+
+    Args:
+        connect_timeout (float): The deadline of the first ping of a channel in seconds, default is 15.
+        health_interval (float): The idle time after which a channel is pinged before use in seconds, default is 30.
+        retry_interval (float): How long an instance whose channel failed to open uses plain execs in seconds, default is 60.
+
+    Example:
+        >>> enable_guest_channels()
+        >>> get_hostname("instance_name")
+        'instance_name'
+    """
+    global _channels
+    with _channels_lock:
+        _channel_options.update(connect_timeout=connect_timeout, health_interval=health_interval, retry_interval=retry_interval)
+        if _channels is None:
+            _channels = {}
+
+
+
+def disable_guest_channels():
+    """Close every guest channel and go back to one `multipass exec` per command."""
+    global _channels
+    with _channels_lock:
+        channels, _channels = _channels or {}, None
+    for channel, _ in channels.values():
+        channel.close()
+
+
+
+def close_channel(name=None):
+    """
+    Close the guest channel of an instance, e.g. before it is stopped or deleted.
+    The channel is reopened on the next command if guest channels are still enabled.
+
+    Args:
+        name (str): The name of the instance, every channel if None.
+    """
+    with _channels_lock:
+        if _channels is None:
+            return
+        names = list(_channels) if name is None else [name]
+        entries = [_channels.pop(name) for name in names if name in _channels]
+    for channel, _ in entries:
+        channel.close()
+
+
+
+def get_channel(name):
+    """
+    Get the guest channel of an instance.
+
+    Args:
+        name (str): The name of the instance.
+
+    Returns:
+        GuestChannel: The channel, None if guest channels are disabled or the channel recently failed to open.
+    """
+    with _channels_lock:
+        if _channels is None:
+            return None
+        channel, retry_at = _channels.get(name, (None, 0.0))
+        if time.monotonic() < retry_at:
+            return None
+        if channel is None:
+            channel = GuestChannel(name, _channel_options["connect_timeout"], _channel_options["health_interval"])
+            _channels[name] = (channel, 0.0)
+        return channel
+
+
+
+def _channel_failed(name, channel):
+    with _channels_lock:
+        if _channels is not None and _channels.get(name, (None,))[0] is channel:
+            _channels[name] = (channel, time.monotonic() + _channel_options["retry_interval"])
+
+
+
+def run_guest(name, argv, timeout=None, input=None, check=False):
+    """
+    Run a command in an instance, over its guest channel when channels are enabled,
+    with a plain `multipass exec` otherwise or when the channel cannot be opened.
+
+    Args:
+        name (str): The name of the instance.
+        argv (list): The command and its arguments.
+        timeout (float): The deadline of the command in seconds, no deadline if None.
+        input (str): The data sent to the standard input of the command.
+        check (bool): Raise subprocess.CalledProcessError if the command fails, default is False.
+
+    Returns:
+        subprocess.CompletedProcess: The exit code and output of the command.
+
+    Raises:
+        subprocess.TimeoutExpired: If the command did not finish before the deadline.
+        subprocess.CalledProcessError: If check is True and the command failed.
+
+    Example:
+        >>> run_guest("instance_name", ["uptime"]).stdout
+        ' 10:00:00 up 1:00,  0 users,  load average: 0.00, 0.00, 0.00\\n'
+    """
+    result = None
+    channel = get_channel(name)
+    if channel is not None:
+        try:
+            result = channel.run(argv, timeout, input)
+        except ChannelError as error:
+            log.warning(f'Guest channel unavailable, using a plain exec: {error}')
+            _channel_failed(name, channel)
+    if result is None:
+        result = run_multipass(["exec", name, "--"] + list(argv), input=input, timeout=timeout)
+    if check:
+        result.check_returncode()
+    return result
@@ -0,0 +1,170 @@
+##
+## Multipass Library - 2024
+## mp [Ubuntu:22.04]
+## File description:
+## multipass instance library for instance metadata caching
+## @julesreyn
+##
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+import threading
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+FOREVER = None # entries with this TTL are kept until the instance is invalidated (deleted)
+
+DEFAULT_TTLS = {
+    "state": 2.0,
+    "ip": 10.0,
+    "image": FOREVER,
+    "hostname": FOREVER,
+    "index": 2.0,
+}
+
+VOLATILE_FIELDS = ("state", "ip")
+
+
+class InstanceCache:
+    """
+    Process-wide cache of instance metadata with a separate TTL per field.
+
+    Entries are keyed by (instance name, field). Fleet-wide entries such as the instance
+    listing use None as instance name.
+
+    Attributes:
+        ttls (dict): The TTL in seconds of each field, FOREVER (None) to cache until invalidated.
+        bypass (bool): When True, every lookup goes to multipass and nothing is cached, in every thread.
+        hits (int): The number of lookups answered from the cache.
+        misses (int): The number of lookups that had to call multipass.
+
+    Example:
+        >>> instance_cache.get("instance_name", "state", lambda: "Running")
+        'Running'
+        >>> instance_cache.stats()
+        {'hits': 0, 'misses': 1, 'entries': 1, 'bypass': False}
+    """
+
+    def __init__(self, ttls=None):
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.bypass = False
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._bypassed = ContextVar(f'instance_cache_bypassed_{id(self)}', default=False)
+
+    def _skipped(self):
+        return self.bypass or self._bypassed.get()
+
+    def _expiry(self, field):
+        ttl = self.ttls.get(field, 0)
+        return None if ttl is FOREVER else time.monotonic() + ttl
+
+    def get(self, name, field, loader):
+        """
+        Get a field of an instance, calling the loader on a miss.
+
+        Args:
+            name (str): The name of the instance, None for fleet-wide entries.
+            field (str): The name of the field.
+            loader (callable): Called without arguments to fetch the value on a miss.
+
+        Returns:
+            The cached or freshly loaded value. None values are never cached.
+        """
+        found, value = self.lookup(name, field)
+        if found:
+            return value
+        value = loader()
+        self.set(name, field, value)
+        return value
+
+    def lookup(self, name, field):
+        """
+        Look a field of an instance up without loading it on a miss.
+
+        Args:
+            name (str): The name of the instance, None for fleet-wide entries.
+            field (str): The name of the field.
+
+        Returns:
+            tuple: (True, value) on a hit, (False, None) on a miss.
+        """
+        if self._skipped():
+            return False, None
+        with self._lock:
+            entry = self._entries.get((name, field))
+            if entry is not None and (entry[0] is None or entry[0] > time.monotonic()):
+                self.hits += 1
+                return True, entry[1]
+            self.misses += 1
+        return False, None
+
+    def set(self, name, field, value):
+        """
+        Store a field of an instance, None values are ignored.
+
+        Args:
+            name (str): The name of the instance, None for fleet-wide entries.
+            field (str): The name of the field.
+            value: The value to store.
+        """
+        if self._skipped() or value is None:
+            return
+        with self._lock:
+            self._entries[(name, field)] = (self._expiry(field), value)
+
+    def invalidate(self, name=None, fields=None):
+        """
+        Drop the cached fields of an instance and the fleet-wide entries.
+
+        Args:
+            name (str): The name of the instance, None to only drop the fleet-wide entries.
+            fields (list): The fields to drop for the instance, all of them if None.
+        """
+        log.info(f'Invalidating cache of instance {name}: {", ".join(fields) if fields else "all fields"}')
+        with self._lock:
+            for key in list(self._entries):
+                if key[0] is None or (key[0] == name and (fields is None or key[1] in fields)):
+                    del self._entries[key]
+
+    def clear(self):
+        """Drop every cached entry and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        Get the cache counters.
+
+        Returns:
+            dict: The number of hits, misses and entries, and whether the cache is bypassed in the current context.
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "bypass": self._skipped()}
+
+    @contextmanager
+    def bypassed(self):
+        """
+        Temporarily bypass the cache in the current thread or asyncio task.
+
+        The flag is held in a context variable: other threads keep using the cache, nested uses restore
+        the previous state on exit, and the threads started with asyncio.to_thread inherit it.
+
+        Example:
+            >>> with instance_cache.bypassed():
+            ...     get_state("instance_name")
+        """
+        token = self._bypassed.set(True)
+        try:
+            yield self
+        finally:
+            self._bypassed.reset(token)
+
+
+instance_cache = InstanceCache()
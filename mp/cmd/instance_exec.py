@@ -0,0 +1,415 @@
+##
+## Multipass Library - 2024
+## mp [Ubuntu:22.04]
+## File description:
+## multipass instance library for command execution
+## @julesreyn
+##
+
+from mp.logger import logger
+from mp.cmd.instance_info import get_instance_index
+from mp.cmd.runner import runner
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+from collections import deque
+import subprocess
+import secrets
+import fnmatch
+import threading
+import logging
+import queue
+import shlex
+import time
+import re
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_LINES = 1000 # lines of stdout and stderr kept in ExecResult
+
+
+@dataclass(slots=True)
+class ExecResult:
+    """
+    Outcome of a command executed on an instance.
+
+    Attributes:
+        name (str): The name of the instance.
+        argv (list): The executed command.
+        exit_code (int): The exit code of the command, None if it was killed on timeout.
+        duration (float): The duration of the command in seconds.
+        stdout (str): The last lines of the standard output.
+        stderr (str): The last lines of the standard error.
+        timed_out (bool): True if the command was killed because its deadline expired.
+    """
+    name: str
+    argv: list
+    exit_code: int = None
+    duration: float = 0.0
+    stdout: str = ""
+    stderr: str = ""
+    timed_out: bool = False
+
+    @property
+    def ok(self):
+        """True if the command exited with code 0."""
+        return self.exit_code == 0
+
+
+@dataclass(slots=True)
+class ExecManyResult:
+    """
+    Outcome of a command executed on many instances.
+
+    Attributes:
+        results (dict): A dictionary mapping the instance names to their ExecResult.
+        skipped (list): The instances on which the command was not started because of fail-fast or max_failures.
+        groups (dict): With group_output, a dictionary mapping (exit_code, stdout) to the names of the instances
+            that produced it.
+        duration (float): The duration of the whole fan-out in seconds.
+    """
+    results: dict = field(default_factory=dict)
+    skipped: list = field(default_factory=list)
+    groups: dict = field(default_factory=dict)
+    duration: float = 0.0
+
+    @property
+    def failed(self):
+        """The names of the instances on which the command failed or timed out."""
+        return [name for name, result in self.results.items() if not result.ok]
+
+
+def _split(command):
+    return shlex.split(command) if isinstance(command, str) else list(command)
+
+
+def _pump(stream, source, lines):
+    for line in iter(stream.readline, ""):
+        lines.put((source, line.rstrip("\n")))
+    stream.close()
+    lines.put((source, None))
+
+
+class ExecStream:
+    """
+    Command running on an instance, iterated line by line as the output arrives.
+
+    Iterating yields (source, line) tuples where source is "stdout" or "stderr". Only the last
+    max_lines lines of each stream are retained, so memory stays bounded whatever the volume
+    of output. The result attribute holds the ExecResult once the iteration is over.
+
+    Args:
+        name (str): The name of the instance.
+        argv (list | str): The command to execute, a string is split with shell quoting rules.
+        timeout (float): The deadline of the command in seconds, no deadline if None.
+        max_lines (int): The number of lines of each stream kept in the result, default is 1000.
+        input (str): The data to send on the standard input of the command.
+        report (bool): Send a failure or timeout to the logger, default is True.
+
+    Example:
+        >>> stream = ExecStream("instance_name", ["bash", "/home/ubuntu/config.sh"], timeout=1800)
+        >>> for source, line in stream:
+        ...     print(line)
+        >>> stream.result.exit_code
+        0
+    """
+
+    def __init__(self, name, argv, timeout=None, max_lines=DEFAULT_MAX_LINES, input=None, report=True):
+        self.name = name
+        self.argv = _split(argv)
+        self.timeout = timeout
+        self.max_lines = max_lines
+        self.input = input
+        self.report = report
+        self.result = None
+
+    def __iter__(self):
+        log.info(f'Executing command on instance {self.name}: {shlex.join(self.argv)}')
+        start = time.monotonic()
+        deadline = None if self.timeout is None else start + self.timeout
+        process, call = runner.popen(["exec", self.name, "--"] + self.argv, self.name, text=True,
+                                     stdin=subprocess.PIPE if self.input is not None else subprocess.DEVNULL)
+        tails = {"stdout": deque(maxlen=self.max_lines), "stderr": deque(maxlen=self.max_lines)}
+        lines = queue.Queue()
+        for source in tails:
+            threading.Thread(target=_pump, args=(getattr(process, source), source, lines), daemon=True).start()
+        if self.input is not None:
+            threading.Thread(target=self._feed, args=(process,), daemon=True).start()
+        open_streams = len(tails)
+        timed_out = False
+        output_bytes = 0
+        try:
+            while open_streams:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    timed_out = True
+                    break
+                try:
+                    source, line = lines.get(timeout=remaining)
+                except queue.Empty:
+                    continue
+                if line is None:
+                    open_streams -= 1
+                    continue
+                tails[source].append(line)
+                output_bytes += len(line) + 1
+                yield source, line
+        finally:
+            if process.poll() is None and (timed_out or open_streams):
+                process.kill()
+            process.wait()
+            runner.finish(call, None if timed_out else process.returncode, output_bytes, timed_out)
+            self.result = ExecResult(self.name, self.argv, None if timed_out else process.returncode,
+                                     round(time.monotonic() - start, 3), "\n".join(tails["stdout"]), "\n".join(tails["stderr"]), timed_out)
+        if not self.report:
+            return
+        if timed_out:
+            logger(instance=self.name, error=f"command {shlex.join(self.argv)} timed out after {self.timeout}s\n{self.result.stderr}")
+        elif process.returncode != 0:
+            logger(instance=self.name, error=self.result.stderr)
+
+    def _feed(self, process):
+        try:
+            process.stdin.write(self.input)
+            process.stdin.close()
+        except (BrokenPipeError, ValueError):
+            pass
+
+    def run(self):
+        """
+        Consume the whole output and return the result.
+
+        Returns:
+            ExecResult: The result of the command.
+        """
+        for _ in self:
+            pass
+        return self.result
+
+
+def exec_stream(name, argv, timeout=None, max_lines=DEFAULT_MAX_LINES, input=None):
+    """
+    Execute a command on a specified instance and stream its output.
+
+    Args:
+        name (str): The name of the instance.
+        argv (list | str): The command to execute, a string is split with shell quoting rules.
+        timeout (float): The deadline of the command in seconds, no deadline if None.
+        max_lines (int): The number of lines of each stream kept in the result, default is 1000.
+        input (str): The data to send on the standard input of the command.
+
+    Returns:
+        ExecStream: The running command, iterate over it to get the (source, line) tuples.
+
+    Example:
+        >>> stream = exec_stream("instance_name", "bash /home/ubuntu/config.sh", timeout=1800)
+        >>> for source, line in stream:
+        ...     print(f'[{source}] {line}')
+        [stdout] [+] Initializing configuration of instance
+        >>> stream.result
+        ExecResult(name='instance_name', argv=['bash', '/home/ubuntu/config.sh'], exit_code=0, duration=612.4, ...)
+    """
+    return ExecStream(name, argv, timeout, max_lines, input)
+
+
+
+def _select_targets(targets):
+    if callable(targets):
+        return [name for name, entry in get_instance_index().by_name.items() if targets(entry)]
+    if isinstance(targets, str):
+        return [name for name in get_instance_index().names("Running") if fnmatch.fnmatchcase(name, targets)]
+    return list(dict.fromkeys(targets))
+
+
+
+def _exec_one(name, argv, timeout, max_lines):
+    # an error raised for one target, e.g. by the logger or when multipass cannot be started, is recorded
+    # as the failed result of that target instead of failing the whole fan-out
+    start = time.monotonic()
+    stream = ExecStream(name, argv, timeout, max_lines)
+    try:
+        return stream.run()
+    except Exception as error:
+        log.exception(f'Executing command on instance {name} failed')
+        if stream.result is not None:
+            return stream.result
+        return ExecResult(name, argv, None, round(time.monotonic() - start, 3), stderr=str(error))
+
+
+
+def exec_many(targets, argv, concurrency=8, timeout=None, fail_fast=False, max_failures=None, group_output=False,
+              max_lines=DEFAULT_MAX_LINES):
+    """
+    Execute the same command on many instances in parallel.
+
+    Args:
+        targets (list | str | callable): The names of the instances, a shell-style pattern matched against the
+            running instances (e.g. "web-*", "*" for all of them), or a predicate called with each InstanceEntry.
+        argv (list | str): The command to execute, a string is split with shell quoting rules.
+        concurrency (int): The maximum number of commands running at the same time, default is 8. Values below 1 count as 1.
+        timeout (float): The deadline of each command in seconds, no deadline if None.
+        fail_fast (bool): Stop starting new commands after the first failure, default is False.
+        max_failures (int): Stop starting new commands after this number of failures, no limit if None.
+        group_output (bool): Group the instances that produced the same exit code and output, default is False.
+        max_lines (int): The number of lines of each stream kept in the results, default is 1000.
+
+    Returns:
+        ExecManyResult: The per-instance results, the skipped instances and the output groups. An error
+        raised for an instance is logged and recorded as its failed result, with no exit code.
+
+    Example:
+        >>> exec_many("*", "systemctl is-active docker", concurrency=16, timeout=30, group_output=True).groups
+        {(0, 'active'): ['instance1', 'instance2'], (3, 'inactive'): ['instance3']}
+    """
+    names = _select_targets(targets)
+    argv = _split(argv)
+    concurrency = max(1, concurrency)
+    if fail_fast:
+        max_failures = 1
+    log.info(f'Executing command on {len(names)} instances, {concurrency} at a time: {shlex.join(argv)}')
+    outcome = ExecManyResult()
+    start = time.monotonic()
+    pending = deque(names)
+    failures = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        running = set()
+        while pending or running:
+            while pending and len(running) < concurrency and (max_failures is None or failures < max_failures):
+                running.add(pool.submit(_exec_one, pending.popleft(), argv, timeout, max_lines))
+            if not running:
+                break
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                outcome.results[result.name] = result
+                failures += not result.ok
+    outcome.skipped = list(pending)
+    outcome.results = {name: outcome.results[name] for name in names if name in outcome.results}
+    if group_output:
+        for name, result in outcome.results.items():
+            outcome.groups.setdefault((result.exit_code, result.stdout), []).append(name)
+    outcome.duration = round(time.monotonic() - start, 3)
+    log.info(f'Command executed on {len(outcome.results)} instances in {outcome.duration}s, '
+             f'{len(outcome.failed)} failed, {len(outcome.skipped)} skipped')
+    return outcome
+
+
+
+class ExecBatch:
+    """
+    Queue of commands shipped to an instance as a single script in one `multipass exec`.
+
+    Each command gets its own ExecResult: the script writes a marker with the command index and
+    exit status around each command on both streams, so the output is split back per command.
+    String commands are inserted in the script as shell snippets, argv lists are quoted.
+
+    Args:
+        name (str): The name of the instance.
+        stop_on_error (bool): Skip the remaining commands after a failure, default is True.
+        timeout (float): The deadline of the whole batch in seconds, no deadline if None.
+        max_lines (int): The number of lines of each stream kept per command, default is 1000.
+
+    Example:
+        >>> batch = ExecBatch("instance_name", stop_on_error=False)
+        >>> batch.add("chmod +x /home/ubuntu/config.sh").add(["bash", "/home/ubuntu/config.sh"]).add("rm /home/ubuntu/config.sh")
+        >>> [result.exit_code for result in batch.run()]
+        [0, 0, 0]
+    """
+
+    def __init__(self, name, stop_on_error=True, timeout=None, max_lines=DEFAULT_MAX_LINES):
+        self.name = name
+        self.stop_on_error = stop_on_error
+        self.timeout = timeout
+        self.max_lines = max_lines
+        self.commands = []
+
+    def add(self, command):
+        """
+        Queue a command.
+
+        Args:
+            command (str | list): A shell snippet, or an argv list.
+
+        Returns:
+            ExecBatch: The batch, so calls can be chained.
+        """
+        self.commands.append(command)
+        return self
+
+    def script(self, marker):
+        """
+        Build the script of the batch.
+
+        Args:
+            marker (str): The unique marker delimiting the output of each command.
+
+        Returns:
+            str: The shell script.
+        """
+        lines = []
+        for index, command in enumerate(self.commands):
+            snippet = command if isinstance(command, str) else shlex.join(command)
+            lines += [
+                f"printf '%s %d begin\\n' {marker} {index}; printf '%s %d begin\\n' {marker} {index} >&2",
+                snippet,
+                "rc=$?",
+                f"printf '%s %d end %d\\n' {marker} {index} $rc; printf '%s %d end %d\\n' {marker} {index} $rc >&2",
+            ]
+            if self.stop_on_error:
+                lines.append('[ "$rc" -eq 0 ] || exit "$rc"')
+        return "\n".join(lines) + "\n"
+
+    def run(self, on_line=None):
+        """
+        Run the queued commands on the instance.
+
+        Args:
+            on_line (callable): Called with (index, source, line) for each line of output as it arrives.
+
+        Returns:
+            list: The ExecResult of each queued command, in order. Commands skipped after a failure,
+            or cut by the batch deadline, have an exit_code of None. Each failed or timed out command
+            is sent to the logger once, by the batch.
+        """
+        marker = f'__mp_batch_{secrets.token_hex(8)}__'
+        pattern = re.compile(rf'{marker} (\d+) (begin|end)(?: (\d+))?$')
+        results = [ExecResult(self.name, _split(command) if not isinstance(command, str) else [command]) for command in self.commands]
+        tails = [{"stdout": deque(maxlen=self.max_lines), "stderr": deque(maxlen=self.max_lines)} for _ in self.commands]
+        current = {"stdout": None, "stderr": None}
+        started = {}
+        log.info(f'Executing batch of {len(self.commands)} commands on instance {self.name}')
+        stream = ExecStream(self.name, ["bash", "-c", self.script(marker)], self.timeout, self.max_lines, report=False)
+        for source, line in stream:
+            prefix, found, rest = line.partition(marker)
+            match = pattern.match(found + rest) if found else None
+            if match is None:
+                if current[source] is not None:
+                    tails[current[source]][source].append(line)
+                    if on_line is not None:
+                        on_line(current[source], source, line)
+                continue
+            index = int(match.group(1))
+            if prefix and current[source] is not None:
+                tails[current[source]][source].append(prefix)
+                if on_line is not None:
+                    on_line(current[source], source, prefix)
+            if match.group(2) == "begin":
+                current[source] = index
+                started.setdefault(index, time.monotonic())
+                continue
+            current[source] = None
+            if source == "stdout":
+                results[index].exit_code = int(match.group(3))
+                results[index].duration = round(time.monotonic() - started.get(index, time.monotonic()), 3)
+        for index, result in enumerate(results):
+            result.stdout = "\n".join(tails[index]["stdout"])
+            result.stderr = "\n".join(tails[index]["stderr"])
+            result.timed_out = stream.result.timed_out and index in started and result.exit_code is None
+            if index in started and result.exit_code is None and not result.timed_out:
+                result.exit_code = stream.result.exit_code # a snippet called exit, the script ended with it
+            if result.timed_out:
+                logger(instance=self.name, error=f'{shlex.join(result.argv)} timed out after {self.timeout}s\n{result.stderr}')
+            elif result.exit_code not in (0, None):
+                logger(instance=self.name, error=f'{shlex.join(result.argv)} exited with {result.exit_code}: {result.stderr}')
+        if not started and not stream.result.ok:
+            logger(instance=self.name, error=stream.result.stderr or f'batch exited with {stream.result.exit_code}')
+        return results
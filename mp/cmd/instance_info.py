@@ -7,12 +7,220 @@
 ##
 
 from mp.logger import logger
-import subprocess
+from mp.cmd.instance_cache import instance_cache
+from mp.cmd.guest_channel import run_guest
+from mp.cmd.runner import run_multipass
+from dataclasses import dataclass, field
+import threading
 import logging
+import json
 
 log = logging.getLogger(__name__)
 
 
+@dataclass(slots=True)
+class InstanceSnapshot:
+    """
+    Structured view of an instance, built from a single `multipass info --format json` call.
+
+    Attributes:
+        name (str): The name of the instance.
+        state (str): The state of the instance (Running, Stopped, Suspended, ...).
+        ipv4 (list): The IPv4 addresses of the instance, the first one is the primary address.
+        image (str): The image release of the instance, e.g. "22.04 LTS".
+        image_hash (str): The short hash of the image.
+        release (str): The release reported by the guest, e.g. "Ubuntu 22.04.4 LTS".
+        load (tuple): The 1, 5 and 15 minutes load averages.
+        cpus (int): The number of CPUs allocated to the instance.
+        disk_used (int): The disk usage in bytes.
+        disk_total (int): The disk size in bytes.
+        memory_used (int): The memory usage in bytes.
+        memory_total (int): The memory size in bytes.
+        mounts (dict): The mounts of the instance, mapping the target path to the host source path.
+    """
+    name: str
+    state: str = None
+    ipv4: list = field(default_factory=list)
+    image: str = None
+    image_hash: str = None
+    release: str = None
+    load: tuple = ()
+    cpus: int = None
+    disk_used: int = None
+    disk_total: int = None
+    memory_used: int = None
+    memory_total: int = None
+    mounts: dict = field(default_factory=dict)
+
+    @property
+    def ip(self):
+        """The primary IPv4 address of the instance, None if it has none."""
+        return self.ipv4[0] if self.ipv4 else None
+
+    def describe(self):
+        """
+        Render the snapshot with the layout of the `multipass info` text output.
+
+        Returns:
+            str: The human readable description of the instance.
+        """
+        lines = [
+            ("Name", self.name),
+            ("State", self.state),
+            ("IPv4", self.ip or "--"),
+            ("Release", self.release or "--"),
+            ("Image hash", f'{self.image_hash} (Ubuntu {self.image})' if self.image_hash else "--"),
+            ("CPU(s)", self.cpus if self.cpus is not None else "--"),
+            ("Load", " ".join(str(load) for load in self.load) or "--"),
+            ("Disk usage", _format_usage(self.disk_used, self.disk_total)),
+            ("Memory usage", _format_usage(self.memory_used, self.memory_total)),
+            ("Mounts", "\n                ".join(f'{source} => {target}' for target, source in self.mounts.items()) or "--"),
+        ]
+        return "\n".join(f'{f"{key}:":<16}{value}' for key, value in lines) + "\n"
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _format_size(size):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return f'{size:.1f}{unit}' if unit != "B" else f'{size}{unit}'
+        size /= 1024
+    return f'{size:.1f}TiB'
+
+
+def _format_usage(used, total):
+    if used is None or total is None:
+        return "--"
+    return f'{_format_size(used)} out of {_format_size(total)}'
+
+
+def _parse_snapshot(name, info):
+    """
+    Build an InstanceSnapshot from the JSON description of an instance.
+
+    Args:
+        name (str): The name of the instance.
+        info (dict): The instance entry of `multipass info --format json`.
+
+    Returns:
+        InstanceSnapshot: The parsed snapshot.
+    """
+    disks = info.get("disks") or {}
+    disk_used = [_to_int(disk.get("used")) for disk in disks.values()]
+    disk_total = [_to_int(disk.get("total")) for disk in disks.values()]
+    memory = info.get("memory") or {}
+    return InstanceSnapshot(
+        name=name,
+        state=info.get("state"),
+        ipv4=list(info.get("ipv4") or []),
+        image=info.get("image_release") or None,
+        image_hash=info.get("image_hash") or None,
+        release=info.get("release") or None,
+        load=tuple(info.get("load") or ()),
+        cpus=_to_int(info.get("cpu_count")),
+        disk_used=sum(disk_used) if disk_used and None not in disk_used else None,
+        disk_total=sum(disk_total) if disk_total and None not in disk_total else None,
+        memory_used=_to_int(memory.get("used")),
+        memory_total=_to_int(memory.get("total")),
+        mounts={target: mount.get("source_path") for target, mount in (info.get("mounts") or {}).items()},
+    )
+
+
+def _parse_snapshots(output, names=None):
+    """
+    Parse the output of `multipass info --format json` and refresh the cached fields.
+
+    Args:
+        output (str): The JSON output.
+        names (list): The names of the instances to keep, all of them if None or empty.
+
+    Returns:
+        dict: A dictionary mapping the instance names to their InstanceSnapshot.
+    """
+    info = json.loads(output).get("info", {})
+    snapshots = {name: _parse_snapshot(name, data) for name, data in info.items() if not names or name in names}
+    for snapshot in snapshots.values():
+        instance_cache.set(snapshot.name, "state", snapshot.state)
+        instance_cache.set(snapshot.name, "ip", snapshot.ip)
+        instance_cache.set(snapshot.name, "image", snapshot.image)
+    return snapshots
+
+
+
+def fetch_snapshots(names=None):
+    """
+    Get a snapshot of several instances with a single `multipass info` call, telling a failed query from an empty host.
+
+    Args:
+        names (list): The names of the instances, all instances if None or empty.
+
+    Returns:
+        dict: A dictionary mapping the instance names to their InstanceSnapshot, None if multipass could not be queried.
+        Unknown instances are left out of the result.
+
+    Example:
+        >>> fetch_snapshots()
+        {'instance1': InstanceSnapshot(name='instance1', state='Running', ...)}
+    """
+    names = list(names or [])
+    log.info(f'Getting snapshot of instances [{", ".join(names) or "all"}]')
+    result = run_multipass(["info", "--format", "json"] + (names or ["--all"]))
+    if result.returncode != 0 and len(names) > 1:
+        # multipass refuses the whole query when one instance is unknown, fall back on the full listing
+        result = run_multipass(["info", "--format", "json", "--all"])
+    if result.returncode != 0:
+        logger(instance=", ".join(names) or "get_snapshots", error=result.stderr)
+        return None
+    snapshots = _parse_snapshots(result.stdout, names)
+    log.info(f'Got snapshot of instances [{", ".join(snapshots)}]')
+    return snapshots
+
+
+
+def get_snapshots(names=None):
+    """
+    Get a snapshot of several instances with a single `multipass info` call.
+
+    Args:
+        names (list): The names of the instances, all instances if None or empty.
+
+    Returns:
+        dict: A dictionary mapping the instance names to their InstanceSnapshot, empty if multipass could not be queried.
+        Unknown instances are left out of the result.
+
+    Example:
+        >>> get_snapshots(["instance1", "instance2"])
+        {'instance1': InstanceSnapshot(name='instance1', state='Running', ...), 'instance2': InstanceSnapshot(...)}
+    """
+    snapshots = fetch_snapshots(names)
+    return {} if snapshots is None else snapshots
+
+
+
+def get_snapshot(name):
+    """
+    Get a snapshot of a specified instance.
+
+    Args:
+        name (str): The name of the instance.
+
+    Returns:
+        InstanceSnapshot: The snapshot of the instance, None if the instance does not exist.
+
+    Example:
+        >>> get_snapshot("instance_name")
+        InstanceSnapshot(name='instance_name', state='Running', ipv4=['192.168.0.1'], image='22.04 LTS', ...)
+    """
+    return get_snapshots([name]).get(name)
+
+
+
 def get_ip(name):
     """
     Get the IP address of a specified instance.
@@ -28,16 +236,9 @@ def get_ip(name):
         192.168.0.1
     """
     log.info(f'Getting IP address of instance {name}')
-    result = subprocess.run(["multipass", "info", name], capture_output=True, text=True, check=True)
-
-    if result.returncode != 0:
-        logger(instance=name, error=result.stderr)
-    for line in result.stdout.split('\n'):
-        if 'IPv4' in line:
-            ipv4 = line.split()[1]
-            log.info(f'Instance {name} has IP address {ipv4}')
-            return ipv4
-    return None
+    ipv4 = instance_cache.get(name, "ip", lambda: getattr(get_snapshot(name), "ip", None))
+    log.info(f'Instance {name} has IP address {ipv4}')
+    return ipv4
 
 
 
@@ -59,15 +260,9 @@ def get_state(name):
         Stopped
     """
     log.info(f'Getting state of instance {name}')
-    result = subprocess.run(["multipass", "info", name], capture_output=True, text=True, check=True)
-    if result.returncode != 0:
-        logger(instance=name, error=result.stderr)
-    for line in result.stdout.split('\n'):
-        if 'State' in line:
-            state = line.split()[1]
-            log.info(f'Instance {name} is {state}')
-            return state
-    return None
+    state = instance_cache.get(name, "state", lambda: getattr(get_snapshot(name), "state", None))
+    log.info(f'Instance {name} is {state}')
+    return state
 
 
 
@@ -83,47 +278,96 @@ def get_image(name):
 
     Example:
         >>> get_image("instance_name")
-        22.04
+        22.04 LTS
     """
     log.info(f'Getting image of instance {name}')
-    result = subprocess.run(["multipass", "info", name], capture_output=True, text=True, check=True)
-    if result.returncode != 0:
-        logger(instance=name, error=result.stderr)
-    for line in result.stdout.split('\n'):
-        if 'Image' in line:
-            image = line.split()[1]
-            log.info(f'Instance {name} is using image {image}')
-            return image
-    return None
+    image = instance_cache.get(name, "image", lambda: getattr(get_snapshot(name), "image", None))
+    log.info(f'Instance {name} is using image {image}')
+    return image
+
+
+
+class CpuSampler:
+    """
+    Compute the CPU usage of instances from the delta of their /proc/stat counters.
+
+    The sampler remembers the last jiffy counters read on each instance. The usage is
+    computed over the interval between two reads, so a read never has to sleep. The first
+    read of an instance, or the first read after a reboot, returns the average usage since boot.
+
+    Example:
+        >>> cpu_sampler.sample("instance_name", "cpu  4705 356 584 3699 23 0 23 0 0 0")
+        0.6036
+    """
+
+    def __init__(self):
+        self._previous = {}
+        self._lock = threading.Lock()
+
+    def sample(self, name, line):
+        """
+        Record a /proc/stat `cpu` line of an instance and compute its usage.
+
+        Args:
+            name (str): The name of the instance.
+            line (str): The aggregated `cpu` line of /proc/stat.
+
+        Returns:
+            float: The CPU usage since the previous sample, 0.4 is equal to 40% CPU usage.
+        """
+        jiffies = [int(jiffy) for jiffy in line.split()[1:9]]
+        total = sum(jiffies)
+        idle = sum(jiffies[3:5])
+        with self._lock:
+            previous = self._previous.get(name)
+            self._previous[name] = (total, idle)
+        if previous is not None and total > previous[0]:
+            total, idle = total - previous[0], idle - previous[1]
+        return round((total - idle) / total, 4) if total else 0.0
+
+    def reset(self, name=None):
+        """
+        Forget the counters of an instance, or of every instance if name is None.
+
+        Args:
+            name (str): The name of the instance.
+        """
+        with self._lock:
+            if name is None:
+                self._previous.clear()
+            else:
+                self._previous.pop(name, None)
+
+
+cpu_sampler = CpuSampler()
 
 
 
 def get_cpu_usage(name):
     """
     Get the CPU usage of a specified instance.
-    Usage is calculated as the percentage of time the CPU is not idle.
+    Usage is calculated as the percentage of time the CPU is not idle since the previous call,
+    the first call returns the average usage since boot.
     0.4 is equal to 40% CPU usage.
 
     Args:
         name (str): The name of the instance.
 
     Returns:
-        str: The CPU usage of the instance.
+        float: The CPU usage of the instance.
 
     Example:
         >>> get_cpu_usage("instance_name")
         0.0
     """
     log.info(f'Getting CPU usage of instance {name}')
-    result = subprocess.run(["multipass", "exec", name, "--", "mpstat", "1", "1"], capture_output=True, text=True, check=True)
-    if result.returncode != 0:
+    result = run_guest(name, ["head", "-n", "1", "/proc/stat"])
+    if result.returncode != 0 or not result.stdout.startswith("cpu"):
         logger(instance=name, error=result.stderr)
-    for line in result.stdout.split('\n'):
-        if 'all' in line:
-            cpu_usage = line.split()[-1]
-            log.info(f'Instance {name} has CPU usage {cpu_usage}')
-            return cpu_usage
-    return None
+        return None
+    cpu_usage = cpu_sampler.sample(name, result.stdout)
+    log.info(f'Instance {name} has CPU usage {cpu_usage}')
+    return cpu_usage
 
 
 
@@ -144,7 +388,7 @@ def get_memory_usage(name):
         0
     """
     log.info(f'Getting memory usage of instance {name}')
-    result = subprocess.run(["multipass", "exec", name, "--", "free", "-m"], capture_output=True, text=True, check=True)
+    result = run_guest(name, ["free", "-m"], check=True)
     if result.returncode != 0:
         logger(instance=name, error=result.stderr)
     for line in result.stdout.split('\n'):
@@ -173,7 +417,7 @@ def get_disk_usage(name):
         0.4
     """
     log.info(f'Getting disk usage of instance {name}')
-    result = subprocess.run(["multipass", "exec", name, "--", "df", "-h"], capture_output=True, text=True, check=True)
+    result = run_guest(name, ["df", "-h"], check=True)
     if result.returncode != 0:
         logger(instance=name, error=result.stderr)
     for line in result.stdout.split('\n'):
@@ -202,7 +446,7 @@ def get_uptime(name):
         1:23:45
     """
     log.info(f'Getting uptime of instance {name}')
-    result = subprocess.run(["multipass", "exec", name, "--", "uptime"], capture_output=True, text=True, check=True)
+    result = run_guest(name, ["uptime"], check=True)
     if result.returncode != 0:
         logger(instance=name, error=result.stderr)
     log.info(f'Instance {name} has uptime {result.stdout.split()[2]}')
@@ -226,7 +470,7 @@ def get_processes(name):
         10
     """
     log.info(f'Getting number of processes on instance {name}')
-    result = subprocess.run(["multipass", "exec", name, "--", "ps", "aux"], capture_output=True, text=True, check=True)
+    result = run_guest(name, ["ps", "aux"], check=True)
     if result.returncode != 0:
         logger(instance=name, error=result.stderr)
     log.info(f'Instance {name} has {len(result.stdout.split()) - 1} processes')
@@ -250,7 +494,7 @@ def get_nb_users(name):
         1
     """
     log.info(f'Getting number of users on instance {name}')
-    result = subprocess.run(["multipass", "exec", name, "--", "who"], capture_output=True, text=True, check=True)
+    result = run_guest(name, ["who"], check=True)
     if result.returncode != 0:
         logger(instance=name, error=result.stderr)
     log.info(f'Instance {name} has {len(result.stdout.split()) - 1} users')
@@ -273,14 +517,153 @@ def get_hostname(name):
         "instance_hostname"
     """
     log.info(f'Getting hostname of instance {name}')
-    result = subprocess.run(["multipass", "exec", name, "--", "hostname"], capture_output=True, text=True, check=True)
+    hostname = instance_cache.get(name, "hostname", lambda: _fetch_hostname(name))
+    log.info(f'Instance {name} has hostname {hostname}')
+    return hostname
+
+
+def _fetch_hostname(name):
+    result = run_guest(name, ["hostname"])
     if result.returncode != 0:
         logger(instance=name, error=result.stderr)
-    log.info(f'Instance {name} has hostname {result.stdout.strip()}')
+        return None
     return result.stdout.strip()
 
 
 
+@dataclass(slots=True)
+class InstanceEntry:
+    """
+    Row of the `multipass list` output.
+
+    Attributes:
+        name (str): The name of the instance.
+        state (str): The state of the instance.
+        ipv4 (list): The IPv4 addresses of the instance.
+        release (str): The release of the instance, e.g. "Ubuntu 22.04 LTS".
+    """
+    name: str
+    state: str = None
+    ipv4: list = field(default_factory=list)
+    release: str = None
+
+
+@dataclass(slots=True)
+class InstanceIndex:
+    """
+    Index of all instances built from a single `multipass list --format json` call.
+
+    Attributes:
+        by_name (dict): A dictionary mapping the instance names to their InstanceEntry.
+        by_state (dict): A dictionary mapping the states to the names of the instances in that state.
+        by_ipv4 (dict): A dictionary mapping the IPv4 addresses to the instance names.
+        by_release (dict): A dictionary mapping the releases to the names of the instances running them.
+    """
+    by_name: dict = field(default_factory=dict)
+    by_state: dict = field(default_factory=dict)
+    by_ipv4: dict = field(default_factory=dict)
+    by_release: dict = field(default_factory=dict)
+
+    @classmethod
+    def from_entries(cls, entries):
+        index = cls()
+        for entry in entries:
+            index.by_name[entry.name] = entry
+            index.by_state.setdefault(entry.state, []).append(entry.name)
+            index.by_release.setdefault(entry.release, []).append(entry.name)
+            for ipv4 in entry.ipv4:
+                index.by_ipv4[ipv4] = entry.name
+        return index
+
+    def names(self, state=None):
+        """
+        Get the names of the instances, optionally filtered by state.
+
+        Args:
+            state (str): The state of the instances, all instances if None.
+
+        Returns:
+            list: The names of the instances.
+        """
+        if state is None:
+            return list(self.by_name)
+        return list(self.by_state.get(state, []))
+
+
+def _parse_instance_index(output):
+    """
+    Parse the output of `multipass list --format json` and refresh the cached fields.
+
+    Args:
+        output (str): The JSON output.
+
+    Returns:
+        InstanceIndex: The index of all instances.
+    """
+    entries = [InstanceEntry(name=item["name"], state=item.get("state"), ipv4=list(item.get("ipv4") or []), release=item.get("release") or None)
+               for item in json.loads(output).get("list", [])]
+    for entry in entries:
+        instance_cache.set(entry.name, "state", entry.state)
+        instance_cache.set(entry.name, "ip", entry.ipv4[0] if entry.ipv4 else None)
+    return InstanceIndex.from_entries(entries)
+
+
+def fetch_instance_index():
+    """
+    Get a fresh index of all instances with a single `multipass list` call, bypassing the cache.
+
+    Returns:
+        InstanceIndex: The index of all instances, None if multipass could not be queried.
+
+    Example:
+        >>> fetch_instance_index().by_state
+        {'Running': ['instance1'], 'Stopped': ['instance2']}
+    """
+    result = run_multipass(["list", "--format", "json"])
+    if result.returncode != 0:
+        logger(instance="get_instance_index", error=result.stderr)
+        return None
+    return _parse_instance_index(result.stdout)
+
+
+
+def get_instance_index():
+    """
+    Get the index of all instances, keyed by name, state, IPv4 and release.
+    The whole inventory costs a single `multipass list` call.
+
+    Returns:
+        InstanceIndex: The index of all instances, empty if multipass could not be queried.
+
+    Example:
+        >>> get_instance_index().by_state
+        {'Running': ['instance1', 'instance2'], 'Stopped': ['instance3'], 'Suspended': ['instance4']}
+    """
+    log.info('Getting instance index')
+    return instance_cache.get(None, "index", fetch_instance_index) or InstanceIndex()
+
+
+
+def get_instances_in_state(state):
+    """
+    Get the names of all instances in a specified state.
+
+    Args:
+        state (str): The state of the instances, e.g. "Running", "Stopped", "Suspended", "Starting" or "Deleted".
+
+    Returns:
+        list: A list of the names of the instances in that state.
+
+    Example:
+        >>> get_instances_in_state("Suspended")
+        ["instance4"]
+    """
+    instances = get_instance_index().names(state)
+    log.info(f'{state} instances: [{", ".join(instances)}]')
+    return instances
+
+
+
 def get_running_instances():
     """
     Get the names of all running instances.
@@ -293,12 +676,7 @@ def get_running_instances():
         ["instance1", "instance2"]
     """
     log.info('Getting running instances')
-    result = subprocess.run(["multipass", "list"], capture_output=True, text=True, check=True)
-    if result.returncode != 0:
-        logger(instance="get_running_instances", error=result.stderr)
-    lines = result.stdout.split("\n")
-    log.info(f'Running instances: [{", ".join([line.split()[0] for line in lines if "Running" in line])}]')
-    return [line.split()[0] for line in lines if "Running" in line]
+    return get_instances_in_state("Running")
 
 
 
@@ -314,18 +692,29 @@ def get_stopped_instances():
         ["instance3", "instance4"]
     """
     log.info('Getting stopped instances')
-    result = subprocess.run(["multipass", "list"], capture_output=True, text=True, check=True)
-    if result.returncode != 0:
-        logger(instance="get_running_instances", error=result.stderr)
-    lines = result.stdout.split("\n")
-    log.info(f'Stopped instances: [{", ".join([line.split()[0] for line in lines if "Stopped" in line])}]')
-    return [line.split()[0] for line in lines if "Stopped" in line]
+    return get_instances_in_state("Stopped")
+
+
+
+def get_suspended_instances():
+    """
+    Get the names of all suspended instances.
+
+    Returns:
+        list: A list of the names of all suspended instances.
+
+    Example:
+        >>> get_suspended_instances()
+        ["instance5"]
+    """
+    log.info('Getting suspended instances')
+    return get_instances_in_state("Suspended")
 
 
 
 def get_all_instances():
     """
-    Get the names of all instances, both running and stopped.
+    Get the names of all instances, whatever their state.
 
     Returns:
         list: A list of the names of all instances.
@@ -335,10 +724,9 @@ def get_all_instances():
         ["instance1", "instance2", "instance3", "instance4"]
     """
     log.info('Getting all instances')
-    running_instances = get_running_instances()
-    stopped_instances = get_stopped_instances()
-    log.info(f'All instances: {running_instances + stopped_instances}')
-    return running_instances + stopped_instances
+    instances = get_instance_index().names()
+    log.info(f'All instances: {instances}')
+    return instances
 
 
 
@@ -364,8 +752,9 @@ def get_instance_info(name):
         Memory usage:   91.5M out of 985.4M"
     """
     log.info(f'Getting information about instance {name}')
-    result = subprocess.run(["multipass", "info", name], capture_output=True, text=True, check=True)
-    if result.returncode != 0:
-        logger(instance=name, error=result.stderr)
-    log.info(f'Information about instance {name}:\n{result.stdout}')
-    return result.stdout
+    snapshot = get_snapshot(name)
+    if snapshot is None:
+        return None
+    info = snapshot.describe()
+    log.info(f'Information about instance {name}:\n{info}')
+    return info
@@ -0,0 +1,191 @@
+##
+## Multipass Library - 2024
+## mp [Ubuntu:22.04]
+## File description:
+## multipass instance library for batched in-guest metrics collection
+## @julesreyn
+##
+
+from mp.logger import logger
+from mp.cmd.instance_cache import instance_cache
+from mp.cmd.instance_info import get_running_instances, cpu_sampler
+from mp.cmd.guest_channel import run_guest
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+import subprocess
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+METRICS_PROBE = """
+echo "hostname $(hostname)"
+head -n 1 /proc/stat
+grep -E '^(MemTotal|MemAvailable):' /proc/meminfo
+echo "uptime $(cut -d ' ' -f 1 /proc/uptime)"
+echo "disk $(df -kP / | tail -n 1 | awk '{print $3, $2}')"
+set -- /proc/[0-9]*
+echo "processes $#"
+echo "users $(who | wc -l)"
+"""
+
+
+@dataclass(slots=True)
+class InstanceMetrics:
+    """
+    Health metrics of an instance, gathered with a single `multipass exec`.
+
+    Attributes:
+        name (str): The name of the instance.
+        hostname (str): The hostname of the instance.
+        cpu_usage (float): The CPU usage since the previous sample of the instance, 0.4 is equal to 40% CPU usage.
+        memory_used (int): The memory usage in MB.
+        memory_total (int): The memory size in MB.
+        disk_used (float): The disk usage of the root filesystem in GB.
+        disk_total (float): The size of the root filesystem in GB.
+        uptime (float): The uptime in seconds.
+        processes (int): The number of processes running on the instance.
+        users (int): The number of users logged in to the instance.
+    """
+    name: str
+    hostname: str = None
+    cpu_usage: float = None
+    memory_used: int = None
+    memory_total: int = None
+    disk_used: float = None
+    disk_total: float = None
+    uptime: float = None
+    processes: int = None
+    users: int = None
+
+
+@dataclass(slots=True)
+class FleetMetrics:
+    """
+    Result of a fleet-wide metrics sweep.
+
+    Attributes:
+        metrics (dict): A dictionary mapping the instance names to their InstanceMetrics.
+        timed_out (list): The names of the instances that did not answer before the deadline.
+        failed (list): The names of the instances on which the probe failed.
+        duration (float): The duration of the sweep in seconds.
+    """
+    metrics: dict = field(default_factory=dict)
+    timed_out: list = field(default_factory=list)
+    failed: list = field(default_factory=list)
+    duration: float = 0.0
+
+
+def _parse_metrics(name, output):
+    """
+    Parse the output of the metrics probe.
+
+    Args:
+        name (str): The name of the instance.
+        output (str): The output of METRICS_PROBE.
+
+    Returns:
+        InstanceMetrics: The parsed metrics, fields missing from the output are left to None.
+    """
+    metrics = InstanceMetrics(name=name)
+    meminfo = {}
+    for line in output.splitlines():
+        key, _, value = line.partition(" ")
+        value = value.strip()
+        if key == "hostname":
+            metrics.hostname = value
+        elif key == "cpu":
+            metrics.cpu_usage = cpu_sampler.sample(name, line)
+        elif key in ("MemTotal:", "MemAvailable:"):
+            meminfo[key] = int(value.split()[0]) // 1024
+        elif key == "uptime":
+            metrics.uptime = float(value)
+        elif key == "disk" and value:
+            used, total = value.split()
+            metrics.disk_used = round(int(used) / 1024 ** 2, 2)
+            metrics.disk_total = round(int(total) / 1024 ** 2, 2)
+        elif key == "processes":
+            metrics.processes = int(value)
+        elif key == "users":
+            metrics.users = int(value)
+    if "MemTotal:" in meminfo:
+        metrics.memory_total = meminfo["MemTotal:"]
+        metrics.memory_used = meminfo["MemTotal:"] - meminfo.get("MemAvailable:", 0)
+    return metrics
+
+
+
+def collect_metrics(name, timeout=None):
+    """
+    Collect the CPU, memory, disk, uptime, processes, users and hostname of an instance at once.
+    A single guest-side probe reads /proc directly, replacing the seven `multipass exec` calls
+    of the individual getters.
+
+    Args:
+        name (str): The name of the instance.
+        timeout (float): The deadline of the probe in seconds, no deadline if None.
+
+    Returns:
+        InstanceMetrics: The metrics of the instance, None if the probe failed.
+
+    Raises:
+        subprocess.TimeoutExpired: If the instance did not answer before the deadline.
+
+    Example:
+        >>> collect_metrics("instance_name")
+        InstanceMetrics(name='instance_name', hostname='instance_name', cpu_usage=0.0213, memory_used=183, ...)
+    """
+    log.info(f'Collecting metrics of instance {name}')
+    result = run_guest(name, ["sh", "-c", METRICS_PROBE], timeout=timeout)
+    if result.returncode != 0:
+        logger(instance=name, error=result.stderr)
+        return None
+    metrics = _parse_metrics(name, result.stdout)
+    instance_cache.set(name, "hostname", metrics.hostname)
+    log.info(f'Instance {name} metrics: {metrics}')
+    return metrics
+
+
+
+def collect_fleet_metrics(names=None, workers=8, timeout=10.0):
+    """
+    Collect the metrics of many instances in parallel.
+    Each instance gets its own deadline, a hung guest is reported as timed out
+    instead of blocking the whole sweep.
+
+    Args:
+        names (list): The names of the instances, all running instances if None.
+        workers (int): The maximum number of probes running at the same time, default is 8.
+        timeout (float): The deadline of each probe in seconds, default is 10.
+
+    Returns:
+        FleetMetrics: The metrics of the instances that answered, and the instances that timed out or failed.
+
+    Example:
+        >>> collect_fleet_metrics(workers=16, timeout=5)
+        FleetMetrics(metrics={'instance1': InstanceMetrics(...)}, timed_out=['instance2'], failed=[], duration=5.02)
+    """
+    names = get_running_instances() if names is None else list(names)
+    log.info(f'Collecting metrics of {len(names)} instances with {workers} workers')
+    fleet = FleetMetrics()
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {name: pool.submit(collect_metrics, name, timeout) for name in names}
+        for name, future in futures.items():
+            try:
+                metrics = future.result()
+            except subprocess.TimeoutExpired:
+                log.warning(f'Instance {name} did not answer within {timeout}s')
+                fleet.timed_out.append(name)
+                continue
+            except Exception:
+                log.exception(f'Collecting the metrics of instance {name} failed')
+                fleet.failed.append(name)
+                continue
+            if metrics is None:
+                fleet.failed.append(name)
+            else:
+                fleet.metrics[name] = metrics
+    fleet.duration = round(time.monotonic() - start, 3)
+    log.info(f'Collected metrics of {len(fleet.metrics)}/{len(names)} instances in {fleet.duration}s')
+    return fleet
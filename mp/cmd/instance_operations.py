@@ -7,13 +7,107 @@
 ##
 
 from mp.logger import logger
+from mp.cmd.instance_cache import instance_cache, VOLATILE_FIELDS
+from mp.cmd.instance_info import get_all_instances, fetch_instance_index
+from mp.cmd.admission import admission
+from mp.cmd.guest_channel import run_guest, close_channel
+from mp.cmd.runner import run_multipass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import NamedTuple
+from pathlib import Path
 import subprocess
+import threading
+import fnmatch
 import secrets
 import string
+import shlex
 import logging
+import json
+import time
 
 log = logging.getLogger(__name__)
 
+BULK_TARGET_STATES = {"start": "Running", "stop": "Stopped", "suspend": "Suspended", "delete": None}
+LAUNCH_RECORD_FILE = Path.home() / '.cache' / 'mp' / 'launches.json' # launch time of the instances created by this library
+
+_launch_record_lock = threading.Lock()
+
+
+class InstanceProfile(NamedTuple):
+    """
+    Launch parameters of an instance.
+
+    Attributes:
+        image (str): The image of the instance, e.g. "22.04".
+        cpus (str): The number of CPUs, e.g. "1".
+        memory (str): The amount of memory, e.g. "2G".
+    """
+    image: str = "22.04"
+    cpus: str = "1"
+    memory: str = "2G"
+
+
+@dataclass(slots=True)
+class OperationResult:
+    """
+    Outcome of a lifecycle operation on one instance.
+
+    Attributes:
+        name (str): The name of the instance.
+        ok (bool): True if the operation succeeded.
+        duration (float): The duration of the multipass call in seconds. Instances handled by
+            the same batched call share its duration.
+        error (str): The error reported by multipass, None on success.
+    """
+    name: str
+    ok: bool
+    duration: float
+    error: str = None
+
+
+
+def _load_launch_record():
+    try:
+        return json.loads(LAUNCH_RECORD_FILE.read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+
+def _update_launch_record(update):
+    # the record only serves older_than selections, failing to write it must not fail the operation
+    with _launch_record_lock:
+        record = _load_launch_record()
+        update(record)
+        try:
+            LAUNCH_RECORD_FILE.parent.mkdir(parents=True, exist_ok=True)
+            tmp = LAUNCH_RECORD_FILE.with_suffix('.tmp')
+            tmp.write_text(json.dumps(record))
+            tmp.replace(LAUNCH_RECORD_FILE)
+        except OSError as error:
+            log.warning(f'Could not update the launch record {LAUNCH_RECORD_FILE}: {error}')
+        return record
+
+
+
+def get_launch_time(name):
+    """
+    Get the time at which an instance was launched by this library.
+
+    Args:
+        name (str): The name of the instance.
+
+    Returns:
+        float: The launch time as a UNIX timestamp, None if the instance was not launched by this library.
+
+    Example:
+        >>> get_launch_time("instance_name")
+        1713790800.0
+    """
+    return _load_launch_record().get(name)
+
 
 
 def instance_name_gen():
@@ -33,13 +127,14 @@ def instance_name_gen():
 
 
 
-def exec_command(name, command):
+def exec_command(name, command, timeout=None):
     """
     Execute a command on a specified instance.
 
     Args:
         name (str): The name of the instance on which to execute the command.
-        command (str): The command to execute.
+        command (str | list): The command to execute, a string is split with shell quoting rules.
+        timeout (float): The deadline of the command in seconds, no deadline if None.
 
     Returns:
         bool: True if the command executed successfully, False otherwise.
@@ -49,10 +144,16 @@ def exec_command(name, command):
         True
         >>> exec_command("instance_name", "ls /nonexistent")
         False
+        >>> exec_command("instance_name", "sh -c 'echo $HOME'")
+        True
     """
     log.info(f'Executing command on instance {name}: {command}')
-    command_list = command.split()
-    process = subprocess.run(["multipass", "exec", name, "--"] + command_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    command_list = shlex.split(command) if isinstance(command, str) else list(command)
+    try:
+        process = run_guest(name, command_list, timeout=timeout)
+    except subprocess.TimeoutExpired as error:
+        logger(instance=name, error=f"command {command} timed out after {error.timeout}s")
+        return False
     if process.returncode != 0:
         logger(instance=name, error=process.stderr)
     return process.returncode == 0
@@ -85,16 +186,23 @@ def launch_instance(name="default_name", image="22.04", cpus="1", memory="2G"):
         memory (str): The amount of memory to allocate to the instance.
 
     Returns:
-        bool: True if the instance was created successfully, False otherwise.
+        bool: True if the instance was created successfully, False otherwise or if admission control rejected it.
 
     Example:
         >>> launch_instance("instance_name", "22.04", "1", "2G")
         True
     """
     log.info(f'Launching instance {name} with image {image}, {cpus} CPUs, and {memory} memory')
-    result = subprocess.run(["multipass", "launch", "--name", name, "--cpus", cpus, "--memory", memory, image], capture_output=True, text=True)
+    with admission(name, cpus, memory) as admitted:
+        if not admitted:
+            logger(instance=name, error="warning: not enough host capacity to launch the instance.", status="warning")
+            return False
+        result = run_multipass(["launch", "--name", name, "--cpus", cpus, "--memory", memory, image])
+    instance_cache.invalidate(name)
     if result.returncode != 0:
         logger(instance=name, error=result.stderr)
+    else:
+        _update_launch_record(lambda record: record.update({name: time.time()}))
     return result.returncode == 0
 
 
@@ -114,7 +222,9 @@ def stop_instance(name):
         True
     """
     log.info(f'Stopping instance {name}')
-    result = subprocess.run(["multipass", "stop", name], capture_output=True, text=True)
+    close_channel(name)
+    result = run_multipass(["stop", name])
+    instance_cache.invalidate(name, VOLATILE_FIELDS)
     if result.returncode != 0:
         logger(instance=name, error=result.stderr)
     return result.returncode == 0
@@ -136,7 +246,8 @@ def start_instance(name):
         True
     """
     log.info(f'Starting instance {name}')
-    result = subprocess.run(["multipass", "start", name], capture_output=True, text=True)
+    result = run_multipass(["start", name])
+    instance_cache.invalidate(name, VOLATILE_FIELDS)
     if result.returncode != 0:
         logger(instance=name, error=result.stderr)
     return result.returncode == 0
@@ -158,9 +269,13 @@ def delete_instance(name):
         True
     """
     log.info(f'Deleting instance {name}')
-    result = subprocess.run(["multipass", "delete", name, "--purge"], capture_output=True, text=True)
+    close_channel(name)
+    result = run_multipass(["delete", name, "--purge"])
+    instance_cache.invalidate(name)
     if result.returncode != 0:
         logger(instance=name, error=result.stderr)
+    else:
+        _update_launch_record(lambda record: record.pop(name, None))
     return result.returncode == 0
 
 
@@ -177,9 +292,13 @@ def delete_all_instances():
         True
     """
     log.info('Deleting all instances')
-    result = subprocess.run(["multipass", "delete", "--all", "--purge"], capture_output=True, text=True)
+    close_channel()
+    result = run_multipass(["delete", "--all", "--purge"])
+    instance_cache.clear()
     if result.returncode != 0:
         logger(instance="Delete All Instances", error=result.stderr)
+    else:
+        _update_launch_record(lambda record: record.clear())
     return result.returncode == 0
 
 
@@ -196,48 +315,259 @@ def list_instances():
         ['instance1', 'instance2', 'instance3']
     """
     log.info('Listing all instances')
-    result = subprocess.run(["multipass", "list"], capture_output=True, text=True, check=True)
+    return get_all_instances()
+
+
+
+def _run_one(action, name, options):
+    start = time.monotonic()
+    result = run_multipass([action] + options + [name])
+    instance_cache.invalidate(name, None if action == "delete" else VOLATILE_FIELDS)
+    duration = round(time.monotonic() - start, 3)
     if result.returncode != 0:
-        logger(instance="List Instances", error=result.stderr)
-    return [line.split()[0] for line in result.stdout.split('\n')[2:] if line]
+        logger(instance=name, error=result.stderr)
+        return OperationResult(name, False, duration, result.stderr.strip())
+    return OperationResult(name, True, duration)
+
+
+
+def _run_many(action, names, options=(), workers=8):
+    """
+    Run a lifecycle operation on many instances with a single multipass call.
+    If the batched call fails, the instances that did not reach the target state
+    are retried one by one on a bounded worker pool to attribute the errors.
+
+    Args:
+        action (str): The multipass sub-command: start, stop, suspend or delete.
+        names (list): The names of the instances.
+        options (tuple): The extra options of the sub-command.
+        workers (int): The maximum number of individual retries running at the same time.
+
+    Returns:
+        dict: A dictionary mapping the instance names to their OperationResult.
+    """
+    names = list(dict.fromkeys(names))
+    if not names:
+        return {}
+    log.info(f'Running {action} on instances [{", ".join(names)}]')
+    if action != "start":
+        for name in names:
+            close_channel(name)
+    options = list(options)
+    start = time.monotonic()
+    result = run_multipass([action] + options + names)
+    duration = round(time.monotonic() - start, 3)
+    for name in names:
+        instance_cache.invalidate(name, None if action == "delete" else VOLATILE_FIELDS)
+    if result.returncode == 0:
+        return {name: OperationResult(name, True, duration) for name in names}
+
+    log.warning(f'Batched {action} failed, checking instances one by one: {result.stderr.strip()}')
+    index = fetch_instance_index()
+    target = BULK_TARGET_STATES[action]
+    results, pending = {}, []
+    for name in names:
+        entry = index.by_name.get(name) if index is not None else None
+        if target is None:
+            # without --purge a deleted instance stays listed as Deleted until it is recovered or purged
+            done = entry is None or ("--purge" not in options and entry.state == "Deleted")
+        else:
+            done = entry is not None and entry.state == target
+        if index is not None and done:
+            results[name] = OperationResult(name, True, duration)
+        else:
+            pending.append(name)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for outcome in pool.map(lambda name: _run_one(action, name, options), pending):
+            results[outcome.name] = outcome
+    return {name: results[name] for name in names}
+
+
+
+def start_many(names, workers=8):
+    """
+    Start several instances with a single multipass call.
+
+    Args:
+        names (list): The names of the instances to start.
+        workers (int): The maximum number of individual retries running at the same time when the batched call fails.
+
+    Returns:
+        dict: A dictionary mapping the instance names to their OperationResult.
+
+    Example:
+        >>> start_many(["instance1", "instance2"])
+        {'instance1': OperationResult(name='instance1', ok=True, duration=12.3, error=None), 'instance2': OperationResult(...)}
+    """
+    return _run_many("start", names, workers=workers)
+
+
+
+def stop_many(names, workers=8):
+    """
+    Stop several instances with a single multipass call.
+
+    Args:
+        names (list): The names of the instances to stop.
+        workers (int): The maximum number of individual retries running at the same time when the batched call fails.
+
+    Returns:
+        dict: A dictionary mapping the instance names to their OperationResult.
+
+    Example:
+        >>> stop_many(["instance1", "instance2"])
+        {'instance1': OperationResult(name='instance1', ok=True, duration=4.1, error=None), 'instance2': OperationResult(...)}
+    """
+    return _run_many("stop", names, workers=workers)
+
+
+
+def suspend_many(names, workers=8):
+    """
+    Suspend several instances with a single multipass call.
+
+    Args:
+        names (list): The names of the instances to suspend.
+        workers (int): The maximum number of individual retries running at the same time when the batched call fails.
+
+    Returns:
+        dict: A dictionary mapping the instance names to their OperationResult.
+
+    Example:
+        >>> suspend_many(["instance1", "instance2"])
+        {'instance1': OperationResult(name='instance1', ok=True, duration=3.2, error=None), 'instance2': OperationResult(...)}
+    """
+    return _run_many("suspend", names, workers=workers)
+
+
+
+def delete_many(names, purge=True, workers=8):
+    """
+    Delete several instances with a single multipass call.
+
+    Args:
+        names (list): The names of the instances to delete.
+        purge (bool): Purge the instances, default is True.
+        workers (int): The maximum number of individual retries running at the same time when the batched call fails.
+
+    Returns:
+        dict: A dictionary mapping the instance names to their OperationResult.
+
+    Example:
+        >>> delete_many(["instance1", "instance2"])
+        {'instance1': OperationResult(name='instance1', ok=True, duration=1.8, error=None), 'instance2': OperationResult(...)}
+    """
+    results = _run_many("delete", names, ["--purge"] if purge else [], workers=workers)
+    deleted = [name for name, result in results.items() if result.ok]
+    if purge and deleted:
+        def forget(record):
+            for name in deleted:
+                record.pop(name, None)
+        _update_launch_record(forget)
+    return results
 
 
 
 def stop_all_instances():
     """
-    Stop all instances.
+    Stop all running instances.
 
     Returns:
-        bool: True if all instances were stopped successfully, False otherwise.
+        bool: True if all running instances were stopped successfully, False otherwise or if multipass could not be queried.
 
     Example:
         >>> stop_all_instances()
         True
     """
     log.info('Stopping all instances')
-    instances = list_instances()
-    for instance in instances:
-        stop_instance(instance)
-    return True
+    index = fetch_instance_index()
+    if index is None:
+        return False
+    results = stop_many(index.by_state.get("Running", []))
+    return all(result.ok for result in results.values())
 
 
 
 def start_all_instances():
     """
-    Start all instances.
+    Start all stopped and suspended instances.
 
     Returns:
-        bool: True if all instances were started successfully, False otherwise.
+        bool: True if all stopped and suspended instances were started successfully, False otherwise or if multipass could not be queried.
 
     Example:
         >>> start_all_instances()
         True
     """
     log.info('Starting all instances')
-    instances = list_instances()
-    for instance in instances:
-        start_instance(instance)
-    return True
+    index = fetch_instance_index()
+    if index is None:
+        return False
+    results = start_many(index.by_state.get("Stopped", []) + index.by_state.get("Suspended", []))
+    return all(result.ok for result in results.values())
+
+
+
+def _select_instances(state=None, older_than=None, name_glob=None):
+    # None if the instances could not be listed, nothing can be selected then
+    index = fetch_instance_index()
+    if index is None:
+        return None
+    states = [state] if isinstance(state, str) else state
+    if isinstance(older_than, timedelta):
+        older_than = older_than.total_seconds()
+    launches = _load_launch_record() if older_than is not None else {}
+    now = time.time()
+    selected = []
+    for name, entry in index.by_name.items():
+        if states is not None and entry.state not in states:
+            continue
+        if name_glob is not None and not fnmatch.fnmatchcase(name, name_glob):
+            continue
+        if older_than is not None and (name not in launches or now - launches[name] < older_than):
+            continue
+        selected.append(name)
+    return selected
+
+
+
+def delete_where(state=None, older_than=None, name_glob=None, dry_run=False, match_all=False):
+    """
+    Delete and purge the instances matching all the given criteria.
+    The instances are selected from a single `multipass list` and purged with a single `multipass delete`.
+    At least one criterion is required, deleting every instance must be asked for with match_all=True.
+
+    Args:
+        state (str | list): The state or states of the instances to delete, any state if None.
+        older_than (float | timedelta): The minimum age of the instances, in seconds. The age is only known for
+            the instances launched by this library, other instances never match this criterion.
+        name_glob (str): A shell-style pattern the instance names must match, e.g. "test-*".
+        dry_run (bool): Only return the matching instances without deleting them, default is False.
+        match_all (bool): Select every instance when no criterion is given, default is False.
+
+    Returns:
+        list: The names of the deleted instances, or of the instances that would be deleted with dry_run.
+        None if the instances could not be listed.
+
+    Raises:
+        ValueError: If no criterion is given and match_all is False.
+
+    Example:
+        >>> delete_where(state="Stopped", older_than=timedelta(days=7), dry_run=True)
+        ['instance3', 'instance4']
+        >>> delete_where(name_glob="test-*")
+        ['test-a', 'test-b']
+    """
+    if state is None and older_than is None and name_glob is None and not match_all:
+        raise ValueError("delete_where needs a state, older_than or name_glob criterion, or match_all=True to delete every instance")
+    selected = _select_instances(state, older_than, name_glob)
+    if selected is None:
+        return None
+    log.info(f'{"Would delete" if dry_run else "Deleting"} instances [{", ".join(selected)}]')
+    if dry_run or not selected:
+        return selected
+    results = delete_many(selected)
+    return [name for name, result in results.items() if result.ok]
 
 
 
@@ -246,15 +576,15 @@ def delete_stopped_instances():
     Delete all stopped instances.
 
     Returns:
-        bool: True if all stopped instances were deleted successfully, False otherwise.
+        bool: True if all stopped instances were deleted successfully, False otherwise or if multipass could not be queried.
 
     Example:
         >>> delete_stopped_instances()
         True
     """
     log.info('Deleting all stopped instances')
-    instances = list_instances()
-    for instance in instances:
-        if "Stopped" in subprocess.run(["multipass", "info", instance], capture_output=True, text=True).stdout:
-            delete_instance(instance)
-    return True
\ No newline at end of file
+    selected = _select_instances(state="Stopped")
+    if selected is None:
+        return False
+    results = delete_many(selected)
+    return all(result.ok for result in results.values())
@@ -6,12 +6,27 @@
 ## @julesreyn
 ##
 
-from mp.cmd.instance_operations import instance_name_gen, exec_command
-from mp.cmd.instance_operations import launch_instance
-from mp.cmd.file_operations import put_file
+from mp.cmd.instance_operations import instance_name_gen
+from mp.cmd.instance_operations import launch_instance, InstanceProfile
+from mp.cmd.instance_operations import start_instance, stop_instance, delete_many, OperationResult
+from mp.cmd.instance_info import fetch_instance_index, get_all_instances
+from mp.cmd.instance_cache import instance_cache
+from mp.cmd.runner import run_multipass
+from mp.cmd.admission import admission
+from mp.cmd.instance_exec import ExecBatch
+from mp.cmd.file_operations import put_file, put_tree
+from mp.cmd.warm_pool import WarmPool
+from mp.logger import logger
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from pathlib import Path
 import subprocess
+import threading
+import hashlib
 import socket
 import logging
+import time
+import re
 
 log = logging.getLogger(__name__)
 
@@ -19,26 +34,29 @@ DEFAULT_INSTANCE_IMAGE = "22.04" # available options: 20.04, 22.04, 23.10, daily
 DEFAULT_INSTANCE_VCPUS = "1" # available options: 1, 2, 4, 6, more..
 DEFAULT_INSTANCE_MEMORY = "2G" # available options: 512M, 1G, 2G, 4G, 8G, more..
 
+SETUP_FILES = ["./setup_tools/config.sh", "./setup_tools/update-motd.d"] # content of the golden images, see provisioning_hash
+CONFIG_FILES = ["config.sh", "update-motd.d/00-header", "update-motd.d/10-help-text"] # uploaded from ./setup_tools by upload_config
+
+_warm_pool = None # WarmPool used by init_instance, see enable_warm_pool
+_template_locks = {}
+_template_locks_lock = threading.Lock()
+
 def upload_config(name):
     """
-    Uploads the configuration files to the instance
+    Uploads the configuration files to the instance, in a single tar stream
 
     Args:
         name (str): The name of the instance
 
     Returns:
-        None
+        bool: True if every file was uploaded
 
     Example:
         >>> upload_config("instance_name")
     """
     log.info(f'Uploading configuration files to instance {name}')
-    log.info(f'Uploading config.sh to instance {name}')
-    put_file(name, "./setup_tools/config.sh", "config.sh")
-    log.info(f'Uploading update-motd.d/00-header to instance {name}')
-    put_file(name, "./setup_tools/update-motd.d/00-header", "00-header")
-    log.info(f'Uploading update-motd.d/10-help-text to instance {name}')
-    put_file(name, "./setup_tools/update-motd.d/10-help-text", "10-help-text")
+    results = put_tree(name, "./setup_tools", "/home/ubuntu", include=CONFIG_FILES)
+    return len(results) == len(CONFIG_FILES) and all(result.ok for result in results)
 
 
 def install_prerequisites(name):
@@ -49,24 +67,152 @@ def install_prerequisites(name):
         name (str): The name of the instance
 
     Returns:
-        None
+        bool: True if the configuration files were uploaded, every step of config.sh succeeded and the certificate was uploaded
 
     Example:
         >>> install_prerequisites("instance_name")
+        True
     """
     log.info(f'Installing prerequisites on instance {name}')
-    upload_config(name)
-    log.info(f'Adding execution permissions to config.sh on instance {name}')
-    exec_command(name, "chmod +x /home/ubuntu/config.sh")
+    ok = upload_config(name)
     log.info(f'Executing config.sh on instance {name}')
-    exec_command(name, "bash /home/ubuntu/config.sh")
-    log.info(f'Removing config.sh from instance {name}')
-    exec_command(name, "rm /home/ubuntu/config.sh")
+    batch = ExecBatch(name, stop_on_error=False)
+    batch.add(["chmod", "+x", "/home/ubuntu/config.sh"])
+    batch.add(["bash", "/home/ubuntu/config.sh"])
+    batch.add(["rm", "-r", "/home/ubuntu/config.sh", "/home/ubuntu/update-motd.d"])
+    for result in batch.run(on_line=lambda index, source, line: log.info(f'[{name}] {line}')):
+        ok = ok and result.ok # failures are reported by the batch
     log.info(f'Uploading cloudflared certificat to instance {name}')
-    put_file(name, "~/.cloudflared/cert.pem", "~/.cloudflared/cert.pem")
+    return put_file(name, "~/.cloudflared/cert.pem", "~/.cloudflared/cert.pem") and ok
+
+
+def provisioning_hash(paths=SETUP_FILES):
+    """
+    Hash the content of the provisioning files, directories are hashed recursively
+
+    Args:
+        paths (list): The files and directories to hash, default is config.sh and the motd files
+
+    Returns:
+        str: The first 10 hexadecimal digits of the SHA-256 of the files
+
+    Example:
+        >>> provisioning_hash()
+            "3f2a9c01be"
+    """
+    digest = hashlib.sha256()
+    for path in map(Path, paths):
+        files = sorted(file for file in path.rglob("*") if file.is_file()) if path.is_dir() else [path]
+        for file in files:
+            digest.update(file.as_posix().encode() + b"\0")
+            digest.update(file.read_bytes() + b"\0")
+    return digest.hexdigest()[:10]
+
+
+def _profile_key(profile):
+    return re.sub(r"[^a-z0-9]+", "-", f'{profile.image}-{profile.cpus}c-{profile.memory}'.lower()).strip("-")
 
 
-def init_instance(image=DEFAULT_INSTANCE_IMAGE, cpu=DEFAULT_INSTANCE_VCPUS, memory=DEFAULT_INSTANCE_MEMORY, config=True):
+def template_name(profile, digest=None):
+    """
+    Get the name of the golden image of a profile
+
+    Args:
+        profile (InstanceProfile): The profile of the golden image
+        digest (str): The provisioning hash, default is the hash of the current provisioning files
+
+    Returns:
+        str: The name of the template instance
+
+    Example:
+        >>> template_name(InstanceProfile("22.04", "1", "2G"))
+            "golden-3f2a9c01be-22-04-1c-2g"
+    """
+    return f'golden-{digest or provisioning_hash()}-{_profile_key(profile)}'
+
+
+def ensure_template(profile):
+    """
+    Build the golden image of a profile if it does not exist for the current provisioning files.
+    The template is built under a temporary "<template>-build" name: launched, configured with config.sh,
+    stopped, then cloned to the template name, so an instance with the template name is always fully
+    provisioned. Builds left over by an interrupted process and templates built from older provisioning
+    files are deleted.
+
+    Args:
+        profile (InstanceProfile): The profile of the golden image
+
+    Returns:
+        str: The name of the template instance, None if it could not be built
+
+    Example:
+        >>> ensure_template(InstanceProfile("22.04", "1", "2G"))
+            "golden-3f2a9c01be-22-04-1c-2g"
+    """
+    profile = InstanceProfile(*profile)
+    with _template_locks_lock:
+        lock = _template_locks.setdefault(profile, threading.Lock())
+    with lock:
+        name = template_name(profile)
+        index = fetch_instance_index()
+        if index is None:
+            return None
+        entry = index.by_name.get(name)
+        stale = [instance for instance in index.by_name if instance != name
+                 and re.fullmatch(rf'golden-[0-9a-f]+-{re.escape(_profile_key(profile))}(-build)?', instance)]
+        if stale:
+            log.info(f'Deleting outdated golden images and interrupted builds [{", ".join(stale)}]')
+            delete_many(stale)
+        if entry is None:
+            if not _build_template(name, profile):
+                return None
+        elif entry.state != "Stopped" and not stop_instance(name):
+            return None
+        return name
+
+
+def _build_template(name, profile):
+    build = f'{name}-build'
+    log.info(f'Building golden image {name} as {build}')
+    if not launch_instance(build, profile.image, profile.cpus, profile.memory):
+        return False
+    if not install_prerequisites(build) or not stop_instance(build):
+        log.warning(f'Provisioning of golden image {name} failed, deleting it')
+        delete_many([build])
+        return False
+    result = run_multipass(["clone", build, "--name", name])
+    instance_cache.invalidate(name)
+    if result.returncode != 0:
+        logger(instance=name, error=result.stderr)
+    delete_many([build])
+    return result.returncode == 0
+
+
+def clone_instance(template, name):
+    """
+    Create and start an instance from a stopped template with `multipass clone`
+
+    Args:
+        template (str): The name of the template instance
+        name (str): The name of the new instance
+
+    Returns:
+        bool: True if the instance was cloned and started successfully, False otherwise
+
+    Example:
+        >>> clone_instance("golden-3f2a9c01be-22-04-1c-2g", "instance_name")
+            True
+    """
+    log.info(f'Cloning instance {name} from {template}')
+    result = run_multipass(["clone", template, "--name", name])
+    instance_cache.invalidate(name)
+    if result.returncode != 0:
+        logger(instance=name, error=result.stderr)
+        return False
+    return start_instance(name)
+
+
+def init_instance(image=DEFAULT_INSTANCE_IMAGE, cpu=DEFAULT_INSTANCE_VCPUS, memory=DEFAULT_INSTANCE_MEMORY, config=True, golden=False):
     """
     Initializes a new instance
 
@@ -75,6 +221,8 @@ def init_instance(image=DEFAULT_INSTANCE_IMAGE, cpu=DEFAULT_INSTANCE_VCPUS, memo
         cpu (str): The number of CPUs, default is "1"
         memory (str): The amount of memory, default is "2G"
         config (bool): Configures the instance with multipass requirements, default is True
+        golden (bool): Clones the configured instance from the golden image of the profile instead of
+            running config.sh, the golden image is built first if needed, default is False
     Returns:
         str: The name of the instance
 
@@ -83,7 +231,15 @@ def init_instance(image=DEFAULT_INSTANCE_IMAGE, cpu=DEFAULT_INSTANCE_VCPUS, memo
             "instance_name"
     """
     log.info("Starting instance initialization")
+    if config and _warm_pool is not None:
+        name = _warm_pool.claim(InstanceProfile(image, cpu, memory))
+        if name is not None:
+            log.info(f'Using warm instance {name}')
+            return name
     name = instance_name_gen()
+    if config and golden:
+        _provision_instance(name, InstanceProfile(image, cpu, memory), golden)
+        return name
     launch_instance(name, image, cpu, memory)
     if config:
         log.info(f'Configuring instance {name} with multipass requirements')
@@ -91,6 +247,125 @@ def init_instance(image=DEFAULT_INSTANCE_IMAGE, cpu=DEFAULT_INSTANCE_VCPUS, memo
     return name
 
 
+def _provision_instance(name, profile, golden=False):
+    if golden:
+        template = ensure_template(profile)
+        if template is not None:
+            with admission(name, profile.cpus, profile.memory) as admitted:
+                if not admitted:
+                    logger(instance=name, error="warning: not enough host capacity to clone the instance.", status="warning")
+                    return False
+                return clone_instance(template, name)
+        log.warning(f'Golden image of profile {profile} unavailable, provisioning {name} from scratch')
+    if not launch_instance(name, profile.image, profile.cpus, profile.memory):
+        return False
+    return install_prerequisites(name)
+
+
+def _launch_fleet_member(name, profile, config, golden):
+    start = time.monotonic()
+    try:
+        if config:
+            ok = _provision_instance(name, profile, golden)
+        else:
+            ok = launch_instance(name, profile.image, profile.cpus, profile.memory)
+        error = None if ok else "launch or provisioning failed, see the instance logs"
+    except Exception as exc:
+        log.exception(f'Launch of instance {name} failed')
+        ok, error = False, str(exc)
+    return OperationResult(name, ok, round(time.monotonic() - start, 3), error)
+
+
+def launch_fleet(count, profile=InstanceProfile(DEFAULT_INSTANCE_IMAGE, DEFAULT_INSTANCE_VCPUS, DEFAULT_INSTANCE_MEMORY),
+                 concurrency=4, config=True, golden=False, on_progress=None):
+    """
+    Launches and configures several instances in parallel
+
+    Args:
+        count (int): The number of instances to launch
+        profile (InstanceProfile): The image, CPUs and memory of the instances, default is the default profile
+        concurrency (int): The maximum number of instances launched at the same time, default is 4
+        config (bool): Configures the instances with multipass requirements, default is True
+        golden (bool): Clones the configured instances from the golden image of the profile, default is False
+        on_progress (callable): Called with (OperationResult, done, total) each time an instance is ready or failed
+
+    Returns:
+        dict: A dictionary mapping the instance names to their OperationResult, in launch order
+
+    Example:
+        >>> launch_fleet(3, InstanceProfile("22.04", "1", "2G"), concurrency=2)
+            {'xzvyan': OperationResult(name='xzvyan', ok=True, duration=95.2, error=None), ...}
+    """
+    profile = InstanceProfile(*profile)
+    taken = set(get_all_instances())
+    names = []
+    while len(names) < count:
+        name = instance_name_gen()
+        if name not in taken:
+            taken.add(name)
+            names.append(name)
+    log.info(f'Launching fleet of {count} instances with profile {profile}, {concurrency} at a time')
+    if golden and config:
+        ensure_template(profile)
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        futures = [pool.submit(_launch_fleet_member, name, profile, config, golden) for name in names]
+        for future in as_completed(futures):
+            result = future.result()
+            results[result.name] = result
+            log.info(f'Instance {result.name} {"ready" if result.ok else "failed"} in {result.duration}s ({len(results)}/{count})')
+            if on_progress is not None:
+                on_progress(result, len(results), count)
+    return {name: results[name] for name in names}
+
+
+def enable_warm_pool(profiles=(InstanceProfile(DEFAULT_INSTANCE_IMAGE, DEFAULT_INSTANCE_VCPUS, DEFAULT_INSTANCE_MEMORY),),
+                     size=2, max_idle_age=86400.0, refill_concurrency=2, golden=False):
+    """
+    Keep provisioned instances ready so that init_instance returns immediately.
+
+    Args:
+        profiles (list): The InstanceProfile list to keep ready, default is the default image, CPUs and memory.
+        size (int): The number of idle instances to keep per profile, default is 2.
+        max_idle_age (float): The maximum idle time of an instance in seconds before it is replaced, default is 86400 (1 day).
+        refill_concurrency (int): The maximum number of instances provisioned at the same time, default is 2.
+        golden (bool): Provisions the pool by cloning the golden image of each profile, default is False.
+
+    Returns:
+        WarmPool: The pool used by init_instance.
+
+    Example:
+        >>> enable_warm_pool([InstanceProfile("22.04", "2", "4G")], size=3)
+        >>> init_instance("22.04", "2", "4G")
+            "instance_name"
+    """
+    global _warm_pool
+    disable_warm_pool()
+    log.info(f'Enabling warm pool of {size} instances for profiles {list(profiles)}')
+    _warm_pool = WarmPool(partial(_provision_instance, golden=golden), size, max_idle_age, refill_concurrency)
+    for profile in profiles:
+        _warm_pool.warm(InstanceProfile(*profile))
+    _warm_pool.start()
+    return _warm_pool
+
+
+def disable_warm_pool(drain=True):
+    """
+    Stop the warm pool, init_instance provisions new instances again.
+
+    Args:
+        drain (bool): Delete the idle instances of the pool, default is True.
+
+    Example:
+        >>> disable_warm_pool()
+    """
+    global _warm_pool
+    if _warm_pool is not None:
+        log.info('Disabling warm pool')
+        _warm_pool.stop(drain)
+        _warm_pool = None
+
+
 def check_server_virtualization():
     """
     Check if the server supports virtualization, has Multipass installed, and has network access
@@ -0,0 +1,216 @@
+##
+## Multipass Library - 2024
+## mp [Ubuntu:22.04]
+## File description:
+## multipass instance library for instance state watching
+## @julesreyn
+##
+
+from mp.cmd.instance_cache import instance_cache
+from mp.cmd.instance_info import fetch_instance_index
+from dataclasses import dataclass, field
+import threading
+import asyncio
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+ADDED = "added"
+REMOVED = "removed"
+STATE_CHANGED = "state_changed"
+IP_CHANGED = "ip_changed"
+
+
+@dataclass(slots=True, frozen=True)
+class InstanceEvent:
+    """
+    Change detected on an instance between two polls.
+
+    Attributes:
+        kind (str): ADDED, REMOVED, STATE_CHANGED or IP_CHANGED.
+        name (str): The name of the instance.
+        old: The previous state or IPv4 addresses, None for ADDED events.
+        new: The new state or IPv4 addresses, None for REMOVED events.
+        timestamp (float): The time at which the change was detected.
+    """
+    kind: str
+    name: str
+    old: object = None
+    new: object = None
+    timestamp: float = field(default_factory=time.time)
+
+
+def diff_indexes(previous, current):
+    """
+    Compute the events between two instance indexes.
+
+    Args:
+        previous (InstanceIndex): The index of the previous poll.
+        current (InstanceIndex): The index of the current poll.
+
+    Returns:
+        list: The InstanceEvent list, in instance order.
+    """
+    events = []
+    for name, entry in current.by_name.items():
+        before = previous.by_name.get(name)
+        if before is None:
+            events.append(InstanceEvent(ADDED, name, None, entry.state))
+            continue
+        if before.state != entry.state:
+            events.append(InstanceEvent(STATE_CHANGED, name, before.state, entry.state))
+        if before.ipv4 != entry.ipv4:
+            events.append(InstanceEvent(IP_CHANGED, name, before.ipv4, entry.ipv4))
+    for name, entry in previous.by_name.items():
+        if name not in current.by_name:
+            events.append(InstanceEvent(REMOVED, name, entry.state, None))
+    return events
+
+
+class InstanceWatcher:
+    """
+    Watch the whole fleet with a single `multipass list` per poll and emit change events.
+
+    The poll interval adapts to the activity: it drops back to min_interval as soon as
+    a change is seen, and grows by the backoff factor up to max_interval while nothing changes.
+
+    Args:
+        min_interval (float): The shortest delay between two polls in seconds, default is 1.
+        max_interval (float): The longest delay between two polls in seconds, default is 30.
+        backoff (float): The growth factor of the interval while the fleet is quiet, default is 1.5.
+
+    Example:
+        >>> watcher = InstanceWatcher()
+        >>> watcher.subscribe(lambda event: print(event.kind, event.name), kinds=[STATE_CHANGED])
+        >>> watcher.start()
+        state_changed instance_name
+        >>> watcher.stop()
+    """
+
+    def __init__(self, min_interval=1.0, max_interval=30.0, backoff=1.5):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+        self.index = None
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def subscribe(self, callback, kinds=None):
+        """
+        Register a callback called with each InstanceEvent.
+
+        Args:
+            callback (callable): The function to call, it runs on the watcher thread.
+            kinds (list): The event kinds to receive, all of them if None.
+
+        Returns:
+            callable: The callback, so subscribe can be used as a decorator.
+        """
+        with self._lock:
+            self._subscribers.append((callback, set(kinds) if kinds else None))
+        return callback
+
+    def unsubscribe(self, callback):
+        """
+        Unregister a callback.
+
+        Args:
+            callback (callable): The function given to subscribe.
+        """
+        with self._lock:
+            self._subscribers = [(cb, kinds) for cb, kinds in self._subscribers if cb is not callback]
+
+    def _emit(self, event):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for callback, kinds in subscribers:
+            if kinds is not None and event.kind not in kinds:
+                continue
+            try:
+                callback(event)
+            except Exception:
+                log.exception(f'Watcher callback {callback!r} failed on {event}')
+
+    def poll(self):
+        """
+        Poll the fleet once, emit and return the changes since the previous poll.
+        The first poll only records the baseline and returns no event.
+
+        Returns:
+            list: The InstanceEvent list, empty if nothing changed or multipass could not be queried.
+        """
+        index = fetch_instance_index()
+        if index is None:
+            return []
+        instance_cache.set(None, "index", index)
+        previous, self.index = self.index, index
+        if previous is None:
+            return []
+        events = diff_indexes(previous, index)
+        for event in events:
+            log.info(f'Instance {event.name} {event.kind}: {event.old} -> {event.new}')
+            self._emit(event)
+        return events
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                events = self.poll()
+            except Exception:
+                log.exception('Instance watcher poll failed')
+                events = []
+            self.interval = self.min_interval if events else min(self.max_interval, self.interval * self.backoff)
+            self._stopped.wait(self.interval)
+
+    def start(self):
+        """Start polling on a background thread."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        log.info(f'Starting instance watcher every {self.min_interval}s to {self.max_interval}s')
+        self._stopped.clear()
+        self.interval = self.min_interval
+        self._thread = threading.Thread(target=self._run, name="mp-instance-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread."""
+        log.info('Stopping instance watcher')
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    async def events(self, kinds=None):
+        """
+        Iterate asynchronously over the events, the watcher must be started.
+
+        Args:
+            kinds (list): The event kinds to receive, all of them if None.
+
+        Example:
+            >>> async for event in watcher.events():
+            ...     print(event)
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+
+        def forward(event):
+            loop.call_soon_threadsafe(queue.put_nowait, event)
+
+        self.subscribe(forward, kinds)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self.unsubscribe(forward)
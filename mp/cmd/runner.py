@@ -0,0 +1,387 @@
+##
+## Multipass Library - 2024
+## mp [Ubuntu:22.04]
+## File description:
+## multipass instance library for instrumented multipass command execution
+## @julesreyn
+##
+
+from mp.backends import get_backend
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+import subprocess
+import threading
+import logging
+import bisect
+import time
+
+log = logging.getLogger(__name__)
+
+HISTOGRAM_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0) # upper bounds in seconds, +Inf is implicit
+TIMEOUT_CODE = 124 # exit code of the commands cut by the runner default timeout, as timeout(1) does
+VALUE_OPTIONS = ("--format", "--name", "-n", "--cpus", "-c", "--memory", "-m", "--disk", "-d", "--timeout", "-t")
+
+
+@dataclass(slots=True)
+class CommandCall:
+    """
+    One multipass invocation, filled in as it runs and handed to the runner hooks.
+
+    Attributes:
+        subcommand (str): The multipass sub-command, e.g. "exec".
+        args (list): The arguments of the multipass command.
+        instance (str): The target instance, None for fleet-wide or multi-instance commands.
+        started (float): The wall-clock start time (time.time()).
+        duration (float): The duration in seconds, None while running.
+        returncode (int): The exit code, None while running or if the command timed out.
+        output_bytes (int): The size of stdout and stderr.
+        timed_out (bool): True if the command was killed at its deadline.
+        error (Exception): The exception raised by the backend, if any.
+    """
+    subcommand: str
+    args: list
+    instance: str = None
+    started: float = 0.0
+    duration: float = None
+    returncode: int = None
+    output_bytes: int = 0
+    timed_out: bool = False
+    error: Exception = None
+    _start: float = 0.0
+
+    @property
+    def ok(self):
+        """True if the command exited with code 0."""
+        return self.returncode == 0
+
+
+@dataclass(slots=True)
+class LatencyHistogram:
+    """
+    Latency distribution of a series of commands.
+
+    Attributes:
+        buckets (list): The number of observations per bucket of HISTOGRAM_BUCKETS, plus one for +Inf.
+        count (int): The number of commands.
+        errors (int): The number of commands that exited with a non-zero code or raised.
+        timeouts (int): The number of commands killed at their deadline.
+        total (float): The sum of the durations in seconds.
+        max (float): The longest duration in seconds.
+        output_bytes (int): The total size of the outputs.
+    """
+    buckets: list = field(default_factory=lambda: [0] * (len(HISTOGRAM_BUCKETS) + 1))
+    count: int = 0
+    errors: int = 0
+    timeouts: int = 0
+    total: float = 0.0
+    max: float = 0.0
+    output_bytes: int = 0
+
+    def observe(self, call):
+        self.buckets[bisect.bisect_left(HISTOGRAM_BUCKETS, call.duration)] += 1
+        self.count += 1
+        self.errors += not call.ok and not call.timed_out
+        self.timeouts += call.timed_out
+        self.total += call.duration
+        self.max = max(self.max, call.duration)
+        self.output_bytes += call.output_bytes
+
+    def quantile(self, q):
+        """
+        Estimate a quantile from the buckets.
+
+        Args:
+            q (float): The quantile, e.g. 0.99.
+
+        Returns:
+            float: The upper bound of the bucket holding the quantile, the max duration for the +Inf bucket.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(HISTOGRAM_BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return round(min(bound, self.max), 3)
+        return round(self.max, 3)
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "total": round(self.total, 3),
+            "mean": round(self.total / self.count, 3) if self.count else None,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "max": round(self.max, 3),
+            "output_bytes": self.output_bytes,
+            "buckets": dict(zip(HISTOGRAM_BUCKETS + (float("inf"),), self.buckets)),
+        }
+
+
+class CommandRunner:
+    """
+    Single entry point of the multipass invocations of mp.
+
+    Every command is timed and recorded in per sub-command and per instance latency histograms,
+    goes through the pre and post hooks, and is bounded by the concurrency limit and default timeout.
+
+    Args:
+        max_concurrency (int): The maximum number of multipass commands running at the same time, no limit if None.
+        default_timeout (float): The deadline of the commands run without a timeout in seconds, no deadline if None.
+            A command cut by this deadline fails with the TIMEOUT_CODE exit code instead of raising.
+
+    Example:
+        >>> runner.run(["list", "--format", "json"]).returncode
+        0
+        >>> runner.stats()["commands"]["list"]["count"]
+        1
+    """
+
+    def __init__(self, max_concurrency=None, default_timeout=None):
+        self.default_timeout = default_timeout
+        self._slots = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+        self._commands = {}
+        self._instances = {}
+        self._pre_hooks = []
+        self._post_hooks = []
+        self._lock = threading.Lock()
+
+    def configure(self, max_concurrency=None, default_timeout=None):
+        """
+        Change the concurrency limit and the default timeout.
+
+        Args:
+            max_concurrency (int): The maximum number of multipass commands running at the same time, no limit if None.
+            default_timeout (float): The deadline of the commands run without a timeout in seconds, no deadline if None.
+                A command cut by this deadline fails with the TIMEOUT_CODE exit code instead of raising,
+                so the helpers that do not pass a timeout report it like any other failure.
+        """
+        self.default_timeout = default_timeout
+        self._slots = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+
+    def add_hook(self, pre=None, post=None):
+        """
+        Register callbacks run around every multipass command.
+        Exceptions raised by a hook are logged and ignored.
+
+        Args:
+            pre (callable): Called with the CommandCall before the command starts.
+            post (callable): Called with the completed CommandCall.
+        """
+        with self._lock:
+            if pre is not None:
+                self._pre_hooks.append(pre)
+            if post is not None:
+                self._post_hooks.append(post)
+
+    def remove_hook(self, pre=None, post=None):
+        """
+        Unregister callbacks registered with add_hook.
+
+        Args:
+            pre (callable): The pre hook to remove.
+            post (callable): The post hook to remove.
+        """
+        with self._lock:
+            if pre in self._pre_hooks:
+                self._pre_hooks.remove(pre)
+            if post in self._post_hooks:
+                self._post_hooks.remove(post)
+
+    def _run_hooks(self, hooks, call):
+        for hook in list(hooks):
+            try:
+                hook(call)
+            except Exception:
+                log.exception(f'Runner hook {hook!r} failed')
+
+    def start(self, args, instance=None):
+        """
+        Open the record of a command started outside of run, e.g. a streamed exec.
+
+        Args:
+            args (list): The arguments of the multipass command.
+            instance (str): The target instance, guessed from the arguments if None.
+
+        Returns:
+            CommandCall: The record to close with finish.
+        """
+        args = list(args)
+        call = CommandCall(args[0] if args else "", args, instance or _guess_instance(args), time.time(), _start=time.monotonic())
+        self._run_hooks(self._pre_hooks, call)
+        return call
+
+    def finish(self, call, returncode=None, output_bytes=0, timed_out=False, error=None):
+        """
+        Close the record of a command and add it to the histograms.
+
+        Args:
+            call (CommandCall): The record returned by start.
+            returncode (int): The exit code of the command.
+            output_bytes (int): The size of stdout and stderr.
+            timed_out (bool): True if the command was killed at its deadline.
+            error (Exception): The exception raised while running the command.
+        """
+        call.duration = time.monotonic() - call._start
+        call.returncode = returncode
+        call.output_bytes = output_bytes
+        call.timed_out = timed_out
+        call.error = error
+        with self._lock:
+            self._commands.setdefault(call.subcommand, LatencyHistogram()).observe(call)
+            if call.instance is not None:
+                self._instances.setdefault(call.instance, LatencyHistogram()).observe(call)
+        self._run_hooks(self._post_hooks, call)
+
+    def run(self, args, instance=None, input=None, timeout=None):
+        """
+        Run a multipass command on the current backend.
+
+        Args:
+            args (list): The arguments of the multipass command, e.g. ["start", "instance_name"].
+            instance (str): The target instance, guessed from the arguments if None.
+            input (str): The data sent to the standard input of the command.
+            timeout (float): The deadline of the command in seconds, the default timeout if None.
+
+        Returns:
+            subprocess.CompletedProcess: The exit code and the text output of the command. A command cut by
+            the default timeout exits with TIMEOUT_CODE.
+
+        Raises:
+            subprocess.TimeoutExpired: If the command did not finish before an explicit timeout.
+        """
+        explicit = timeout is not None
+        timeout = self.default_timeout if timeout is None else timeout
+        slots = self._slots
+        with slots if slots is not None else nullcontext():
+            call = self.start(args, instance)
+            try:
+                result = get_backend().run(call.args, input=input, timeout=timeout)
+            except subprocess.TimeoutExpired:
+                self.finish(call, timed_out=True)
+                if explicit:
+                    raise
+                log.warning(f'multipass {call.subcommand} timed out after the default timeout of {timeout}s')
+                return subprocess.CompletedProcess(["multipass"] + call.args, TIMEOUT_CODE, "", f'multipass {call.subcommand} timed out after {timeout}s\n')
+            except Exception as error:
+                self.finish(call, error=error)
+                raise
+        self.finish(call, result.returncode, len(result.stdout or "") + len(result.stderr or ""))
+        return result
+
+    def popen(self, args, instance=None, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=False):
+        """
+        Start a multipass command on the current backend without waiting for it, e.g. a streamed exec.
+        It is not bounded by the concurrency limit nor the default timeout, the caller closes its record with finish.
+
+        Args:
+            args (list): The arguments of the multipass command.
+            instance (str): The target instance, guessed from the arguments if None.
+            stdin (int): subprocess.PIPE or subprocess.DEVNULL, default is subprocess.DEVNULL.
+            stdout (int): subprocess.PIPE or subprocess.DEVNULL, default is subprocess.PIPE.
+            stderr (int): subprocess.PIPE or subprocess.DEVNULL, default is subprocess.PIPE.
+            text (bool): Open the pipes in text mode, line buffered, default is False.
+
+        Returns:
+            tuple: The running process (subprocess.Popen or an object with the same interface) and its CommandCall.
+
+        Raises:
+            OSError: If the process cannot be started, its record is already closed.
+
+        Example:
+            >>> process, call = runner.popen(["exec", "instance_name", "--", "tar", "-c", "-f", "-", "."])
+            >>> data = process.stdout.read()
+            >>> runner.finish(call, process.wait(), len(data))
+        """
+        call = self.start(args, instance)
+        try:
+            process = get_backend().popen(call.args, stdin=stdin, stdout=stdout, stderr=stderr, text=text)
+        except Exception as error: # e.g. multipass is not on the PATH, the record is closed before raising
+            self.finish(call, error=error)
+            raise
+        return process, call
+
+    def stats(self):
+        """
+        Get the latency statistics of the commands run so far.
+
+        Returns:
+            dict: {"commands": {subcommand: summary}, "instances": {name: summary}} where each summary holds
+            count, errors, timeouts, total, mean, p50, p90, p99, max (seconds), output_bytes and buckets.
+        """
+        with self._lock:
+            return {
+                "commands": {subcommand: histogram.summary() for subcommand, histogram in self._commands.items()},
+                "instances": {name: histogram.summary() for name, histogram in self._instances.items()},
+            }
+
+    def reset(self):
+        """Forget the recorded commands."""
+        with self._lock:
+            self._commands.clear()
+            self._instances.clear()
+
+
+
+def _guess_instance(args):
+    if not args:
+        return None
+    if args[0] == "launch":
+        return next((args[index + 1] for index, arg in enumerate(args[:-1]) if arg in ("--name", "-n")), None)
+    if args[0] in ("transfer", "mount"):
+        names = {arg.split(":", 1)[0] for arg in args[1:] if ":" in arg}
+        return names.pop() if len(names) == 1 else None
+    positional = []
+    for index, arg in enumerate(args[1:], 1):
+        if arg == "--":
+            break
+        if not arg.startswith("-") and args[index - 1] not in VALUE_OPTIONS:
+            positional.append(arg.split(":", 1)[0])
+    return positional[0] if len(positional) == 1 else None
+
+
+
+runner = CommandRunner()
+
+
+def run_multipass(args, instance=None, input=None, timeout=None):
+    """
+    Run a multipass command through the instrumented runner.
+
+    Args:
+        args (list): The arguments of the multipass command, e.g. ["start", "instance_name"].
+        instance (str): The target instance, guessed from the arguments if None.
+        input (str): The data sent to the standard input of the command.
+        timeout (float): The deadline of the command in seconds, the runner default if None.
+
+    Returns:
+        subprocess.CompletedProcess: The exit code and the text output of the command. A command cut by
+        the runner default timeout exits with TIMEOUT_CODE.
+
+    Raises:
+        subprocess.TimeoutExpired: If the command did not finish before an explicit timeout.
+
+    Example:
+        >>> run_multipass(["stop", "instance_name"]).returncode
+        0
+    """
+    return runner.run(args, instance, input, timeout)
+
+
+
+def stats():
+    """
+    Get the latency statistics of the multipass commands run by mp.
+
+    Returns:
+        dict: {"commands": {subcommand: summary}, "instances": {name: summary}}.
+
+    Example:
+        >>> stats()["commands"]["exec"]
+        {'count': 42, 'errors': 1, 'timeouts': 0, 'total': 12.6, 'mean': 0.3, 'p50': 0.25, 'p90': 0.5, 'p99': 1.0, ...}
+    """
+    return runner.stats()
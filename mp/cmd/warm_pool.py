@@ -0,0 +1,310 @@
+##
+## Multipass Library - 2024
+## mp [Ubuntu:22.04]
+## File description:
+## multipass instance library for pools of pre-provisioned instances
+## @julesreyn
+##
+
+from mp.cmd.instance_operations import instance_name_gen, delete_instance, delete_many
+from mp.cmd.instance_info import fetch_instance_index
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from pathlib import Path
+import threading
+import logging
+import json
+import time
+import os
+
+log = logging.getLogger(__name__)
+
+WARM_PREFIX = "warm-" # name prefix of the pool instances, so that they are told apart from the user instances
+WARM_POOL_RECORD = Path.home() / '.cache' / 'mp' / 'warm_pool.json' # pool instances of every process: profile, owner pid, ready time
+
+_record_lock = threading.Lock()
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class WarmPool:
+    """
+    Keep provisioned idle instances ready to be handed out, per instance profile.
+
+    A profile is an InstanceProfile (image, cpus, memory). Each profile is refilled up to `size`
+    idle instances on a bounded worker pool. Idle instances older than `max_idle_age` are deleted
+    and replaced, so handed out instances are never stale.
+
+    Pool instances are named "warm-<random>" and recorded in `record` with their profile and the pid
+    of their process. When a process exits without draining its pool, the next pool adopts its ready
+    instances of the warmed profiles and deletes the other ones when it starts.
+
+    Args:
+        provision (callable): Called with (name, profile) to create and configure an instance, returns True on success.
+        size (int): The number of idle instances to keep per profile, default is 2.
+        max_idle_age (float): The maximum idle time of an instance in seconds, default is 86400 (1 day).
+        refill_concurrency (int): The maximum number of instances provisioned at the same time, default is 2.
+        check_interval (float): The delay between two recycling checks in seconds, default is 60.
+        record (Path): The file recording the pool instances, default is ~/.cache/mp/warm_pool.json.
+
+    Example:
+        >>> pool = WarmPool(provision, size=3)
+        >>> pool.warm(InstanceProfile("22.04", "1", "2G"))
+        >>> pool.start()
+        >>> pool.claim(InstanceProfile("22.04", "1", "2G"))
+        'warm-xzvyan'
+    """
+
+    def __init__(self, provision, size=2, max_idle_age=86400.0, refill_concurrency=2, check_interval=60.0, record=WARM_POOL_RECORD):
+        self.provision = provision
+        self.size = size
+        self.max_idle_age = max_idle_age
+        self.refill_concurrency = refill_concurrency
+        self.check_interval = check_interval
+        self.record = Path(record)
+        self._idle = {}
+        self._filling = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, refill_concurrency), thread_name_prefix="mp-warm-pool")
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _update_record(self, update=None):
+        # the record only serves to find the instances of exited processes, failing to write it must not fail the pool
+        with _record_lock:
+            try:
+                record = json.loads(self.record.read_text())
+            except (OSError, ValueError):
+                record = {}
+            if update is None:
+                return record
+            update(record)
+            try:
+                self.record.parent.mkdir(parents=True, exist_ok=True)
+                tmp = self.record.with_suffix('.tmp')
+                tmp.write_text(json.dumps(record))
+                tmp.replace(self.record)
+            except OSError as error:
+                log.warning(f'Could not update the warm pool record {self.record}: {error}')
+            return record
+
+    def _forget(self, names):
+        def forget(record):
+            for name in names:
+                record.pop(name, None)
+        if names:
+            self._update_record(forget)
+
+    def _update_entries(self, names, **fields):
+        def update(record):
+            for name in names:
+                if name in record:
+                    record[name].update(fields)
+        self._update_record(update)
+
+    def _orphans(self):
+        # instances recorded by processes that exited
+        return {name: entry for name, entry in self._update_record().items() if not _alive(entry.get("pid", 0))}
+
+    def warm(self, profile):
+        """
+        Register a profile, adopt the ready instances of the profile left by exited processes and start filling its pool.
+
+        Args:
+            profile (InstanceProfile): The profile of the instances to keep ready.
+        """
+        with self._lock:
+            self._idle.setdefault(profile, deque())
+            self._filling.setdefault(profile, 0)
+        orphans = {name: entry for name, entry in self._orphans().items()
+                   if entry.get("profile") == list(profile) and entry.get("ready_at") is not None}
+        index = fetch_instance_index() if orphans else None
+        if index is not None:
+            adopted = [name for name in orphans if getattr(index.by_name.get(name), "state", None) == "Running"]
+            if adopted:
+                log.info(f'Adopting warm instances [{", ".join(adopted)}] for profile {profile}')
+                with self._lock:
+                    self._idle[profile].extend((name, orphans[name]["ready_at"]) for name in adopted)
+                self._update_entries(adopted, pid=os.getpid())
+        self.refill(profile)
+
+    def reclaim(self):
+        """Delete the pool instances left by exited processes that were not adopted by warm."""
+        orphans = self._orphans()
+        if not orphans:
+            return
+        index = fetch_instance_index()
+        if index is None:
+            return
+        leaked = [name for name in orphans if name in index.by_name]
+        if leaked:
+            log.info(f'Deleting warm instances left by exited processes [{", ".join(leaked)}]')
+            leaked = [name for name, result in delete_many(leaked).items() if result.ok]
+        self._forget([name for name in orphans if name not in index.by_name] + leaked)
+
+    def claim(self, profile):
+        """
+        Hand out an idle instance of a profile and trigger a refill.
+        The instance is checked to still exist and be running, then removed from the pool,
+        it will never be handed out again.
+
+        Args:
+            profile (InstanceProfile): The profile of the wanted instance.
+
+        Returns:
+            str: The name of the instance, None if no instance of the profile is ready.
+        """
+        expired, lost = [], []
+        name = None
+        index = None
+        while name is None:
+            with self._lock:
+                idle = self._idle.get(profile)
+                candidate = None
+                while idle:
+                    candidate, ready_at = idle.popleft()
+                    if time.time() - ready_at <= self.max_idle_age:
+                        break
+                    expired.append(candidate)
+                    candidate = None
+            if candidate is None:
+                break
+            index = index or fetch_instance_index()
+            if index is None: # cannot be checked, the instance stays in the pool
+                with self._lock:
+                    self._idle.setdefault(profile, deque()).appendleft((candidate, ready_at))
+                break
+            state = getattr(index.by_name.get(candidate), "state", None)
+            if state == "Running":
+                name = candidate
+            else:
+                log.warning(f'Warm instance {candidate} is {state or "gone"}, dropping it from the pool')
+                (expired if state is not None else lost).append(candidate)
+        if expired:
+            delete_many(expired)
+        self._forget(expired + lost + ([name] if name else []))
+        if profile in self._idle:
+            self.refill(profile)
+        log.info(f'Warm pool {"handed out " + name if name else "has no ready instance"} for profile {profile}')
+        return name
+
+    def refill(self, profile):
+        """
+        Provision instances of a profile until the pool holds `size` idle or in-flight instances.
+
+        Args:
+            profile (InstanceProfile): The profile to refill.
+        """
+        with self._lock:
+            if self._stopped.is_set():
+                return
+            missing = self.size - len(self._idle.get(profile, ())) - self._filling.get(profile, 0)
+            self._filling[profile] = self._filling.get(profile, 0) + max(0, missing)
+        for submitted in range(max(0, missing)):
+            try:
+                self._executor.submit(self._fill_one, profile)
+            except RuntimeError: # the pool was stopped in the meantime
+                with self._lock:
+                    self._unfill(profile, missing - submitted)
+                return
+
+    def _unfill(self, profile, count):
+        # called with the lock held, stop() may have cleared the counters in the meantime
+        if profile in self._filling:
+            self._filling[profile] -= count
+
+    def _fill_one(self, profile):
+        if self._stopped.is_set():
+            with self._lock:
+                self._unfill(profile, 1)
+            return
+        name = f'{WARM_PREFIX}{instance_name_gen()}'
+        pid = os.getpid()
+        self._update_record(lambda record: record.update({name: {"profile": list(profile), "pid": pid, "ready_at": None}}))
+        try:
+            log.info(f'Provisioning warm instance {name} for profile {profile}')
+            ok = self.provision(name, profile)
+        except Exception:
+            log.exception(f'Provisioning of warm instance {name} failed')
+            ok = False
+        ready_at = time.time()
+        with self._lock:
+            self._unfill(profile, 1)
+            ready = ok and not self._stopped.is_set()
+            if ready:
+                self._idle.setdefault(profile, deque()).append((name, ready_at))
+        if ready:
+            self._update_entries([name], ready_at=ready_at)
+            return
+        if delete_instance(name):
+            self._forget([name])
+
+    def recycle(self):
+        """Delete the idle instances older than max_idle_age and refill every profile."""
+        expired = []
+        with self._lock:
+            for idle in self._idle.values():
+                while idle and time.time() - idle[0][1] > self.max_idle_age:
+                    expired.append(idle.popleft()[0])
+            profiles = list(self._idle)
+        if expired:
+            log.info(f'Recycling expired warm instances [{", ".join(expired)}]')
+            delete_many(expired)
+            self._forget(expired)
+        for profile in profiles:
+            self.refill(profile)
+
+    def stats(self):
+        """
+        Get the number of idle and in-flight instances of each profile.
+
+        Returns:
+            dict: A dictionary mapping the profiles to {"idle": int, "filling": int}.
+        """
+        with self._lock:
+            return {profile: {"idle": len(idle), "filling": self._filling.get(profile, 0)} for profile, idle in self._idle.items()}
+
+    def _run(self):
+        while not self._stopped.wait(self.check_interval):
+            try:
+                self.recycle()
+            except Exception:
+                log.exception('Warm pool recycling failed')
+
+    def start(self):
+        """Delete the instances left by exited processes and start the background recycling thread."""
+        try:
+            self.reclaim()
+        except Exception:
+            log.exception('Reclaiming the warm instances of exited processes failed')
+        self._thread = threading.Thread(target=self._run, name="mp-warm-pool-recycler", daemon=True)
+        self._thread.start()
+
+    def stop(self, drain=True):
+        """
+        Stop refilling the pool.
+
+        Args:
+            drain (bool): Delete the idle instances, default is True.
+        """
+        self._stopped.set()
+        self._executor.shutdown(wait=True, cancel_futures=True) # only the provisions already running are waited for
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            idle = [name for instances in self._idle.values() for name, _ in instances]
+            self._idle.clear()
+            self._filling.clear()
+        if drain and idle:
+            log.info(f'Draining warm instances [{", ".join(idle)}]')
+            results = delete_many(idle)
+            self._forget([name for name, result in results.items() if result.ok])
@@ -0,0 +1,232 @@
+##
+## Multipass Library - 2024
+## mp [Ubuntu:22.04]
+## File description:
+## multipass prometheus exporter for instance and tunnel metrics
+## @julesreyn
+##
+
+from mp.cmd.instance_info import get_instance_index
+from mp.cmd.instance_metrics import collect_fleet_metrics
+from mp.cmd.runner import stats
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import logging
+import shelve
+import dbm
+import time
+
+log = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+EXPOSE_STATUS_FILE = "port_status" # shelve file written by setup_tools/expose.py
+
+INSTANCE_GAUGES = [
+    ("mp_instance_cpu_usage_ratio", "CPU usage of the instance, 0.4 is 40%.", lambda m: m.cpu_usage),
+    ("mp_instance_memory_used_bytes", "Memory used by the instance.", lambda m: m.memory_used * 1024 ** 2 if m.memory_used is not None else None),
+    ("mp_instance_memory_total_bytes", "Memory size of the instance.", lambda m: m.memory_total * 1024 ** 2 if m.memory_total is not None else None),
+    ("mp_instance_disk_used_bytes", "Disk usage of the instance root filesystem.", lambda m: int(m.disk_used * 1024 ** 3) if m.disk_used is not None else None),
+    ("mp_instance_disk_total_bytes", "Size of the instance root filesystem.", lambda m: int(m.disk_total * 1024 ** 3) if m.disk_total is not None else None),
+    ("mp_instance_uptime_seconds", "Uptime of the instance.", lambda m: m.uptime),
+    ("mp_instance_processes", "Number of processes running on the instance.", lambda m: m.processes),
+    ("mp_instance_users", "Number of users logged in to the instance.", lambda m: m.users),
+]
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _sample(metric, labels, value):
+    label_text = ",".join(f'{key}="{_escape(label)}"' for key, label in labels.items())
+    return f'{metric}{{{label_text}}} {value}' if label_text else f'{metric} {value}'
+
+
+def load_tunnel_status(path=EXPOSE_STATUS_FILE):
+    """
+    Load the tunnel states saved by setup_tools/expose.py.
+
+    Args:
+        path (str): The path of the expose status shelve file.
+
+    Returns:
+        dict: A dictionary mapping port numbers to tunnel statuses, empty if the file does not exist.
+    """
+    try:
+        with shelve.open(path, flag="r") as db:
+            return {int(port): state for port, state in db.items()}
+    except dbm.error:
+        return {}
+
+
+def render_metrics(index, fleet, tunnels, duration, commands=None):
+    """
+    Render the collected values in the Prometheus text exposition format.
+
+    Args:
+        index (InstanceIndex): The index of all instances.
+        fleet (FleetMetrics): The metrics of the running instances.
+        tunnels (dict): The tunnel statuses from expose.
+        duration (float): The duration of the collection in seconds.
+        commands (dict): The per sub-command summaries of the runner statistics.
+
+    Returns:
+        bytes: The exposition payload.
+    """
+    lines = ["# HELP mp_instance_state State of the instance, 1 for its current state.", "# TYPE mp_instance_state gauge"]
+    for name, entry in index.by_name.items():
+        lines.append(_sample("mp_instance_state", {"instance": name, "state": entry.state}, 1))
+
+    lines += ["# HELP mp_instance_up Whether the instance answered the last metrics probe.", "# TYPE mp_instance_up gauge"]
+    for name in fleet.metrics:
+        lines.append(_sample("mp_instance_up", {"instance": name}, 1))
+    for name in fleet.timed_out + fleet.failed:
+        lines.append(_sample("mp_instance_up", {"instance": name}, 0))
+
+    for metric, description, getter in INSTANCE_GAUGES:
+        lines += [f'# HELP {metric} {description}', f'# TYPE {metric} gauge']
+        for name, metrics in fleet.metrics.items():
+            value = getter(metrics)
+            if value is not None:
+                lines.append(_sample(metric, {"instance": name}, value))
+
+    lines += ["# HELP mp_tunnel_up Whether the expose tunnel of the port is started, 1 if started and 0 otherwise.", "# TYPE mp_tunnel_up gauge"]
+    for port, state in sorted(tunnels.items()):
+        lines.append(_sample("mp_tunnel_up", {"port": port}, int(state.get("status") == "started")))
+
+    lines += ["# HELP mp_command_duration_seconds Duration of the multipass commands run by the exporter.",
+              "# TYPE mp_command_duration_seconds histogram"]
+    for subcommand, summary in sorted((commands or {}).items()):
+        cumulative = 0
+        for bound, count in summary["buckets"].items():
+            cumulative += count
+            lines.append(_sample("mp_command_duration_seconds_bucket", {"subcommand": subcommand, "le": "+Inf" if bound == float("inf") else bound}, cumulative))
+        lines.append(_sample("mp_command_duration_seconds_sum", {"subcommand": subcommand}, summary["total"]))
+        lines.append(_sample("mp_command_duration_seconds_count", {"subcommand": subcommand}, summary["count"]))
+
+    lines += [
+        "# HELP mp_collector_duration_seconds Duration of the last collection.",
+        "# TYPE mp_collector_duration_seconds gauge",
+        _sample("mp_collector_duration_seconds", {}, duration),
+        "# HELP mp_collector_last_success_timestamp_seconds Time of the last collection.",
+        "# TYPE mp_collector_last_success_timestamp_seconds gauge",
+        _sample("mp_collector_last_success_timestamp_seconds", {}, round(time.time(), 3)),
+    ]
+    return ("\n".join(lines) + "\n").encode()
+
+
+class MetricsCollector:
+    """
+    Collect the fleet metrics on a background thread and keep the last rendered payload.
+    Scrapes are answered from that payload, so they never run a multipass command,
+    and with a 503 until the first collection is done.
+
+    Args:
+        interval (float): The delay between two collections in seconds, default is 15.
+        workers (int): The maximum number of probes running at the same time, default is 8.
+        timeout (float): The deadline of each probe in seconds, default is 10.
+        status_file (str): The path of the expose status shelve file.
+    """
+
+    def __init__(self, interval=15.0, workers=8, timeout=10.0, status_file=EXPOSE_STATUS_FILE):
+        self.interval = interval
+        self.workers = workers
+        self.timeout = timeout
+        self.status_file = status_file
+        self._payload = b""
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def collect(self):
+        """Run one collection and replace the payload."""
+        start = time.monotonic()
+        index = get_instance_index()
+        fleet = collect_fleet_metrics(index.names("Running"), workers=self.workers, timeout=self.timeout)
+        tunnels = load_tunnel_status(self.status_file)
+        payload = render_metrics(index, fleet, tunnels, round(time.monotonic() - start, 3), stats()["commands"])
+        with self._lock:
+            self._payload = payload
+
+    def payload(self):
+        """
+        Get the last rendered payload.
+
+        Returns:
+            bytes: The Prometheus exposition payload, empty before the first collection.
+        """
+        with self._lock:
+            return self._payload
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.collect()
+            except Exception:
+                log.exception('Metrics collection failed')
+            self._stopped.wait(self.interval)
+
+    def start(self):
+        """Start collecting on a background thread."""
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="mp-metrics-collector", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        payload = self.server.collector.payload()
+        if not payload: # the first collection is still running
+            self.send_response(503)
+            self.send_header("Retry-After", "5")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+def serve(host="127.0.0.1", port=9464, interval=15.0, workers=8, timeout=10.0, status_file=EXPOSE_STATUS_FILE):
+    """
+    Serve the instance and tunnel metrics on http://<host>:<port>/metrics until interrupted.
+
+    Args:
+        host (str): The address to listen on, default is "127.0.0.1".
+        port (int): The port to listen on, default is 9464.
+        interval (float): The delay between two collections in seconds, default is 15.
+        workers (int): The maximum number of probes running at the same time, default is 8.
+        timeout (float): The deadline of each probe in seconds, default is 10.
+        status_file (str): The path of the expose status shelve file.
+
+    Example:
+        >>> serve(port=9464)
+    """
+    collector = MetricsCollector(interval, workers, timeout, status_file)
+    collector.start()
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.collector = collector
+    log.info(f'Serving metrics on http://{host}:{port}/metrics')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        collector.stop()
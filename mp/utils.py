@@ -0,0 +1,31 @@
+##
+## Multipass Library - 2024
+## mp [Ubuntu:22.04]
+## File description:
+## multipass library for the helpers shared by the backends and the instance library
+## @julesreyn
+##
+
+import re
+
+_SIZE_UNITS = {"": 1, "B": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def parse_size(size):
+    """
+    Convert a multipass size such as "512M", "2G" or "1.5GiB" to bytes.
+
+    Args:
+        size (str | int): The size, a plain number is a number of bytes.
+
+    Returns:
+        int: The size in bytes.
+
+    Example:
+        >>> parse_size("2G")
+        2147483648
+    """
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:I?B)?\s*', str(size).upper())
+    if not match:
+        raise ValueError(f'Invalid size: {size}')
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2)])
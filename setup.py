@@ -11,4 +11,9 @@ setup(
     install_requires=[
         
     ],
+    entry_points={
+        'console_scripts': [
+            'mp=mp.__main__:main',
+        ],
+    },
 )
\ No newline at end of file
@@ -45,7 +45,7 @@ mkdir -p ~/.cloudflared
 
 echo -e "\n\n[+] Update motd\n\n"
 
-sudo cp /home/ubuntu/00-header /etc/update-motd.d/00-header
-sudo cp /home/ubuntu/10-help-text /etc/update-motd.d/10-help-text
+sudo cp /home/ubuntu/update-motd.d/00-header /etc/update-motd.d/00-header
+sudo cp /home/ubuntu/update-motd.d/10-help-text /etc/update-motd.d/10-help-text
 
 echo -e "\n\n[+] Finished configuration of instance\n\n"
@@ -0,0 +1,63 @@
+##
+## Multipass Library - 2024
+## mp [Ubuntu:22.04]
+## File description:
+## pytest fixtures, every test runs against the FakeBackend or the benchmarks/bin stand-in
+## @julesreyn
+##
+
+from mp.backends import FakeBackend, set_backend
+from mp.cmd.instance_cache import instance_cache
+from mp.cmd.runner import runner
+from types import SimpleNamespace
+import subprocess
+import importlib
+import pytest
+import os
+
+
+@pytest.fixture(autouse=True)
+def webhook(monkeypatch):
+    """Answer the logger webhook with a 204 and keep the posted messages, no request leaves the host."""
+    sent = []
+
+    def post(url, data=None, headers=None):
+        sent.append(data)
+        return SimpleNamespace(status_code=204, text="")
+
+    monkeypatch.setenv("WEBHOOK_URL", "http://webhook.invalid")
+    monkeypatch.setattr(importlib.import_module("mp.logger").requests, "post", post) # mp.logger is shadowed by the logger function
+    return sent
+
+
+@pytest.fixture(autouse=True)
+def isolated():
+    """Start every test with an empty cache and runner, on the multipass CLI backend."""
+    instance_cache.clear()
+    runner.reset()
+    yield
+    set_backend(None)
+    runner.configure()
+
+
+@pytest.fixture
+def guest_dir(tmp_path):
+    """The directory standing for the filesystem of the fake instance, its home directory."""
+    path = tmp_path / "guest"
+    path.mkdir()
+    return path
+
+
+@pytest.fixture
+def backend(guest_dir):
+    """A FakeBackend with a running instance1, whose execs run on the host in guest_dir."""
+
+    def run_locally(name, argv, input):
+        binary = isinstance(input, bytes)
+        result = subprocess.run(argv, input=input, capture_output=True, text=not binary, cwd=guest_dir,
+                                env=dict(os.environ, HOME=str(guest_dir)))
+        return result.returncode, result.stdout, result.stderr
+
+    fake = FakeBackend(["instance1"], exec_handler=run_locally)
+    set_backend(fake)
+    return fake
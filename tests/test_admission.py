@@ -0,0 +1,62 @@
+##
+## Multipass Library - 2024
+## mp [Ubuntu:22.04]
+## File description:
+## tests of the admission control accounting
+## @julesreyn
+##
+
+from mp.cmd.admission import AdmissionController, Capacity, admission, enable_admission_control, disable_admission_control
+import pytest
+
+GIB = 1024 ** 3
+
+
+@pytest.fixture
+def controller(backend, monkeypatch):
+    """A controller on a host of 4 CPUs, 8 GiB of memory and 100 GiB of disk, without overcommit."""
+    monkeypatch.setattr("mp.cmd.admission.host_capacity", lambda disk_path="/": Capacity(4, 8 * GIB, 100 * GIB))
+    return AdmissionController(cpu_ratio=1.0)
+
+
+def test_headroom_counts_active_instances_and_every_disk(backend, controller):
+    backend.add_instance("stopped", state="Stopped", cpus="2", memory="4G", disk="10G")
+    # multipass reports no disk for a stopped instance, it counts as the default 5G
+    assert controller.headroom() == Capacity(3, 6 * GIB, 90 * GIB)
+
+
+def test_reservations_count_until_released(controller):
+    assert controller.reserve("first", 2, "2G")
+    assert not controller.reserve("second", 2, "2G")
+    assert controller.allocated() == Capacity(3, 4 * GIB, 10 * GIB)
+
+
+def test_released_reservation_outlives_an_older_listing(backend, controller):
+    assert controller.reserve("new", 2, "2G")
+    allocations, listed_at = controller._instance_allocations() # started before the instance exists
+    backend.add_instance("new", cpus="2", memory="2G")
+    controller.release("new")
+    with controller._condition:
+        assert controller._total(allocations, listed_at).cpus == 3
+    assert controller.allocated() == Capacity(3, 4 * GIB, 10 * GIB)
+    assert "new" not in controller._reserved
+
+
+def test_unknown_allocations_reject_the_launch(controller, monkeypatch):
+    monkeypatch.setattr("mp.cmd.admission.fetch_snapshots", lambda names=None: None)
+    assert controller.headroom() is None
+    assert not controller.reserve("new", 1, "1G")
+
+
+def test_admission_context(controller, monkeypatch):
+    monkeypatch.setattr("mp.cmd.admission.host_capacity", lambda disk_path="/": Capacity(1, 8 * GIB, 100 * GIB))
+    try:
+        enable_admission_control(cpu_ratio=2.0)
+        with admission("new", 1, "1G") as admitted:
+            assert admitted
+        with admission("big", 4, "1G") as admitted:
+            assert not admitted
+    finally:
+        disable_admission_control()
+    with admission("big", 64, "1T") as admitted:
+        assert admitted
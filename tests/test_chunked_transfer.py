@@ -0,0 +1,79 @@
+##
+## Multipass Library - 2024
+## mp [Ubuntu:22.04]
+## File description:
+## tests of the resumable chunked transfers
+## @julesreyn
+##
+
+from mp.cmd.chunked_transfer import put_large_file, get_large_file, WRITE_CHUNK
+import os
+import pytest
+
+CHUNK = 1024
+
+
+@pytest.fixture
+def source(tmp_path, monkeypatch):
+    monkeypatch.setattr("mp.cmd.chunked_transfer.TRANSFER_STATE_DIR", tmp_path / "transfers")
+    path = tmp_path / "data.bin"
+    path.write_bytes(os.urandom(CHUNK * 5 + 100))
+    return path
+
+
+@pytest.fixture
+def writes(backend):
+    """The offsets of the chunks written on the instance, the chunk at offset 2048 fails while failing is set."""
+    handler = backend.exec_handler
+    offsets = []
+    writes = {"offsets": offsets, "failing": True}
+
+    def flaky(name, argv, input):
+        if argv[:3] == ["python3", "-c", WRITE_CHUNK]:
+            offsets.append(int(argv[4]))
+            if writes["failing"] and argv[4] == str(2 * CHUNK):
+                return 1, "", "disk full"
+        return handler(name, argv, input)
+
+    backend.exec_handler = flaky
+    return writes
+
+
+def test_interrupted_transfer_resumes_with_the_missing_chunks(source, writes, guest_dir):
+    assert not put_large_file("instance1", str(source), "~/data.bin", chunk_size=CHUNK, retries=0)
+    assert sorted(writes["offsets"]) == [index * CHUNK for index in range(6)]
+    assert not (guest_dir / "data.bin").exists()
+
+    writes["offsets"].clear()
+    writes["failing"] = False
+    assert put_large_file("instance1", str(source), "~/data.bin", chunk_size=CHUNK)
+    assert writes["offsets"] == [2 * CHUNK]
+    assert (guest_dir / "data.bin").read_bytes() == source.read_bytes()
+    assert not (guest_dir / "data.bin.part").exists()
+    assert not os.listdir(source.parent / "transfers")
+
+
+def test_chunks_lost_on_the_instance_are_sent_again(source, writes, guest_dir):
+    assert not put_large_file("instance1", str(source), "~/data.bin", chunk_size=CHUNK, retries=0)
+    (guest_dir / "data.bin.part").unlink()
+    writes["offsets"].clear()
+    writes["failing"] = False
+    assert put_large_file("instance1", str(source), "~/data.bin", chunk_size=CHUNK)
+    assert len(writes["offsets"]) == 6
+    assert (guest_dir / "data.bin").read_bytes() == source.read_bytes()
+
+
+def test_changed_source_starts_over(source, writes):
+    assert not put_large_file("instance1", str(source), "~/data.bin", chunk_size=CHUNK, retries=0)
+    source.write_bytes(os.urandom(CHUNK * 3))
+    writes["offsets"].clear()
+    writes["failing"] = False
+    assert put_large_file("instance1", str(source), "~/data.bin", chunk_size=CHUNK)
+    assert sorted(writes["offsets"]) == [0, CHUNK, 2 * CHUNK]
+
+
+def test_round_trip(source, writes, tmp_path):
+    writes["failing"] = False
+    assert put_large_file("instance1", str(source), "~/data.bin", chunk_size=CHUNK)
+    assert get_large_file("instance1", "~/data.bin", str(tmp_path / "copy.bin"), chunk_size=CHUNK)
+    assert (tmp_path / "copy.bin").read_bytes() == source.read_bytes()
@@ -0,0 +1,64 @@
+##
+## Multipass Library - 2024
+## mp [Ubuntu:22.04]
+## File description:
+## tests of the incremental directory synchronisation
+## @julesreyn
+##
+
+from mp.cmd.file_sync import sync_dir
+import pytest
+
+
+@pytest.fixture
+def site(tmp_path, monkeypatch):
+    monkeypatch.setattr("mp.cmd.file_sync.SYNC_CACHE_DIR", tmp_path / "sync")
+    local = tmp_path / "site"
+    (local / "css").mkdir(parents=True)
+    (local / "index.html").write_text("<h1>home</h1>")
+    (local / "css" / "main.css").write_text("body {}")
+    (local / "notes.pyc").write_bytes(b"\0")
+    return local
+
+
+def test_only_new_and_changed_files_are_sent(backend, site, guest_dir):
+    remote = guest_dir / "srv"
+    first = sync_dir("instance1", str(site), str(remote), exclude=["*.pyc"])
+    assert first.ok
+    assert sorted(transfer.path for transfer in first.transferred) == ["css/main.css", "index.html"]
+    assert (remote / "css" / "main.css").read_text() == "body {}"
+    assert not (remote / "notes.pyc").exists()
+
+    calls = len(backend.calls)
+    second = sync_dir("instance1", str(site), str(remote), exclude=["*.pyc"])
+    assert (second.transferred, second.unchanged) == ([], 2)
+    assert len(backend.calls) == calls + 1 # the manifest exec only
+
+    (site / "index.html").write_text("<h1>HOME</h1>") # same size, new content
+    third = sync_dir("instance1", str(site), str(remote), exclude=["*.pyc"])
+    assert [transfer.path for transfer in third.transferred] == ["index.html"]
+    assert (remote / "index.html").read_text() == "<h1>HOME</h1>"
+
+
+def test_changes_made_on_the_instance_are_detected(backend, site, guest_dir):
+    remote = guest_dir / "srv"
+    sync_dir("instance1", str(site), str(remote))
+    (remote / "css" / "main.css").write_text("body {color: red}")
+    result = sync_dir("instance1", str(site), str(remote))
+    assert [transfer.path for transfer in result.transferred] == ["css/main.css"]
+    assert (remote / "css" / "main.css").read_text() == "body {}"
+
+
+def test_extraneous_files_are_deleted_unless_excluded(backend, site, guest_dir):
+    remote = guest_dir / "srv"
+    remote.mkdir()
+    (remote / "old.html").write_text("old")
+    (remote / "cache.pyc").write_text("keep")
+    result = sync_dir("instance1", str(site), str(remote), delete=True, exclude=["*.pyc"])
+    assert result.deleted == ["old.html"]
+    assert not (remote / "old.html").exists()
+    assert (remote / "cache.pyc").exists()
+
+
+def test_missing_source(backend, tmp_path):
+    assert sync_dir("instance1", str(tmp_path / "missing"), "/srv").error.endswith("does not exist")
@@ -0,0 +1,78 @@
+##
+## Multipass Library - 2024
+## mp [Ubuntu:22.04]
+## File description:
+## tests of the instance metadata cache TTLs and invalidation
+## @julesreyn
+##
+
+from mp.cmd.instance_cache import InstanceCache, FOREVER
+from mp.cmd.instance_info import get_state
+from mp.cmd.instance_operations import stop_instance
+import threading
+import pytest
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("mp.cmd.instance_cache.time.monotonic", lambda: now[0])
+    return now
+
+
+def test_entries_expire_after_their_ttl(clock):
+    cache = InstanceCache({"state": 2.0, "image": FOREVER})
+    cache.set("instance1", "state", "Running")
+    cache.set("instance1", "image", "22.04 LTS")
+    clock[0] += 1.9
+    assert cache.lookup("instance1", "state") == (True, "Running")
+    clock[0] += 0.2
+    assert cache.lookup("instance1", "state") == (False, None)
+    clock[0] += 10 ** 6
+    assert cache.lookup("instance1", "image") == (True, "22.04 LTS")
+
+
+def test_get_loads_on_miss_and_never_caches_none():
+    cache = InstanceCache()
+    loads = []
+    assert cache.get("instance1", "image", lambda: loads.append(1)) is None
+    assert cache.get("instance1", "image", lambda: loads.append(1) or "22.04 LTS") == "22.04 LTS"
+    assert cache.get("instance1", "image", lambda: loads.append(1) or "24.04 LTS") == "22.04 LTS"
+    assert len(loads) == 2
+    assert cache.stats() == {"hits": 1, "misses": 2, "entries": 1, "bypass": False}
+
+
+def test_invalidate_drops_the_instance_fields_and_the_fleet_entries():
+    cache = InstanceCache({"state": FOREVER, "ip": FOREVER, "index": FOREVER})
+    cache.set("instance1", "state", "Running")
+    cache.set("instance1", "ip", "10.0.0.2")
+    cache.set("instance2", "state", "Running")
+    cache.set(None, "index", "listing")
+    cache.invalidate("instance1", ["state"])
+    assert cache.lookup("instance1", "state") == (False, None)
+    assert cache.lookup("instance1", "ip") == (True, "10.0.0.2")
+    assert cache.lookup("instance2", "state") == (True, "Running")
+    assert cache.lookup(None, "index") == (False, None)
+
+
+def test_bypassed_only_applies_to_the_calling_thread():
+    cache = InstanceCache({"state": FOREVER})
+    cache.set("instance1", "state", "Running")
+    seen = []
+    with cache.bypassed():
+        with cache.bypassed():
+            pass
+        assert cache.lookup("instance1", "state") == (False, None)
+        thread = threading.Thread(target=lambda: seen.append(cache.lookup("instance1", "state")))
+        thread.start()
+        thread.join()
+    assert seen == [(True, "Running")]
+    assert cache.lookup("instance1", "state") == (True, "Running")
+
+
+def test_lifecycle_commands_invalidate_the_state(backend):
+    assert get_state("instance1") == "Running"
+    assert get_state("instance1") == "Running"
+    assert backend.calls.count(["info", "--format", "json", "instance1"]) == 1
+    assert stop_instance("instance1")
+    assert get_state("instance1") == "Stopped"
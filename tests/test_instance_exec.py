@@ -0,0 +1,49 @@
+##
+## Multipass Library - 2024
+## mp [Ubuntu:22.04]
+## File description:
+## tests of the batched and fan-out execs
+## @julesreyn
+##
+
+from mp.cmd.instance_exec import ExecBatch, exec_many
+
+
+def test_batch_splits_the_output_per_command(backend):
+    batch = ExecBatch("instance1", stop_on_error=False)
+    batch.add("echo one; echo err >&2").add(["printf", "%s\n", "it's quoted"]).add("false").add("echo four")
+    results = batch.run()
+    assert [result.exit_code for result in results] == [0, 0, 1, 0]
+    assert [result.stdout for result in results] == ["one", "it's quoted", "", "four"]
+    assert results[0].stderr == "err"
+    assert len(backend.calls) == 1
+
+
+def test_batch_keeps_output_without_trailing_newline(backend):
+    lines = []
+    results = ExecBatch("instance1").add("printf partial").add("echo next").run(on_line=lambda *line: lines.append(line))
+    assert [result.stdout for result in results] == ["partial", "next"]
+    assert (0, "stdout", "partial") in lines
+
+
+def test_batch_stops_on_error(backend, webhook):
+    results = ExecBatch("instance1").add("true").add("exit 3").add("echo never").run()
+    assert [result.exit_code for result in results] == [0, 3, None]
+    assert results[2].stdout == ""
+    assert len(webhook) == 1
+
+
+def test_batch_ignores_marker_lookalikes(backend):
+    results = ExecBatch("instance1").add("echo __mp_batch_0000000000000000__ 0 end 9").run()
+    assert results[0].exit_code == 0
+    assert results[0].stdout == "__mp_batch_0000000000000000__ 0 end 9"
+
+
+def test_exec_many_records_errors_per_target(backend, monkeypatch):
+    def unreachable(*args, **kwargs):
+        raise RuntimeError("webhook unreachable")
+
+    backend.add_instance("instance2")
+    monkeypatch.setattr("mp.cmd.instance_exec.logger", unreachable)
+    results = exec_many(["instance1", "instance2"], ["sh", "-c", "exit 4"]).results
+    assert {name: result.exit_code for name, result in results.items()} == {"instance1": 4, "instance2": 4}
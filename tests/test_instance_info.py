@@ -0,0 +1,92 @@
+##
+## Multipass Library - 2024
+## mp [Ubuntu:22.04]
+## File description:
+## tests of the instance snapshots parsed from `multipass info --format json`
+## @julesreyn
+##
+
+from mp.cmd.instance_info import _parse_snapshots, fetch_snapshots, get_snapshot, get_snapshots
+from mp.cmd.instance_cache import instance_cache
+import json
+
+
+INFO = {
+    "errors": [],
+    "info": {
+        "web": {
+            "state": "Running",
+            "ipv4": ["10.0.0.2", "172.17.0.1"],
+            "image_release": "22.04 LTS",
+            "image_hash": "abc123",
+            "release": "Ubuntu 22.04.4 LTS",
+            "load": [0.5, 0.25, 0.1],
+            "cpu_count": "2",
+            "memory": {"total": 2147483648, "used": 536870912},
+            "disks": {"sda1": {"total": "5000", "used": "1000"}, "sdb1": {"total": "3000", "used": "500"}},
+            "mounts": {"/srv": {"source_path": "/home/user/site"}},
+        },
+        "db": {
+            "state": "Stopped",
+            "ipv4": [],
+            "image_release": "",
+            "cpu_count": "",
+            "memory": {},
+            "disks": {"sda1": {"total": "5000"}},
+            "mounts": {},
+        },
+    },
+}
+
+
+def test_parse_snapshots_reads_every_field():
+    web = _parse_snapshots(json.dumps(INFO))["web"]
+    assert web.state == "Running"
+    assert web.ip == "10.0.0.2"
+    assert web.image == "22.04 LTS"
+    assert web.load == (0.5, 0.25, 0.1)
+    assert web.cpus == 2
+    assert (web.disk_used, web.disk_total) == (1500, 8000)
+    assert (web.memory_used, web.memory_total) == (536870912, 2147483648)
+    assert web.mounts == {"/srv": "/home/user/site"}
+
+
+def test_parse_snapshots_leaves_missing_values_unset():
+    db = _parse_snapshots(json.dumps(INFO))["db"]
+    assert db.ip is None
+    assert db.image is None
+    assert db.cpus is None
+    assert db.disk_used is None
+    assert db.disk_total == 5000
+    assert db.memory_total is None
+    assert "Disk usage:     --" in db.describe()
+
+
+def test_parse_snapshots_filters_names_and_fills_the_cache():
+    snapshots = _parse_snapshots(json.dumps(INFO), ["db"])
+    assert list(snapshots) == ["db"]
+    assert instance_cache.lookup("db", "state") == (True, "Stopped")
+    assert instance_cache.lookup("web", "state") == (False, None)
+
+
+def test_get_snapshot_from_the_backend(backend):
+    backend.add_instance("stopped", state="Stopped")
+    snapshot = get_snapshot("instance1")
+    assert snapshot.state == "Running"
+    assert snapshot.ip == backend.instances["instance1"].ipv4
+    assert snapshot.memory_total == 2 * 1024 ** 3
+    assert snapshot.disk_total == 5 * 1024 ** 3
+    assert get_snapshot("stopped").ip is None
+    assert get_snapshot("missing") is None
+
+
+def test_fetch_snapshots_falls_back_on_the_full_listing(backend):
+    snapshots = fetch_snapshots(["instance1", "missing"])
+    assert list(snapshots) == ["instance1"]
+    assert backend.calls[-1] == ["info", "--format", "json", "--all"]
+
+
+def test_fetch_snapshots_reports_a_failed_query(backend, webhook):
+    assert fetch_snapshots(["missing"]) is None
+    assert get_snapshots(["missing"]) == {}
+    assert webhook
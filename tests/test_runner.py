@@ -0,0 +1,59 @@
+##
+## Multipass Library - 2024
+## mp [Ubuntu:22.04]
+## File description:
+## tests of the runner timeouts, on the benchmarks/bin stand-in client
+## @julesreyn
+##
+
+from mp.backends import CliBackend, FakeBackend, set_backend
+from mp.cmd.runner import runner, run_multipass, TIMEOUT_CODE
+from pathlib import Path
+import subprocess
+import pytest
+
+STAND_IN = Path(__file__).resolve().parent.parent / "benchmarks" / "bin" / "multipass"
+
+
+@pytest.fixture
+def slow_client(tmp_path, monkeypatch):
+    """The stand-in multipass client, answering every command after 0.5s."""
+    monkeypatch.setenv("MP_BENCH_STATE", str(tmp_path / "state.json"))
+    monkeypatch.setenv("MP_BENCH_FLEET", "1")
+    monkeypatch.setenv("MP_BENCH_LATENCY", "0.5")
+    set_backend(CliBackend(str(STAND_IN)))
+
+
+def test_default_timeout_exits_with_timeout_code(slow_client):
+    runner.configure(default_timeout=0.1)
+    result = run_multipass(["list", "--format", "json"])
+    assert result.returncode == TIMEOUT_CODE
+    assert "timed out after 0.1s" in result.stderr
+    summary = runner.stats()["commands"]["list"]
+    assert (summary["count"], summary["timeouts"], summary["errors"]) == (1, 1, 0)
+
+
+def test_explicit_timeout_raises(slow_client):
+    runner.configure(default_timeout=30)
+    with pytest.raises(subprocess.TimeoutExpired):
+        run_multipass(["list", "--format", "json"], timeout=0.1)
+    assert runner.stats()["commands"]["list"]["timeouts"] == 1
+
+
+def test_commands_within_the_deadline_succeed(slow_client):
+    runner.configure(default_timeout=30)
+    assert run_multipass(["list", "--format", "json"]).returncode == 0
+    assert runner.stats()["instances"] == {}
+
+
+def test_failed_start_is_recorded(monkeypatch):
+    def missing(*args, **kwargs):
+        raise FileNotFoundError("multipass")
+
+    backend = FakeBackend(["instance1"])
+    monkeypatch.setattr(backend, "popen", missing)
+    set_backend(backend)
+    with pytest.raises(FileNotFoundError):
+        runner.popen(["exec", "instance1", "--", "true"])
+    summary = runner.stats()["instances"]["instance1"]
+    assert (summary["count"], summary["errors"]) == (1, 1)